@@ -4,4 +4,4 @@ This program is part of the Biomine project <http://biomine.cs.helsinki.fi/>
 
 @author: Atte Hinkka <atte.hinkka@cs.helsinki.fi>
 '''
-import db, file, crawler
+import db, file, binary, crawler
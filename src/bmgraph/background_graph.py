@@ -5,6 +5,8 @@ import sys
 import os, math, time, codecs
 from collections import defaultdict
 
+from file import open_file
+
 def entropy(elements):
 	sum = 0
 	for element in elements:
@@ -31,12 +33,16 @@ target = sys.argv[1]
 sep = ". "
 if len(sys.argv) > 2:
 	sep = sys.argv[2]
+# Compressed if it ends in .gz, .bz2, .xz or .zst
+output = "graph_sentence_nouns.txt"
+if len(sys.argv) > 3:
+	output = sys.argv[3]
 
 term_sentence = defaultdict(set)		
 term_to_term = defaultdict(set)	
 S = 0
 
-f = codecs.open(target, "r", encoding = 'utf-8')
+f = open_file(target, "r", encoding = 'utf-8')
 data = f.read()
 f.close()
 
@@ -57,7 +63,7 @@ for s in sentences:
 		print 100*S/len(sentences),"% left"
 
 print "Writing bg graph"
-f = codecs.open("graph_sentence_nouns.txt", "w", encoding = 'utf-8')
+f = open_file(output, "w", encoding = 'utf-8')
 f.write("term_a	term_b	ll_sen\n")	
 counter = 0
 target = len(term_to_term)
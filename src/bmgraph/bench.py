@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''Benchmarks for the graph backends.
+
+Usage: bench.py -a ACTION -d DATABASE [options]
+       bench.py -a memory [-f BMGRAPH-FILE | -e EDGES]
+'''
+
+import sys
+import os
+import gc
+import time
+import random
+import sqlite3
+import multiprocessing
+import logging
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger("bmgraph.bench")
+
+from optparse import OptionParser
+
+import db as bmgraph_db
+
+
+def _timed(f, *args):
+    start = time.time()
+    ret = f(*args)
+    return time.time() - start, ret
+
+
+def _report(name, timings):
+    timings = sorted(timings)
+    n = len(timings)
+    print "%-24s n=%-6i mean=%9.1f us  median=%9.1f us  p99=%9.1f us" % (
+        name, n, sum(timings) / n * 1e6, timings[n // 2] * 1e6,
+        timings[min(n - 1, int(n * 0.99))] * 1e6)
+
+
+def bench_csr(path, queries, k):
+    """Load time of the in-memory CSR graph and top-k neighbour query
+    latency against the SQLite path."""
+    import csrgraph
+
+    connection = bmgraph_db.pooled_connection(path)
+    ans = [n.an for n in bmgraph_db.sample(connection, queries)]
+
+    elapsed, graph = _timed(csrgraph.CSRGraph.from_db, connection)
+    print "CSR load: %.2f s for %i nodes, %i adjacencies" % (
+        elapsed, len(graph), len(graph.neighbours))
+
+    if bmgraph_db.has_adjacency(connection):
+        sqlite_query = lambda an: bmgraph_db.top_neighbours(connection, an, k)
+        _report("sqlite top_neighbours", [_timed(sqlite_query, an)[0] for an in ans])
+    _report("sqlite neighbourhood",
+            [_timed(bmgraph_db.neighbourhood, connection, an)[0] for an in ans])
+    _report("csr neighbours_of",
+            [_timed(graph.neighbours_of, an, k)[0] for an in ans])
+
+
+def bench_queries(path, queries, k):
+    """Statements per logical call of the graph queries, to catch N+1
+    patterns, and the tables they scan whole."""
+    connection = bmgraph_db.open_readonly(path, factory=bmgraph_db.InstrumentedConnection)
+    ans = [n.an for n in bmgraph_db.sample(connection, queries)]
+    for an in ans:
+        for e in bmgraph_db.edges(connection, an):
+            unicode(e)
+        bmgraph_db.neighbourhood(connection, an)
+        if bmgraph_db.has_adjacency(connection):
+            bmgraph_db.top_neighbours(connection, an, k)
+        bmgraph_db.suggest(connection, an[:3], [], prefix=True)
+
+    stats = bmgraph_db.query_stats(connection)
+    for name, call in sorted(stats.iteritems()):
+        print "%-24s calls=%-6i statements/call=%7.1f  mean=%9.1f us  scans: %s" % (
+            name or "<no call>", call['calls'], call['statements_per_call'],
+            call['seconds'] / max(call['calls'], 1) * 1e6,
+            ", ".join(call['full_scans']) or "-")
+
+
+def _bench_connection(path, mode):
+    if mode == 'default':
+        connection = sqlite3.connect(path, factory=bmgraph_db.GraphConnection)
+        connection.row_factory = sqlite3.Row
+        return connection
+    return bmgraph_db.open_readonly(path, immutable=(mode == 'immutable'))
+
+
+def _edges_worker(path, mode, ans, ready, start, results):
+    connection = _bench_connection(path, mode)
+    ready.put(None)
+    start.wait()
+    began = time.time()
+    for an in ans:
+        for e in bmgraph_db.edges(connection, an):
+            unicode(e)
+    results.put(time.time() - began)
+
+
+def bench_concurrent(path, queries, processes):
+    """Throughput of edges() over all processes, each running the same
+    queries on its own connection, for the connection modes."""
+    connection = bmgraph_db.open_readonly(path)
+    ans = [n.an for n in bmgraph_db.sample(connection, queries)]
+    connection.close()
+
+    for mode in ('default', 'readonly', 'immutable'):
+        for count in processes:
+            ready = multiprocessing.Queue()
+            results = multiprocessing.Queue()
+            start = multiprocessing.Event()
+            workers = [multiprocessing.Process(target=_edges_worker,
+                                               args=(path, mode, ans, ready, start, results))
+                       for i in range(count)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                ready.get()
+            start.set()
+            elapsed = max([results.get() for w in workers])
+            for w in workers:
+                w.join()
+            print "%-10s processes=%-3i %9.0f edges() calls/s" % (
+                mode, count, count * len(ans) / elapsed)
+
+
+def _resident_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def bench_memory(filename, edges):
+    """Resident memory per edge of an in-memory bmgraph.file.Graph, read
+    from filename or, without one, of edges random LLR edges."""
+    import file as bmgraph_file
+
+    gc.collect()
+    before = _resident_bytes()
+    start = time.time()
+    sink = bmgraph_file.GraphObjectSink(dedupe=False)
+    if filename:
+        with bmgraph_file.open_file(filename) as f:
+            bmgraph_file.read_file_batched(f, bmgraph_file.BatchSinkAdapter(sink))
+    else:
+        words = [u"w%i" % i for i in range(max(edges // 8, 2))]
+        for i in xrange(edges):
+            n1, n2 = random.sample(words, 2)
+            sink.edge_read(n1, u"Term", n2, u"Term", u"is_related_to",
+                           {u"llr": u"%.2f" % random.uniform(0, 100)})
+    elapsed = time.time() - start
+    graph = sink.get_object()
+    gc.collect()
+    used = _resident_bytes() - before
+
+    count = sum(len(n.edges) for n in graph.nodes.itervalues()) // 2
+    print "Graph of %i nodes and %i edges in %.2f s: %.1f MiB, %.0f bytes/edge" % (
+        len(graph.nodes), count, elapsed, used / 1048576.0, used / float(max(count, 1)))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-a", "--action", dest="action",
+                      help="choose ACTION [csr|queries|concurrent|memory]", metavar="ACTION")
+    parser.add_option("-d", "--database", dest="db",
+                      help="sqlite graph database to benchmark",
+                      metavar="DATABASE-FILE")
+    parser.add_option("-f", "--file", dest="file",
+                      help="BMGraph file for memory", metavar="BMGRAPH-FILE")
+    parser.add_option("-e", "--edges", dest="edges", type="int", default=1000000,
+                      help="number of random edges for memory without a file")
+    parser.add_option("-n", "--queries", dest="queries", type="int", default=1000,
+                      help="number of queries to time")
+    parser.add_option("-k", dest="k", type="int", default=200,
+                      help="number of neighbours per query")
+    parser.add_option("-p", "--processes", dest="processes", default="1,4,16",
+                      help="comma-separated process counts for concurrent")
+    opts, args = parser.parse_args()
+
+    if not opts.action:
+        parser.error("Action must be specified.")
+    if opts.action == 'memory':
+        bench_memory(opts.file, opts.edges)
+        return
+    if not opts.db:
+        parser.error("Database must be specified.")
+
+    if opts.action == 'csr':
+        bench_csr(opts.db, opts.queries, opts.k)
+    elif opts.action == 'queries':
+        bench_queries(opts.db, opts.queries, opts.k)
+    elif opts.action == 'concurrent':
+        bench_concurrent(opts.db, opts.queries,
+                         [int(p) for p in opts.processes.split(',')])
+    else:
+        parser.error("Unknown action %s." % opts.action)
+
+
+if __name__ == '__main__':
+    main()
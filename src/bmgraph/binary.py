@@ -0,0 +1,437 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''Binary BMGraph files (.bmgb), read through mmap.
+
+A .bmgb file has a header, a directory of named sections and the sections:
+
+  strings     string_offsets (u64) into string_data, the UTF-8 node names,
+              node and edge types, attribute names and values, each once
+  nodes       node_names and node_types (u32 string ids) and node_flags
+              (u8, 1 for special nodes), nodes in order of name
+  adjacency   adj_offsets (u64) into adj_data, which has the (neighbour,
+              edge) pairs of the edges of each node as varints, ordered by
+              neighbour, each neighbour as the difference to the previous
+  edges       edge_n1, edge_n2 and edge_types (u32)
+  attributes  node_keys and edge_keys (u32 string ids) and for the i'th
+              key the columns nai.o and eai.o of value offsets (u32) for
+              each node or edge into the columns nai.v and eai.v of value
+              string ids (u32)
+
+Numbers are little-endian, and a missing string, like the type of an
+untyped node, is 0xffffffff.  Opening a file only reads its header; nodes,
+edges and attributes are read from the map as they are used.
+
+Usage: binary.py IN.bmg OUT.bmgb
+       binary.py IN.bmgb OUT.bmg
+
+The .bmg file may be compressed, see bmgraph.file.open_file().
+'''
+
+from __future__ import with_statement
+
+import sys
+import mmap
+import struct
+import UserDict
+import logging
+logger = logging.getLogger("bmgraph.binary")
+
+import file as bmgraph_file
+
+_MAGIC = 'BMGB'
+_VERSION = 1
+_NONE = 0xffffffff
+
+_header = struct.Struct('<4sII')
+_section = struct.Struct('<16sQQ')
+_u8 = struct.Struct('<B')
+_u32 = struct.Struct('<I')
+_u64 = struct.Struct('<Q')
+
+# Values packed by one struct.pack() call when writing
+_pack_chunk = 65536
+
+
+def _pack(code, values):
+    values = list(values)
+    return ''.join(struct.pack('<%i%s' % (len(values[i:i + _pack_chunk]), code),
+                               *values[i:i + _pack_chunk])
+                   for i in xrange(0, len(values), _pack_chunk))
+
+
+def _varint(value, out):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+class _StringPool(object):
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, s):
+        if s is None:
+            return _NONE
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+
+def _attribute_columns(prefix, objects, pool):
+    """Returns the key string ids and the sections of the attribute
+    columns of objects."""
+    keys = []
+    for o in objects:
+        if o.has_attributes():
+            for key in o.attributes:
+                if key not in keys:
+                    keys.append(key)
+    sections = []
+    for i, key in enumerate(keys):
+        offsets = [0]
+        values = []
+        for o in objects:
+            if o.has_attributes():
+                values.extend(pool.add(v) for v in o.attributes.get(key, ()))
+            offsets.append(len(values))
+        sections.append(('%s%i.o' % (prefix, i), _pack('I', offsets)))
+        sections.append(('%s%i.v' % (prefix, i), _pack('I', values)))
+    return [pool.add(key) for key in keys], sections
+
+
+def write_bmgb(graph, filename):
+    """Writes graph, a bmgraph.file.Graph, to filename as a .bmgb file."""
+    pool = _StringPool()
+    nodes = sorted(graph.nodes.itervalues(), key=lambda n: n.name)
+    index = dict((id(n), i) for i, n in enumerate(nodes))
+
+    # Each edge once, like bmgraph.file.write_graph()
+    edges = []
+    for node in nodes:
+        previous = None
+        for edge in node.edges:
+            if edge.n1 is node and edge is not previous:
+                edges.append(edge)
+            previous = edge
+
+    adjacency = [[] for n in nodes]
+    for i, edge in enumerate(edges):
+        n1, n2 = index[id(edge.n1)], index[id(edge.n2)]
+        adjacency[n1].append((n2, i))
+        adjacency[n2].append((n1, i))
+    adj_offsets = [0]
+    adj_data = bytearray()
+    for pairs in adjacency:
+        pairs.sort()
+        previous = 0
+        for neighbour, edge in pairs:
+            _varint(neighbour - previous, adj_data)
+            _varint(edge, adj_data)
+            previous = neighbour
+        adj_offsets.append(len(adj_data))
+    del adjacency
+
+    sections = [
+        ('node_names', _pack('I', [pool.add(n.name) for n in nodes])),
+        ('node_types', _pack('I', [pool.add(n.type) for n in nodes])),
+        ('node_flags', _pack('B', [int(bool(n.special_node)) for n in nodes])),
+        ('adj_offsets', _pack('Q', adj_offsets)),
+        ('adj_data', str(adj_data)),
+        ('edge_n1', _pack('I', [index[id(e.n1)] for e in edges])),
+        ('edge_n2', _pack('I', [index[id(e.n2)] for e in edges])),
+        ('edge_types', _pack('I', [pool.add(e.type) for e in edges])),
+        ('comments', _pack('I', [pool.add(unicode(c)) for c in graph.comments])),
+        ]
+    node_keys, columns = _attribute_columns('na', nodes, pool)
+    sections.append(('node_keys', _pack('I', node_keys)))
+    sections.extend(columns)
+    edge_keys, columns = _attribute_columns('ea', edges, pool)
+    sections.append(('edge_keys', _pack('I', edge_keys)))
+    sections.extend(columns)
+
+    data = [s.encode('utf-8') for s in pool.strings]
+    string_offsets = [0]
+    for s in data:
+        string_offsets.append(string_offsets[-1] + len(s))
+    sections.append(('string_offsets', _pack('Q', string_offsets)))
+    sections.append(('string_data', ''.join(data)))
+    del data
+
+    with open(filename, 'wb') as f:
+        offset = _header.size + _section.size * len(sections)
+        f.write(_header.pack(_MAGIC, _VERSION, len(sections)))
+        for name, content in sections:
+            f.write(_section.pack(name, offset, len(content)))
+            offset += len(content)
+        for name, content in sections:
+            f.write(content)
+    logger.info("Wrote %i nodes and %i edges to %s." % (len(nodes), len(edges), filename))
+
+
+class _View(object):
+    __slots__ = ('graph', 'id')
+
+    def __init__(self, graph, id):
+        self.graph = graph
+        self.id = id
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and self.graph is other.graph
+                and self.id == other.id)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return unicode(self).encode('ASCII', 'backslashreplace')
+
+
+class BinaryNode(_View):
+    '''A node of a BinaryGraph, with the attributes of bmgraph.file.Node.
+    Read-only.'''
+    __slots__ = ()
+
+    name = property(lambda self: self.graph._string('node_names', self.id))
+    type = property(lambda self: self.graph._string('node_types', self.id))
+    special_node = property(lambda self: self.graph._item('node_flags', _u8, self.id) == 1)
+
+    @property
+    def edges(self):
+        return [BinaryEdge(self.graph, edge) for neighbour, edge
+                in self.graph._adjacency(self.id)]
+
+    @property
+    def attributes(self):
+        return self.graph._attributes('na', self.graph._node_keys, self.id)
+
+    def has_attributes(self):
+        return len(self.attributes) > 0
+
+    def __unicode__(self):
+        type = self.type
+        if type:
+            return u"%s_%s" % (type, self.name)
+        return self.name
+
+    def __repr__(self):
+        return "<BinaryNode %s>" % str(self)
+
+
+class BinaryEdge(_View):
+    '''An edge of a BinaryGraph, with the attributes of bmgraph.file.Edge.
+    Read-only.'''
+    __slots__ = ()
+
+    n1 = property(lambda self: BinaryNode(self.graph, self.graph._item('edge_n1', _u32, self.id)))
+    n2 = property(lambda self: BinaryNode(self.graph, self.graph._item('edge_n2', _u32, self.id)))
+    type = property(lambda self: self.graph._string('edge_types', self.id))
+
+    @property
+    def attributes(self):
+        return self.graph._attributes('ea', self.graph._edge_keys, self.id)
+
+    def other(self, node):
+        n1 = self.n1
+        if node == n1:
+            return self.n2
+        return n1
+
+    def __unicode__(self):
+        return u"%s %s %s %s" % (self.n1, self.n2, self.type, self.attributes)
+
+    def __repr__(self):
+        return "<BinaryEdge %s>" % str(self)
+
+
+class _NodeMap(UserDict.DictMixin):
+    '''Read-only mapping of node names to the BinaryNodes of a
+    BinaryGraph, found by binary search on the sorted names.'''
+    def __init__(self, graph):
+        self.graph = graph
+
+    def _find(self, name):
+        lo, hi = 0, self.graph.node_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.graph._string('node_names', mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.graph.node_count and self.graph._string('node_names', lo) == name:
+            return lo
+        return None
+
+    def __getitem__(self, name):
+        i = self._find(name)
+        if i is None:
+            raise KeyError(name)
+        return BinaryNode(self.graph, i)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __len__(self):
+        return self.graph.node_count
+
+    def __iter__(self):
+        for i in xrange(self.graph.node_count):
+            yield self.graph._string('node_names', i)
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self):
+        for i in xrange(self.graph.node_count):
+            yield BinaryNode(self.graph, i)
+
+    def iteritems(self):
+        for node in self.itervalues():
+            yield node.name, node
+
+
+class BinaryGraph(object):
+    '''A .bmgb file opened with mmap.  Like bmgraph.file.Graph, it has
+    nodes, a mapping of names to nodes, and comments, but the nodes and
+    their edges are read from the file when used and can't be changed.'''
+    def __init__(self, filename):
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = _header.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError("%s is not a binary BMGraph file." % filename)
+        if version != _VERSION:
+            raise ValueError("%s is version %i, only %i is supported." %
+                             (filename, version, _VERSION))
+        self._sections = {}
+        for i in range(count):
+            name, offset, length = _section.unpack_from(
+                self._map, _header.size + _section.size * i)
+            self._sections[name.rstrip('\0')] = (offset, length)
+        self.node_count = self._sections['node_names'][1] // _u32.size
+        self.edge_count = self._sections['edge_n1'][1] // _u32.size
+        self._node_keys = self._strings('node_keys')
+        self._edge_keys = self._strings('edge_keys')
+        self.nodes = _NodeMap(self)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    @property
+    def comments(self):
+        return self._strings('comments')
+
+    @property
+    def edges(self):
+        """All the edges, each once."""
+        return [BinaryEdge(self, i) for i in xrange(self.edge_count)]
+
+    def _item(self, section, format, i):
+        return format.unpack_from(self._map, self._sections[section][0] + format.size * i)[0]
+
+    def _string(self, section, i):
+        return self.string(self._item(section, _u32, i))
+
+    def _strings(self, section):
+        return [self._string(section, i)
+                for i in xrange(self._sections[section][1] // _u32.size)]
+
+    def string(self, i):
+        if i == _NONE:
+            return None
+        base = self._sections['string_data'][0]
+        start = self._item('string_offsets', _u64, i)
+        end = self._item('string_offsets', _u64, i + 1)
+        return self._map[base + start:base + end].decode('utf-8')
+
+    def _adjacency(self, node):
+        """Returns the (neighbour, edge) pairs of node."""
+        base = self._sections['adj_data'][0]
+        start = self._item('adj_offsets', _u64, node)
+        end = self._item('adj_offsets', _u64, node + 1)
+        numbers = []
+        value, shift = 0, 0
+        for c in bytearray(self._map[base + start:base + end]):
+            value |= (c & 0x7f) << shift
+            if c & 0x80:
+                shift += 7
+            else:
+                numbers.append(value)
+                value, shift = 0, 0
+        ret = []
+        neighbour = 0
+        for i in xrange(0, len(numbers), 2):
+            neighbour += numbers[i]
+            ret.append((neighbour, numbers[i + 1]))
+        return ret
+
+    def _attributes(self, prefix, keys, i):
+        ret = bmgraph_file.mdict()
+        for k, key in enumerate(keys):
+            column = '%s%i' % (prefix, k)
+            start = self._item(column + '.o', _u32, i)
+            end = self._item(column + '.o', _u32, i + 1)
+            for j in xrange(start, end):
+                ret[key] = self._string(column + '.v', j)
+        return ret
+
+
+def write_bmg(graph, stream):
+    """Writes graph, a BinaryGraph, to stream, which takes unicode, in the
+    BMGraph format of bmgraph.file.write_graph()."""
+    for node in graph.nodes.itervalues():
+        if node.special_node:
+            stream.write(u"%s\n" % unicode(node))
+
+    for comment in graph.comments:
+        stream.write(u"# %s\n" % comment)
+
+    for i in xrange(graph.edge_count):
+        stream.write(u"%s\n" % unicode(BinaryEdge(graph, i)))
+
+    for node in graph.nodes.itervalues():
+        attributes = node.attributes
+        if len(attributes) == 0:
+            continue
+        stream.write(u"# _attributes %s %s\n" % (unicode(node), unicode(attributes)))
+
+
+def bmg_to_bmgb(stream, filename):
+    """Reads the BMGraph file in stream and writes it to filename as a
+    .bmgb file."""
+    sink = bmgraph_file.GraphObjectSink(dedupe=False)
+    bmgraph_file.read_file_batched(stream, bmgraph_file.BatchSinkAdapter(sink))
+    write_bmgb(sink.get_object(), filename)
+
+
+def bmgb_to_bmg(filename, stream):
+    """Writes the .bmgb file filename to stream in the BMGraph format."""
+    graph = BinaryGraph(filename)
+    try:
+        write_bmg(graph, stream)
+    finally:
+        graph.close()
+
+
+def main(args):
+    if len(args) != 2:
+        print __doc__
+        return
+    logger.setLevel(logging.INFO)
+    if args[0].endswith('.bmgb'):
+        with bmgraph_file.open_file(args[1], 'w', encoding='utf-8') as f:
+            bmgb_to_bmg(args[0], f)
+    else:
+        with bmgraph_file.open_file(args[0]) as f:
+            bmg_to_bmgb(f, args[1])
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main(sys.argv[1:])
@@ -1,11 +1,36 @@
 # -*- coding: utf-8 -*-
+'''Connection subgraphs and neighbourhoods of query nodes.
+
+crawl() finds them in this process, on a graph database or an in-memory
+graph.  crawl_bmg() runs the external Biomine crawler on a BMGraph file.
+crawl_batch() runs either for many sets of query nodes in a process pool.
+'''
+
+from __future__ import with_statement
 
 import os
+import sys
+import math
+import time
+import heapq
+import shutil
+import codecs
+import sqlite3
+import tempfile
+import threading
+import StringIO
+import multiprocessing
+from collections import namedtuple
 from os import environ as env
 from os.path import join as path_join
 from subprocess import Popen, PIPE, STDOUT
 from time import sleep
 from optparse import OptionParser
+import logging
+logger = logging.getLogger("bmgraph.crawler")
+
+import db as bmgraph_db
+import file as bmgraph_file
 
 _crawler_params = {
     'maxdepth': None,
@@ -36,7 +61,13 @@ _crawler_params = {
     'boost_trivial_links': None,
     }
 
-def crawl_bmg(bmg_file, out_file, work_dir, query_nodes, params={}):
+class CrawlTimeout(Exception):
+    pass
+
+
+def crawl_bmg(bmg_file, out_file, work_dir, query_nodes, params={}, timeout=None):
+    """Runs the external crawler.  If it takes longer than timeout
+    seconds, it is killed and CrawlTimeout raised."""
     if not os.path.exists(work_dir):
         raise Exception("Work directory %s doesn't exist." % work_dir)
     elif len(query_nodes) == 0:
@@ -68,32 +99,508 @@ def crawl_bmg(bmg_file, out_file, work_dir, query_nodes, params={}):
 
     print >> log_file_handle, "# Executing: %s" % e
     p = Popen(e, bufsize=0, cwd=work_dir, stdin=PIPE, stderr=PIPE)
+    killed = []
+    timer = None
+    if timeout is not None:
+        def kill():
+            killed.append(True)
+            p.kill()
+        timer = threading.Timer(timeout, kill)
+        timer.start()
     stderr, stdout = p.communicate(" ".join(query_nodes))
+    if timer is not None:
+        timer.cancel()
     print >> log_file_handle, stderr
+    if killed:
+        print >> log_file_handle, "# Killed after %s s" % timeout
     log_file_handle.close()
+    if killed:
+        raise CrawlTimeout()
 
     result = p.poll()
     return result
 
 
+def edge_goodness(record):
+    """Returns the goodness of the EdgeRecord record, in (0, 1]: its
+    goodness attribute or, for other weights w like LLR, w / (1 + w).
+    None if it has no positive weight."""
+    g = record.attributes.get('goodness')
+    if g is None:
+        g = record.weight()
+        if g is None or g <= 0:
+            return None
+        return g / (1.0 + g)
+    if g <= 0:
+        return None
+    return min(g, 1.0)
+
+
+class DBNeighbours(object):
+    '''Edges of the nodes of a graph database built with bmgraph.db.'''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def edges(self, an):
+        return bmgraph_db.neighbourhood(self.connection, an)
+
+
+class GraphNeighbours(object):
+    '''Edges of the nodes of a bmgraph.file.Graph or a
+    bmgraph.binary.BinaryGraph, as EdgeRecords with the first value of each
+    attribute.'''
+    def __init__(self, graph):
+        self.graph = graph
+
+    def edges(self, an):
+        node = self.graph.nodes.get(an)
+        if node is None:
+            return []
+        ret = []
+        for e in node.edges:
+            attributes = {}
+            for k, values in e.attributes.iteritems():
+                value = bmgraph_db.real_value(k, values[0])
+                if value is None:
+                    value = values[0]
+                attributes[k] = value
+            ret.append(bmgraph_db.EdgeRecord(None, e.n1.name, e.n1.type, e.n2.name,
+                                             e.n2.type, e.type, attributes))
+        return ret
+
+
+def _neighbour_source(graph):
+    if isinstance(graph, sqlite3.Connection):
+        return DBNeighbours(graph)
+    if hasattr(graph, 'nodes'):
+        return GraphNeighbours(graph)
+    return graph
+
+
+class _Crawl(object):
+    def __init__(self, source, query_nodes, maxdepth, maxnodedegree, mingoodness,
+                 max_query_time, goodness):
+        self.source = source
+        self.query_nodes = query_nodes
+        self.maxdepth = maxdepth
+        self.maxnodedegree = maxnodedegree
+        self.mingoodness = mingoodness
+        self.goodness = goodness
+        self.deadline = None
+        if max_query_time is not None:
+            self.deadline = time.time() + max_query_time
+        # an -> [(neighbour, cost, record)], and the records by edge
+        self.neighbour_cache = {}
+        self.records = {}
+        self.types = {}
+
+    def stopped(self):
+        """True if the crawl was cut short by max_query_time."""
+        return self.deadline == 0
+
+    def expired(self):
+        if self.deadline is None:
+            return False
+        if self.deadline > 0 and time.time() > self.deadline:
+            logger.warning("Crawl stopped at max_query_time.")
+            self.deadline = 0
+        return self.deadline == 0
+
+    def neighbours(self, an):
+        """Returns the (neighbour, cost, record) of the edges of an
+        followed by the crawl, cost being -log(goodness).  Nodes of a
+        degree over maxnodedegree, other than query nodes, aren't
+        expanded."""
+        ret = self.neighbour_cache.get(an)
+        if ret is not None:
+            return ret
+        records = self.source.edges(an)
+        ret = []
+        for r in records:
+            self.types[r.n1] = r.n1_type
+            self.types[r.n2] = r.n2_type
+        if (self.maxnodedegree is None or len(records) <= self.maxnodedegree
+            or an in self.query_nodes):
+            for r in records:
+                other = r.other(an)
+                g = self.goodness(r)
+                if other == an or g is None:
+                    continue
+                if self.mingoodness is not None and g < self.mingoodness:
+                    continue
+                self.records[(r.n1, r.n2, r.type)] = r
+                ret.append((other, -math.log(g), r))
+        self.neighbour_cache[an] = ret
+        return ret
+
+    def best_paths(self, sources, max_visits=None, targets=()):
+        """Finds the best paths from sources, of the lowest sum of
+        -log(goodness), at most maxdepth edges long.  Returns (reached,
+        labels): reached maps each node reached to the (cost, hops) of its
+        best path, and labels maps (an, hops) to the (cost, parent, record)
+        of the best path of that many edges, parent being the (an, hops) of
+        the node before it; see _path().  With maxdepth a node is settled
+        again when a costlier path reaches it in fewer edges, so that the
+        nodes behind it stay within reach.  Stops after max_visits nodes,
+        when all of targets are reached or at the deadline."""
+        reached = {}
+        labels = {}
+        # an -> the fewest edges of the paths to an settled so far
+        fewest_hops = {}
+        targets = set(targets)
+        stop_at_targets = len(targets) > 0
+        # Without maxdepth all paths count as 0 edges, so each node is
+        # settled once
+        step = 0
+        if self.maxdepth is not None:
+            step = 1
+        heap = [(0.0, 0, an, None, None) for an in sources]
+        heapq.heapify(heap)
+        while heap and not self.expired():
+            cost, hops, an, parent, record = heapq.heappop(heap)
+            if fewest_hops.get(an, hops + 1) <= hops:
+                continue
+            fewest_hops[an] = hops
+            labels[(an, hops)] = (cost, parent, record)
+            if an not in reached:
+                reached[an] = (cost, hops)
+                targets.discard(an)
+                if len(reached) == max_visits or (stop_at_targets and not targets):
+                    break
+            if step and hops >= self.maxdepth:
+                continue
+            for other, edge_cost, r in self.neighbours(an):
+                if fewest_hops.get(other, hops + step + 1) > hops + step:
+                    heapq.heappush(heap, (cost + edge_cost, hops + step, other,
+                                          (an, hops), r))
+        return reached, labels
+
+    def subgraph(self, nodes):
+        """Returns the edges found between nodes as a Graph, the query
+        nodes marked special."""
+        sink = bmgraph_file.GraphObjectSink()
+        for key, r in sorted(self.records.iteritems()):
+            if r.n1 in nodes and r.n2 in nodes:
+                sink.edge_read(r.n1, r.n1_type, r.n2, r.n2_type, r.type,
+                               dict((k, unicode(v)) for k, v in r.attributes.iteritems()))
+        for an in sorted(self.query_nodes):
+            if an in self.types:
+                sink.special_node_read(an, self.types[an])
+            else:
+                logger.warning("Query node %s has no edges." % an)
+        return sink.get_object()
+
+
+def _path(labels, label):
+    """Returns the nodes and the EdgeRecords of the path to label, an
+    (an, hops) key of labels of _Crawl.best_paths()."""
+    nodes = []
+    records = []
+    while label is not None:
+        cost, parent, record = labels[label]
+        nodes.append(label[0])
+        if record is not None:
+            records.append(record)
+        label = parent
+    return nodes, records
+
+
+def crawl(graph, query_nodes, mode='connection_subgraph', maxdepth=None,
+          maxnodedegree=None, mingoodness=None, max_nodes=None,
+          max_query_time=_crawler_params['max_query_time'], goodness=edge_goodness):
+    """Returns the subgraph of graph around the accession numbers
+    query_nodes as a bmgraph.file.Graph, the query nodes marked special.
+    graph is a connection to a bmgraph.db database, a bmgraph.file.Graph
+    or bmgraph.binary.BinaryGraph, or has edges(an) returning EdgeRecords.
+
+    The goodness of a path is the product of the goodness(record) of its
+    edges, see edge_goodness(); best paths are found with Dijkstra's
+    algorithm over -log(goodness).  In mode 'neighborhood' the subgraph
+    has the max_nodes nodes of the best paths from any query node.  In mode
+    'connection_subgraph' it has the best paths between pairs of query
+    nodes, the best first, while they fit in max_nodes nodes.  Either way
+    it has the edges found between its nodes.
+
+    Paths are at most maxdepth edges long and follow edges at least
+    mingoodness good, and nodes of more than maxnodedegree edges are not
+    passed through.  After max_query_time seconds the crawl stops and
+    returns what it has found.  The other _crawler_params of the external
+    crawler are not supported."""
+    return _crawl(graph, query_nodes, mode, maxdepth, maxnodedegree, mingoodness,
+                  max_nodes, max_query_time, goodness)[0]
+
+
+def _crawl(graph, query_nodes, mode='connection_subgraph', maxdepth=None,
+           maxnodedegree=None, mingoodness=None, max_nodes=None,
+           max_query_time=_crawler_params['max_query_time'], goodness=edge_goodness):
+    """Does crawl(), returning the subgraph and the _Crawl."""
+    if mode not in ('neighborhood', 'connection_subgraph'):
+        raise ValueError("Unknown crawl mode %s." % mode)
+    if len(query_nodes) == 0:
+        raise ValueError("No query nodes defined.")
+    state = _Crawl(_neighbour_source(graph), set(query_nodes), maxdepth,
+                   maxnodedegree, mingoodness, max_query_time, goodness)
+    # Their edges give the types of the query nodes
+    for an in query_nodes:
+        state.neighbours(an)
+
+    if mode == 'neighborhood':
+        reached, labels = state.best_paths(query_nodes, max_visits=max_nodes)
+        return state.subgraph(set(reached)), state
+
+    paths = []
+    for i, source in enumerate(query_nodes[:-1]):
+        targets = query_nodes[i + 1:]
+        reached, labels = state.best_paths([source], targets=targets)
+        for target in targets:
+            if target in reached:
+                cost, hops = reached[target]
+                paths.append((cost, _path(labels, (target, hops))[0]))
+    paths.sort()
+    nodes = set(query_nodes)
+    for cost, path in paths:
+        new = set(path) - nodes
+        if max_nodes is not None and len(nodes) + len(new) > max_nodes:
+            continue
+        nodes.update(new)
+    return state.subgraph(nodes), state
+
+
+# Result of a job of crawl_batch(): index is the position of query_nodes
+# in the batch, status 'ok', 'timeout' or 'failed', graph the BMGraph text
+# of the result and log that of the crawl.
+CrawlResult = namedtuple('CrawlResult', 'index query_nodes status graph log seconds')
+
+# Parameters of crawl() that crawl_batch() passes on
+_native_params = ('mode', 'maxdepth', 'maxnodedegree', 'mingoodness', 'max_nodes',
+                  'max_query_time')
+
+# Seconds a job may take on top of twice its max_query_time, for starting
+# the external crawler and reading its graph
+_startup_time = 60
+
+# Seconds after its deadline that a native crawl still running a statement
+# is interrupted
+_interrupt_delay = 5
+
+
+def job_timeout(params):
+    """Returns the seconds after which a crawl_batch() job with params is
+    stopped."""
+    max_query_time = params.get('max_query_time', _crawler_params['max_query_time'])
+    return 2 * max_query_time + _startup_time
+
+
+def read_query_sets(stream):
+    """Returns the sets of query nodes in stream, which gives unicode, one
+    set per line, the nodes separated by whitespace.  Empty lines and
+    lines starting with # are skipped."""
+    ret = []
+    for line in stream:
+        line = line.strip()
+        if line and not line.startswith(u'#'):
+            ret.append(line.split())
+    return ret
+
+
+_worker_connection = None
+
+def _init_native_worker(path, immutable):
+    global _worker_connection
+    _worker_connection = bmgraph_db.open_readonly(path, immutable=immutable)
+
+
+def _native_job(job):
+    index, query_nodes, params, timeout = job
+    params = dict(params)
+    params['max_query_time'] = min(timeout, params.get('max_query_time',
+                                                       _crawler_params['max_query_time']))
+    log = StringIO.StringIO()
+    handler = logging.StreamHandler(log)
+    logger.addHandler(handler)
+    # The crawl stops itself at max_query_time; interrupting the connection
+    # is for a statement that doesn't return by then
+    timed_out = []
+    def interrupt():
+        timed_out.append(True)
+        _worker_connection.interrupt()
+    timer = threading.Timer(params['max_query_time'] + _interrupt_delay, interrupt)
+    start = time.time()
+    timer.start()
+    graph, status = None, 'ok'
+    try:
+        subgraph, state = _crawl(_worker_connection, query_nodes, **params)
+        out = StringIO.StringIO()
+        bmgraph_file.write_graph(subgraph, out)
+        graph = out.getvalue()
+        if state.stopped():
+            status = 'timeout'
+    except Exception, e:
+        status = 'failed'
+        if timed_out:
+            status = 'timeout'
+        logger.warning("Crawl %i failed: %s" % (index, e))
+    finally:
+        timer.cancel()
+        logger.removeHandler(handler)
+    return CrawlResult(index, query_nodes, status, graph, log.getvalue(),
+                       time.time() - start)
+
+
+def _read_text(path):
+    if not os.path.exists(path):
+        return None
+    with codecs.open(path, encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+def _external_job(job):
+    index, query_nodes, params, timeout, bmg_file = job
+    work_dir = tempfile.mkdtemp(prefix='bmgcrawl')
+    start = time.time()
+    graph, status = None, 'ok'
+    try:
+        out_file = os.path.join(work_dir, 'out.bmg')
+        try:
+            if crawl_bmg(bmg_file, out_file, work_dir,
+                         [an.encode('utf-8') for an in query_nodes],
+                         dict(params), timeout) != 0:
+                status = 'failed'
+            graph = _read_text(out_file)
+        except CrawlTimeout:
+            status = 'timeout'
+        except Exception, e:
+            status = 'failed'
+            logger.warning("Crawl %i failed: %s" % (index, e))
+        log = _read_text(os.path.join(work_dir, 'log.txt'))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return CrawlResult(index, query_nodes, status, graph, log, time.time() - start)
+
+
+def crawl_batch(graph, query_sets, params={}, processes=None, external=False,
+                timeout=None, immutable=False):
+    """Crawls each list of query nodes in query_sets in a pool of
+    processes, by default one per core.  Returns an iterator of a
+    CrawlResult for each, as soon as it is done, in the order they finish.
+
+    graph is the path of a graph database, crawled with crawl(), each
+    process having a read-only connection to it, opened with
+    open_readonly(graph, immutable=immutable).  With external it is a
+    BMGraph file for the external crawler, each job run with crawl_bmg()
+    in a temporary work directory of its own, deleted afterwards.  params
+    are the parameters of the crawls; crawl() supports those in
+    _native_params.  Jobs taking more than timeout seconds, by default
+    job_timeout(params), are stopped with status 'timeout'.  A crawl()
+    stops by itself after the lesser of timeout and its max_query_time,
+    and its result keeps what was found, also with status 'timeout'."""
+    if timeout is None:
+        timeout = job_timeout(params)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if external:
+        bmg_file = os.path.abspath(graph)
+        jobs = [(i, nodes, params, timeout, bmg_file) for i, nodes in enumerate(query_sets)]
+        pool = multiprocessing.Pool(processes)
+        f = _external_job
+    else:
+        unsupported = [k for k in params if k not in _native_params]
+        if unsupported:
+            raise ValueError("Parameters %s are only supported by the external crawler." %
+                             ", ".join(sorted(unsupported)))
+        jobs = [(i, nodes, params, timeout) for i, nodes in enumerate(query_sets)]
+        pool = multiprocessing.Pool(processes, _init_native_worker, (graph, immutable))
+        f = _native_job
+    return _results(pool, f, jobs)
+
+
+def _results(pool, f, jobs):
+    try:
+        for result in pool.imap_unordered(f, jobs):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def crawl_batch_files(graph, query_file, out_dir, **kwargs):
+    """Runs crawl_batch() on the query sets in query_file, writing the
+    graph and the log of the i'th set to out_dir/i.bmg and out_dir/i.log as
+    each finishes, and a line about it to stdout."""
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with bmgraph_file.open_file(query_file, encoding='utf-8') as f:
+        query_sets = read_query_sets(f)
+    for result in crawl_batch(graph, query_sets, **kwargs):
+        for extension, text in (('bmg', result.graph), ('log', result.log)):
+            if text is not None:
+                path = os.path.join(out_dir, '%i.%s' % (result.index, extension))
+                with codecs.open(path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+        print "%i\t%s\t%.1f s\t%s" % (result.index, result.status, result.seconds,
+                                      u" ".join(result.query_nodes).encode('utf-8'))
+        sys.stdout.flush()
+
+
+def _batch_params(opts):
+    params = {}
+    if opts.db:
+        params['mode'] = opts.mode
+    if opts.max_nodes is not None:
+        params['max_nodes'] = opts.max_nodes
+    return params
+
+
 def main():
     parser = OptionParser(usage='Reads query nodes from stdin and outputs to stdout.')
     parser.add_option("-b", "--bmg", dest="bmg",
                       help="BMGraph file to Crawl",
                       metavar="BMGRAPH-FILE")
+    parser.add_option("-d", "--database", dest="db",
+                      help="graph database to crawl in this process instead of a BMGraph file",
+                      metavar="DATABASE-FILE")
     parser.add_option("-o", "--output-bmg", dest="out_bmg",
                       help="BMGraph file to Crawl to",
                       metavar="BMGRAPH-FILE")
     parser.add_option("-q", "--query-nodes", dest="query_nodes",
                       help="Query nodes")
+    parser.add_option("-m", "--mode", dest="mode", default="connection_subgraph",
+                      help="crawl a database in MODE [connection_subgraph|neighborhood]",
+                      metavar="MODE")
+    parser.add_option("-n", "--max-nodes", dest="max_nodes", type="int", default=None,
+                      help="crawl a database to at most N nodes", metavar="N")
+    parser.add_option("--batch", dest="batch",
+                      help="crawl the query node sets in QUERY-FILE, one per line, "
+                      "writing the results to the directory given with -o",
+                      metavar="QUERY-FILE")
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=0,
+                      help="run a batch in N processes, 0 for one per core",
+                      metavar="N")
     opts, args = parser.parse_args()
-    if not opts.bmg:
-        parser.error("BMGraph file required!")
-    elif not opts.query_nodes:
+    if not opts.bmg and not opts.db:
+        parser.error("BMGraph file or database required!")
+    elif not opts.query_nodes and not opts.batch:
         parser.error("Query nodes required!")
     elif not opts.out_bmg:
         parser.error("BMGraph output file required!")
 
+    if opts.batch:
+        crawl_batch_files(opts.db or opts.bmg, opts.batch, opts.out_bmg,
+                          processes=opts.processes or None, external=not opts.db,
+                          params=_batch_params(opts))
+        return
+
+    if opts.db:
+        graph = crawl(bmgraph_db.open_readonly(opts.db),
+                      opts.query_nodes.decode('utf-8').split(" "),
+                      opts.mode, max_nodes=opts.max_nodes)
+        with bmgraph_file.open_file(opts.out_bmg, 'w', encoding='utf-8') as f:
+            bmgraph_file.write_graph(graph, f)
+        return
+
     prefs = {}
     crawl_bmg(opts.bmg, opts.out_bmg, os.getcwd(),
               opts.query_nodes.split(" "))
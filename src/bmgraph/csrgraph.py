@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''In-memory graph in compressed sparse row (CSR) form, loaded from a graph
+database built with bmgraph.db.
+
+The neighbours of node i are neighbours[offsets[i]:offsets[i+1]], ordered by
+weight, highest first, so the top-k neighbours of a node are a slice.
+'''
+
+import logging
+logger = logging.getLogger("bmgraph.csrgraph")
+
+import time
+from array import array
+import numpy
+
+import db as bmgraph_db
+
+_no_weight = float('-inf')
+
+
+class CSRGraph(object):
+    def __init__(self, names, types, offsets, neighbours, weights):
+        self.names = names
+        self.types = types
+        self.offsets = offsets
+        self.neighbours = neighbours
+        self.weights = weights
+        self.index = dict((name, i) for i, name in enumerate(names))
+
+    @classmethod
+    def from_db(cls, connection):
+        """Loads the whole graph of a bmgraph.db database.  Uses the
+        adjacency table when the database has one."""
+        start = time.time()
+        c = connection.cursor()
+
+        c.execute('SELECT id, an, type FROM node ORDER BY id;')
+        rows = c.fetchall()
+        ids = numpy.fromiter((row[0] for row in rows), numpy.int64, len(rows))
+        names = numpy.array([row[1] for row in rows], dtype=object)
+        types = numpy.array([row[2] for row in rows], dtype=object)
+        del rows
+        c.close()
+
+        sources = array('l')
+        targets = array('l')
+        weights = array('f')
+        for source, weight, target, edge_id in bmgraph_db.directed_edges(connection):
+            sources.append(source)
+            targets.append(target)
+            # Edges without a weight sort last
+            if weight is None:
+                weight = _no_weight
+            weights.append(weight)
+
+        sources = numpy.searchsorted(ids, numpy.frombuffer(sources, dtype=numpy.int_))
+        targets = numpy.searchsorted(ids, numpy.frombuffer(targets, dtype=numpy.int_))
+        weights = numpy.frombuffer(weights, dtype=numpy.float32)
+
+        order = numpy.lexsort((-weights, sources))
+        neighbours = targets[order].astype(numpy.int32)
+        weights = weights[order]
+        offsets = numpy.zeros(len(ids) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(sources, minlength=len(ids)), out=offsets[1:])
+
+        graph = cls(names, types, offsets, neighbours, weights)
+        logger.info("Loaded %i nodes and %i adjacencies in %.2f s." %
+                    (len(names), len(neighbours), time.time() - start))
+        return graph
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, an):
+        return an in self.index
+
+    def degree(self, an):
+        i = self.index[an]
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def neighbours_of(self, an, k=None):
+        """Returns (an, weight) pairs of the neighbours of an, highest
+        weight first; at most k of them if k is given.  Returns None if
+        an is not in the graph."""
+        i = self.index.get(an)
+        if i is None:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if k is not None:
+            end = min(end, start + k)
+        ret = []
+        for j, weight in zip(self.neighbours[start:end], self.weights[start:end]):
+            if weight == _no_weight:
+                weight = None
+            else:
+                weight = float(weight)
+            ret.append((self.names[j], weight))
+        return ret
+
+    def hop_neighbours_of(self, an, hops, max_nodes, min_weight=None):
+        """Returns (an, hop, weight) triples of at most max_nodes nodes at
+        most hops edges away from an, nearest first and heaviest first
+        within a hop, like bmgraph.db.hop_neighbourhood().  Returns None if
+        an is not in the graph."""
+        i = self.index.get(an)
+        if i is None:
+            return None
+        seen = set([i])
+        frontier = [i]
+        ret = []
+        for hop in range(1, hops + 1):
+            reached = {}
+            for f in frontier:
+                start, end = self.offsets[f], self.offsets[f + 1]
+                for j, weight in zip(self.neighbours[start:end], self.weights[start:end]):
+                    if min_weight is not None and weight < min_weight:
+                        break
+                    if j not in seen and (j not in reached or weight > reached[j]):
+                        reached[j] = weight
+            frontier = sorted(reached, key=reached.get, reverse=True)[:max_nodes - len(ret)]
+            for j in frontier:
+                seen.add(j)
+                weight = reached[j]
+                if weight == _no_weight:
+                    weight = None
+                else:
+                    weight = float(weight)
+                ret.append((self.names[j], hop, weight))
+            if len(ret) >= max_nodes or len(frontier) == 0:
+                break
+        return ret
+
+
+_graphs = {}
+
+def load(path):
+    """Returns the CSRGraph of the database at path, loading it on first
+    use.  Graphs stay in memory for the lifetime of the process."""
+    graph = _graphs.get(path)
+    if graph is None:
+        graph = CSRGraph.from_db(bmgraph_db.pooled_connection(path))
+        _graphs[path] = graph
+    return graph
@@ -2,6 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import os
+import time
+import random
+import threading
+import urllib
+import weakref
 import logging
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger("bmgraph.db")
@@ -11,6 +17,8 @@ from optparse import OptionParser
 from pprint import pprint
 import UserDict
 import codecs
+from collections import namedtuple
+from array import array
 
 import sqlite3
 
@@ -22,6 +30,13 @@ _utf8_out = codecs.getwriter('utf-8')(sys.stdout)
 def levenshtein(a, b):
     a = a.lower()
     b = b.lower()
+    # Common prefixes and suffixes don't change the distance
+    i = 0
+    while i < len(a) and i < len(b) and a[i] == b[i]:
+        i += 1
+    a, b = a[i:], b[i:]
+    while len(a) > 0 and len(b) > 0 and a[-1] == b[-1]:
+        a, b = a[:-1], b[:-1]
     n, m = len(a), len(b)
     if n > m:
         a, b = b, a
@@ -43,52 +58,266 @@ def levenshtein(a, b):
 class NotImplemented(Exception):
     pass
 
-class NodeAttributeProxyDict(bmgraph_file.mdict, UserDict.DictMixin):
-    def __init__(self, node_id, connection):
-        self._node_id = node_id
-        self._connection = connection
-        self._populated = False
 
-    # __getitem__(), __setitem__(), __delitem__(), and keys()
-    def __getitem__(self, key):
-        self.populate()
-        return self[name]
+# Edge attributes holding the edge weight, in order of preference.
+WEIGHT_ATTRIBUTES = ('goodness', 'llr')
 
-    def __setitem__(self, key, value):
-        self.setdefault(key, []).append(value)
+# Attributes that are also stored as numbers in the real_value column.
+NUMERIC_ATTRIBUTES = WEIGHT_ATTRIBUTES + ('rarity', 'relevance', 'reliability')
 
-    def __delitem__(self, key):
-        raise NotImplemented()
+# Version of the schema created by create_db(), kept in PRAGMA user_version.
+# 1: real_value columns for NUMERIC_ATTRIBUTES
+# 2: edges unique by (n1_id, n2_id, type)
+SCHEMA_VERSION = 2
 
-    def keys(self):
-        self.populate()
-        return dict.keys(self)
 
-    def populate(self):
-        if self._populated is True:
-            return
-        c = self._connection.cursor()
-        q = ('SELECT * FROM node_attribute WHERE node_id=?;', (self._node_id,))
-        c.execute(*q)
-        for row in c:
-            if row['text_value'] != None:
-                self[row['name']] = row['text_value']
-            elif row['bool_value'] != None:
-                self[row['name']] = row['bool_value']
-        self._populated = True
+class EdgeRecord(namedtuple('EdgeRecord',
+                            'id n1 n1_type n2 n2_type type attributes')):
+    """Plain edge record returned by neighbourhood().  n1 and n2 are the
+    accession numbers of the endpoints and attributes is a dict of the edge
+    attribute values; NUMERIC_ATTRIBUTES are floats."""
+    __slots__ = ()
+
+    def other(self, an):
+        if self.n1 == an:
+            return self.n2
+        return self.n1
+
+    def weight(self):
+        for name in WEIGHT_ATTRIBUTES:
+            if name in self.attributes:
+                return self.attributes[name]
+        return None
+
+
+# Neighbour record returned by top_neighbours(); weight is a float or None.
+Neighbour = namedtuple('Neighbour', 'an type weight edge_id')
+
+# Record returned by hop_neighbourhood(); hop is the distance in edges.
+HopNeighbour = namedtuple('HopNeighbour', 'an type hop weight')
+
+
+class GraphConnection(sqlite3.Connection):
+    """sqlite3 connection with an identity map of the Nodes and Edges made
+    for it, so that the same id gives the same object while it is in use.
+    Pass as the factory argument of sqlite3.connect()."""
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.node_map = weakref.WeakValueDictionary()
+        self.edge_map = weakref.WeakValueDictionary()
+        self.real_value_column = False
+
+
+def _node_map(connection):
+    return getattr(connection, 'node_map', None)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.time()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            self.connection.stats.record(sql, parameters, time.time() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        start = time.time()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        finally:
+            self.connection.stats.record(sql, seq_of_parameters[0] if seq_of_parameters else (),
+                                         time.time() - start, len(seq_of_parameters))
+
+
+class InstrumentedConnection(GraphConnection):
+    """GraphConnection that counts and times every statement, grouped by
+    the logical call (edges(), sample(), a sink's edge_read(), ...) that
+    issued it.  See query_stats() and log_query_stats()."""
+    def __init__(self, *args, **kwargs):
+        GraphConnection.__init__(self, *args, **kwargs)
+        self.stats = QueryStats()
+
+    def cursor(self, factory=InstrumentedCursor):
+        return GraphConnection.cursor(self, factory)
+
+
+class QueryStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # name -> [calls, seconds]
+        self.calls = {}
+        # (name, sql) -> [executions, seconds, parameters of the first one]
+        self.statements = {}
+        self._stack = []
+
+    def enter(self, name):
+        self._stack.append(name)
+
+    def leave(self, name, seconds):
+        self._stack.pop()
+        totals = self.calls.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+    def record(self, sql, parameters, seconds, executions=1):
+        if self._stack:
+            name = self._stack[-1]
+        else:
+            name = None
+        totals = self.statements.setdefault((name, sql), [0, 0.0, parameters])
+        totals[0] += executions
+        totals[1] += seconds
+
+
+def _instrumented(f):
+    """Makes f, a function taking a connection or a method of an object
+    with a connection, a logical call of InstrumentedConnection stats."""
+    def wrapper(*args, **kwargs):
+        if isinstance(args[0], sqlite3.Connection):
+            connection = args[0]
+            name = f.__name__
+        else:
+            connection = getattr(args[0], 'connection', None)
+            name = '%s.%s' % (type(args[0]).__name__, f.__name__)
+        stats = getattr(connection, 'stats', None)
+        if stats is None:
+            return f(*args, **kwargs)
+        stats.enter(name)
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            stats.leave(name, time.time() - start)
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+
+
+_explained_statements = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+def query_plan(connection, sql, parameters=()):
+    """Returns the detail lines of EXPLAIN QUERY PLAN for sql, or None for
+    statements that have no plan."""
+    words = sql.split(None, 1)
+    if len(words) < 1 or words[0].upper() not in _explained_statements:
+        return None
+    # Not connection.cursor(), which would count the EXPLAIN itself
+    c = sqlite3.Cursor(connection)
+    try:
+        c.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+        return [row[3] for row in c]
+    except sqlite3.Error, e:
+        logger.warning("Cannot explain %s: %s" % (sql, e))
+        return None
+    finally:
         c.close()
 
 
-class EdgeAttributeProxyDict(bmgraph_file.mdict, UserDict.DictMixin):
-    def __init__(self, edge_id, connection):
-        self._edge_id = edge_id
+def full_scans(plan):
+    """Returns the tables that plan, as returned by query_plan(), reads
+    whole without an index.  SQLite's own tables are left out."""
+    ret = []
+    for detail in plan or []:
+        if not detail.startswith('SCAN ') or ' USING ' in detail:
+            continue
+        # Virtual tables list the constraints they use after the colon,
+        # e.g. L0 for the LIKE of node_fts
+        if ' VIRTUAL TABLE ' in detail and not detail.endswith(':'):
+            continue
+        # SQLite before 3.36 says SCAN TABLE edge where later ones say
+        # SCAN edge
+        table = detail[5:]
+        if table.startswith('TABLE '):
+            table = table[6:]
+        table = table.split(' ')[0]
+        if table != 'CONSTANT' and not table.startswith('sqlite_'):
+            ret.append(table)
+    return ret
+
+
+def query_stats(connection, plans=True):
+    """Returns the statistics of an InstrumentedConnection as a dict from
+    logical call name, None for statements outside one, to a dict of
+    calls, seconds, statements, statement_seconds, statements_per_call,
+    full_scans and queries, the last a list of dicts of sql, executions,
+    seconds and full_scans, slowest first.  With plans=True the statements
+    are explained to find full table scans.  For in-memory databases the
+    explaining is done on connection, which with the Python 2 sqlite3
+    module commits an open transaction; file databases are explained on a
+    separate read-only connection."""
+    stats = connection.stats
+    statements = stats.statements.items()
+    explain = None
+    if plans:
+        path = database_path(connection)
+        if path:
+            explain = open_readonly(path)
+        else:
+            explain = connection
+
+    ret = {}
+    for (name, sql), (executions, seconds, parameters) in statements:
+        call = ret.get(name)
+        if call is None:
+            calls, call_seconds = stats.calls.get(name, (0, 0.0))
+            call = {'calls': calls, 'seconds': call_seconds, 'statements': 0,
+                    'statement_seconds': 0.0, 'full_scans': set(), 'queries': []}
+            ret[name] = call
+        scans = []
+        if explain is not None:
+            scans = full_scans(query_plan(explain, sql, parameters))
+        call['statements'] += executions
+        call['statement_seconds'] += seconds
+        call['full_scans'].update(scans)
+        call['queries'].append({'sql': sql, 'executions': executions,
+                                'seconds': seconds, 'full_scans': scans})
+    if explain is not None and explain is not connection:
+        explain.close()
+
+    for call in ret.itervalues():
+        call['statements_per_call'] = call['statements'] / float(max(call['calls'], 1))
+        call['full_scans'] = sorted(call['full_scans'])
+        call['queries'].sort(key=lambda q: q['seconds'], reverse=True)
+    return ret
+
+
+def log_query_stats(connection, plans=True, level=logging.INFO):
+    """Logs query_stats(connection), a line per logical call and a line per
+    statement that scans whole tables."""
+    for name, call in sorted(query_stats(connection, plans).iteritems()):
+        logger.log(level, "%s: %i calls, %.3f s, %i statements (%.1f per call, %.3f s)%s" %
+                   (name or "<no call>", call['calls'], call['seconds'], call['statements'],
+                    call['statements_per_call'], call['statement_seconds'],
+                    call['full_scans'] and ", full scans of " + ", ".join(call['full_scans']) or ""))
+        for query in call['queries']:
+            if query['full_scans']:
+                logger.log(level, "  %i x %.3f s scanning %s: %s" %
+                           (query['executions'], query['seconds'],
+                            ", ".join(query['full_scans']), " ".join(query['sql'].split())))
+
+
+def reset_query_stats(connection):
+    connection.stats.reset()
+
+
+class _AttributeProxyDict(bmgraph_file.mdict, UserDict.DictMixin):
+    """Attributes of a node or an edge, loaded from table on first use or
+    in bulk by prefetch()."""
+    table = None
+    key = None
+
+    def __init__(self, owner_id, connection):
+        self._owner_id = owner_id
         self._connection = connection
         self._populated = False
 
     # __getitem__(), __setitem__(), __delitem__(), and keys()
     def __getitem__(self, key):
         self.populate()
-        return self[name]
+        return dict.__getitem__(self, key)
 
     def __setitem__(self, key, value):
         self.setdefault(key, []).append(value)
@@ -100,42 +329,76 @@ class EdgeAttributeProxyDict(bmgraph_file.mdict, UserDict.DictMixin):
         self.populate()
         return dict.keys(self)
 
+    def items(self):
+        self.populate()
+        return dict.items(self)
+
+    def iteritems(self):
+        self.populate()
+        return dict.iteritems(self)
+
+    def _add(self, name, text_value, bool_value):
+        if text_value != None:
+            self[name] = text_value
+        elif bool_value != None:
+            self[name] = bool_value
+
     def populate(self):
         if self._populated is True:
             return
         c = self._connection.cursor()
-        q = ('SELECT * FROM edge_attribute WHERE edge_id=?;', (self._edge_id,))
+        q = ('SELECT name, text_value, bool_value FROM %s WHERE %s=?;' % (self.table, self.key),
+             (self._owner_id,))
         c.execute(*q)
         for row in c:
-            if row['text_value'] != None:
-                self[row['name']] = row['text_value']
-            elif row['bool_value'] != None:
-                self[row['name']] = row['bool_value']
+            self._add(*row)
         self._populated = True
         c.close()
 
 
+class NodeAttributeProxyDict(_AttributeProxyDict):
+    table = 'node_attribute'
+    key = 'node_id'
+
+
+class EdgeAttributeProxyDict(_AttributeProxyDict):
+    table = 'edge_attribute'
+    key = 'edge_id'
+
+
+_unloaded = object()
+
 class Node(object):
-    def __init__(self, id, connection):
+    __slots__ = ('id', 'connection', '_an', '_type', 'attributes', '__weakref__')
+
+    def __init__(self, id, connection, an=_unloaded, type=_unloaded):
         self.id = id
         self.connection = connection
-        self._populated = False
+        self._an = an
+        self._type = type
         self.attributes = NodeAttributeProxyDict(id, connection)
 
-    def __getattribute__(self, name):
-        if (name == 'an' or name == 'type') and self._populated == False:
-            c = self.connection.cursor()
-            q = ('SELECT an, type FROM node WHERE id=?;', (self.id,))
-            c.execute(*q)
-            self._an, self._type = c.fetchone()
-        if name == 'type':
-            return self._type
-        if name == 'an':
-            return self._an
-        return object.__getattribute__(self, name)
+    def _load(self):
+        c = self.connection.cursor()
+        q = ('SELECT an, type FROM node WHERE id=?;', (self.id,))
+        c.execute(*q)
+        self._an, self._type = c.fetchone()
+        c.close()
+
+    @property
+    def an(self):
+        if self._an is _unloaded:
+            self._load()
+        return self._an
+
+    @property
+    def type(self):
+        if self._type is _unloaded:
+            self._load()
+        return self._type
 
     def __repr__(self):
-        return "<Node #%i %s>" % (self.id, self.__repr__())
+        return "<Node #%i %s>" % (self.id, str(self.typed_name()))
 
     def __str__(self):
         return unicode(self).encode('ASCII', 'backslashreplace')
@@ -159,18 +422,37 @@ class Node(object):
         return self.id
 
 
+def get_node(connection, id, node_map=None):
+    """Returns the Node with id.  The node is looked up from and added to
+    node_map, by default the identity map of a GraphConnection."""
+    if node_map is None:
+        node_map = _node_map(connection)
+        if node_map is None:
+            return Node(id, connection)
+    node = node_map.get(id)
+    if node is None:
+        node = Node(id, connection)
+        node_map[id] = node
+    return node
+
+
 class Edge(object):
-    def __init__(self, id, n1_id, n2_id, type, connection):
+    __slots__ = ('_id', 'n1', 'n2', 'type', '_connection', 'attributes', '__weakref__')
+
+    def __init__(self, id, n1_id, n2_id, type, connection, node_map=None):
         self._id = id
-        self.n1 = Node(n1_id, connection)
-        self.n2 = Node(n2_id, connection)
+        self.n1 = get_node(connection, n1_id, node_map)
+        self.n2 = get_node(connection, n2_id, node_map)
         self.type = type
         self._connection = connection
-        self._populated = False
         self.attributes = EdgeAttributeProxyDict(id, connection)
 
+    @property
+    def id(self):
+        return self._id
+
     def __repr__(self):
-        return "<Edge #%i %s>" % (self.id, self.__repr__())
+        return "<Edge #%i %s>" % (self.id, str(self))
 
     def __str__(self):
         return unicode(self).encode('ASCII', 'backslashreplace')
@@ -187,56 +469,369 @@ class Edge(object):
             if self._id == other._id:
                 return True
         return False
+    def __hash__(self):
+        return self._id
+
+
+def get_edge(connection, id, n1_id, n2_id, type, node_map=None):
+    """Returns the Edge with id, using the identity map of a
+    GraphConnection if connection is one."""
+    edge_map = getattr(connection, 'edge_map', None)
+    if edge_map is not None and id in edge_map:
+        return edge_map[id]
+    edge = Edge(id, n1_id, n2_id, type, connection, node_map)
+    if edge_map is not None:
+        edge_map[id] = edge
+    return edge
+
+
+def _chunks(l, size=500):
+    for i in range(0, len(l), size):
+        yield l[i:i + size]
+
+def prefetch(connection, objects):
+    """Loads what is not yet loaded of Nodes and Edges in objects, and of
+    the endpoints of the Edges: an and type of nodes and the attributes
+    of both.  Uses one IN (...) query per table per 500 objects."""
+    nodes = {}
+    edges = {}
+    for o in objects:
+        if isinstance(o, Edge):
+            edges[o.id] = o
+            nodes[o.n1.id] = o.n1
+            nodes[o.n2.id] = o.n2
+        else:
+            nodes[o.id] = o
 
-
-def create_db(cursor):
-    create_statements = (
-        '''CREATE TABLE node (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        -- unique identification for a node, used to reference other tables
-        an text,
-        -- actual accession number, a textual property
-        type text
-        )''',
-        '''CREATE UNIQUE INDEX id_i ON node (id);''',
-        '''CREATE UNIQUE INDEX an_i ON node (an);''',
-
-        '''CREATE TABLE edge (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        -- unique identification for a node, used to reference other tables
-        n1_id integer,
-        n2_id integer,
-        type text
-        )''',
-        '''CREATE INDEX n1_id_i ON edge (n1_id);''',
-        '''CREATE INDEX n2_id_i ON edge (n2_id);''',
-
-        '''CREATE TABLE node_attribute (
-        node_id INTEGER,
-        name TEXT,
-        bool_value TEXT,
-        text_value TEXT
-        )''',
-        '''CREATE INDEX node_attr_i ON node_attribute (node_id);''',
-
-        '''CREATE TABLE edge_attribute (
-        edge_id INTEGER,
-        name TEXT,
-        bool_value TEXT,
-        text_value TEXT
-        )''',
-        '''CREATE INDEX edge_attr_i ON edge_attribute (edge_id);''',
-        )
-    for stmt in create_statements:
+    c = connection.cursor()
+    unloaded = [n for n in nodes.values() if n._an is _unloaded]
+    for chunk in _chunks(unloaded):
+        by_id = dict((n.id, n) for n in chunk)
+        c.execute('SELECT id, an, type FROM node WHERE id IN (%s);' %
+                  ', '.join(['?'] * len(chunk)), by_id.keys())
+        for id, an, type in c:
+            by_id[id]._an = an
+            by_id[id]._type = type
+
+    for objs in (nodes, edges):
+        unpopulated = [o.attributes for o in objs.values()
+                       if not o.attributes._populated]
+        for chunk in _chunks(unpopulated):
+            by_id = dict((a._owner_id, a) for a in chunk)
+            table, key = chunk[0].table, chunk[0].key
+            c.execute('SELECT %s, name, text_value, bool_value FROM %s WHERE %s IN (%s);' %
+                      (key, table, key, ', '.join(['?'] * len(chunk))), by_id.keys())
+            for row in c:
+                by_id[row[0]]._add(row[1], row[2], row[3])
+            for a in chunk:
+                a._populated = True
+    c.close()
+
+
+# The adjacency table holds every edge in both directions along with its
+# numeric weight, so that the neighbours of a node ordered by weight are a
+# single range scan of the covering index.
+_adjacency_table = '''CREATE TABLE IF NOT EXISTS adjacency (
+    node_id INTEGER,
+    weight REAL,
+    neighbour_id INTEGER,
+    edge_id INTEGER
+    )'''
+_adjacency_index = '''CREATE INDEX IF NOT EXISTS adjacency_i
+    ON adjacency (node_id, weight DESC, neighbour_id, edge_id);'''
+
+_edge_attr_index = '''CREATE INDEX IF NOT EXISTS edge_attr_i ON edge_attribute (edge_id);'''
+
+_edge_attr_real_index = '''CREATE INDEX IF NOT EXISTS edge_attr_real_i
+    ON edge_attribute (name, real_value) WHERE real_value IS NOT NULL;'''
+
+# Also serves the lookups by n1_id
+_edge_unique_index = '''CREATE UNIQUE INDEX IF NOT EXISTS edge_i
+    ON edge (n1_id, n2_id, type);'''
+
+_table_statements = (
+    '''CREATE TABLE node (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    -- unique identification for a node, used to reference other tables
+    an text,
+    -- actual accession number, a textual property
+    type text
+    )''',
+
+    '''CREATE TABLE edge (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    -- unique identification for a node, used to reference other tables
+    n1_id integer,
+    n2_id integer,
+    type text
+    )''',
+
+    '''CREATE TABLE node_attribute (
+    node_id INTEGER,
+    name TEXT,
+    bool_value TEXT,
+    text_value TEXT,
+    real_value REAL
+    )''',
+
+    '''CREATE TABLE edge_attribute (
+    edge_id INTEGER,
+    name TEXT,
+    bool_value TEXT,
+    text_value TEXT,
+    real_value REAL
+    )''',
+
+    _adjacency_table,
+    )
+
+_index_statements = (
+    '''CREATE UNIQUE INDEX IF NOT EXISTS id_i ON node (id);''',
+    '''CREATE UNIQUE INDEX IF NOT EXISTS an_i ON node (an);''',
+    _edge_unique_index,
+    '''CREATE INDEX IF NOT EXISTS n2_id_i ON edge (n2_id);''',
+    '''CREATE INDEX IF NOT EXISTS node_attr_i ON node_attribute (node_id);''',
+    _edge_attr_index,
+    _edge_attr_real_index,
+    _adjacency_index,
+    )
+
+
+def create_db(cursor, indexes=True):
+    """Creates the tables and, unless indexes is False, the indexes.  Bulk
+    loading leaves the indexes to create_indexes() after the data is in."""
+    for stmt in _table_statements:
         # print stmt
         cursor.execute(stmt)
+    cursor.execute('PRAGMA user_version=%i;' % SCHEMA_VERSION)
+    if indexes:
+        create_indexes(cursor)
+
+
+def schema_version(connection):
+    c = connection.cursor()
+    c.execute('PRAGMA user_version;')
+    ret = c.fetchone()[0]
+    c.close()
+    return ret
+
+
+def migrate_db(connection):
+    """Upgrades a database made by an older create_db() to SCHEMA_VERSION.
+    Version 1 adds the real_value columns and fills them in from
+    text_value.  Version 2 merges duplicate edges and makes edges unique
+    by (n1_id, n2_id, type)."""
+    c = connection.cursor()
+    version = schema_version(connection)
+    if version < 1:
+        logger.info("Migrating to schema version 1.")
+        connection.create_function('real_value', 2, real_value)
+        for table in ('node_attribute', 'edge_attribute'):
+            c.execute('ALTER TABLE %s ADD COLUMN real_value REAL;' % table)
+            c.execute('''UPDATE %s SET real_value = real_value(name, text_value)
+            WHERE name IN (%s);''' % (table, ', '.join(['?'] * len(NUMERIC_ATTRIBUTES))),
+                      NUMERIC_ATTRIBUTES)
+        c.execute(_edge_attr_real_index)
+    if version < 2:
+        logger.info("Migrating to schema version 2.")
+        merge_duplicate_edges(c)
+        c.execute(_edge_unique_index)
+    c.execute('PRAGMA user_version=%i;' % SCHEMA_VERSION)
+    connection.commit()
+
+
+def merge_duplicate_edges(cursor):
+    """Merges edges with the same (n1_id, n2_id, type) into the one with
+    the smallest id.  Of attributes with the same name the one added last
+    is kept.  Returns the number of edges removed."""
+    cursor.execute('DROP TABLE IF EXISTS temp.edge_duplicate;')
+    cursor.execute('''CREATE TEMP TABLE edge_duplicate AS
+    SELECT e.id AS id, k.id AS keep FROM edge e
+    JOIN (SELECT min(id) AS id, n1_id, n2_id, type FROM edge
+          GROUP BY n1_id, n2_id, type HAVING count(*) > 1) k
+    ON e.n1_id = k.n1_id AND e.n2_id = k.n2_id AND e.type IS k.type
+    WHERE e.id != k.id;''')
+    cursor.execute('SELECT count(*) FROM temp.edge_duplicate;')
+    removed = cursor.fetchone()[0]
+    if removed > 0:
+        cursor.execute('CREATE INDEX temp.edge_duplicate_i ON edge_duplicate (id);')
+        # Bulk loads create the indexes after this, but this one is needed here
+        cursor.execute(_edge_attr_index)
+        cursor.execute('''UPDATE edge_attribute SET edge_id =
+        (SELECT keep FROM temp.edge_duplicate d WHERE d.id = edge_attribute.edge_id)
+        WHERE edge_id IN (SELECT id FROM temp.edge_duplicate);''')
+        cursor.execute('''DELETE FROM edge_attribute
+        WHERE edge_id IN (SELECT keep FROM temp.edge_duplicate)
+        AND rowid NOT IN (SELECT max(rowid) FROM edge_attribute
+                          WHERE edge_id IN (SELECT keep FROM temp.edge_duplicate)
+                          GROUP BY edge_id, name);''')
+        cursor.execute('DELETE FROM edge WHERE id IN (SELECT id FROM temp.edge_duplicate);')
+        if has_adjacency(cursor.connection):
+            cursor.execute('''DELETE FROM adjacency
+            WHERE edge_id IN (SELECT id FROM temp.edge_duplicate);''')
+            cursor.execute('''UPDATE adjacency SET weight =
+            (SELECT %s FROM edge WHERE edge.id = adjacency.edge_id)
+            WHERE edge_id IN (SELECT keep FROM temp.edge_duplicate);''' %
+                           _edge_weight_column(cursor.connection))
+        logger.info("Merged %i duplicate edges." % removed)
+    cursor.execute('DROP TABLE temp.edge_duplicate;')
+    return removed
+
+
+def real_value(name, value):
+    """Returns value as a float if name is one of NUMERIC_ATTRIBUTES and
+    value is a number, otherwise None."""
+    if name not in NUMERIC_ATTRIBUTES or value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _has_real_value_column(connection):
+    """True if the attribute tables have the real_value column of schema
+    version 1.  GraphConnections remember a True answer, as the column is
+    never dropped again."""
+    if getattr(connection, 'real_value_column', False):
+        return True
+    ret = schema_version(connection) >= 1
+    if ret and hasattr(connection, 'real_value_column'):
+        connection.real_value_column = True
+    return ret
+
+
+def _real_value_column(connection, alias):
+    """SQL for the numeric value of attribute table row alias.  Databases
+    older than schema version 1 have no real_value column, so the value
+    is computed from text_value by real_value() there."""
+    if _has_real_value_column(connection):
+        return '%s.real_value' % alias
+    connection.create_function('real_value', 2, real_value)
+    return 'real_value(%s.name, %s.text_value)' % (alias, alias)
+
+
+def create_indexes(cursor):
+    for stmt in _index_statements:
+        cursor.execute(stmt)
+
+
+def _edge_weight_column(connection):
+    """SQL for the weight of the edge table row, see edge_weight()."""
+    value = _real_value_column(connection, 'a')
+    weights = []
+    for name in WEIGHT_ATTRIBUTES:
+        weights.append('''(SELECT %s FROM edge_attribute a
+        WHERE a.edge_id = edge.id AND a.name = '%s' LIMIT 1)''' % (value, name))
+    return 'COALESCE(%s)' % ', '.join(weights + ['NULL'])
+
+
+def _directed_edges_query(connection):
+    """SQL yielding (node_id, weight, neighbour_id, edge_id) for every edge
+    in both directions, computed from the edge and edge_attribute tables."""
+    weight = _edge_weight_column(connection)
+    return '''SELECT n1_id, %s, n2_id, id FROM edge
+    UNION ALL
+    SELECT n2_id, %s, n1_id, id FROM edge WHERE n1_id != n2_id''' % (weight, weight)
+
+
+def build_adjacency(cursor):
+    """(Re)builds the adjacency table from the edge and edge_attribute
+    tables.  Also works on databases created before the table existed."""
+    cursor.execute(_adjacency_table)
+    # Filling the table is faster without the index
+    cursor.execute('DROP INDEX IF EXISTS adjacency_i;')
+    cursor.execute('DELETE FROM adjacency;')
+    cursor.execute('''INSERT INTO adjacency (node_id, weight, neighbour_id, edge_id)
+    %s;''' % _directed_edges_query(cursor.connection))
+    cursor.execute(_adjacency_index)
+
+
+def directed_edges(connection):
+    """Returns a cursor over (node_id, weight, neighbour_id, edge_id) rows
+    for every edge in both directions, read from the adjacency table if
+    the database has one."""
+    c = connection.cursor()
+    if has_adjacency(connection):
+        c.execute('SELECT node_id, weight, neighbour_id, edge_id FROM adjacency;')
+    else:
+        c.execute(_directed_edges_query(connection) + ';')
+    return c
+
+
+def has_table(connection, name):
+    c = connection.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE name=?;", (name,))
+    ret = c.fetchone() is not None
+    c.close()
+    return ret
+
+
+def has_adjacency(connection):
+    return has_table(connection, 'adjacency')
+
+
+def edge_weight(attribute_dict):
+    """Returns the weight of an edge as a float, or None."""
+    for name in WEIGHT_ATTRIBUTES:
+        if name in attribute_dict:
+            return real_value(name, attribute_dict[name])
+    return None
+
+
+def _adjacency_rows(edge_id, n1_id, n2_id, weight):
+    if n1_id == n2_id:
+        return [(n1_id, weight, n2_id, edge_id)]
+    return [(n1_id, weight, n2_id, edge_id), (n2_id, weight, n1_id, edge_id)]
+
+
+# Trigram full-text index over node accession numbers (name NULL) and text
+# node attributes, used by suggest() when present.
+_fts_table = '''CREATE VIRTUAL TABLE IF NOT EXISTS node_fts
+    USING fts5(text, name UNINDEXED, node_id UNINDEXED, tokenize='trigram')'''
+
+def build_fts(cursor):
+    """(Re)builds the node_fts index.  Returns False if this SQLite lacks
+    FTS5 or the trigram tokenizer, in which case suggest() keeps using
+    LIKE scans."""
+    try:
+        cursor.execute(_fts_table)
+    except sqlite3.OperationalError, e:
+        logger.warning("Not building full-text index: %s" % e)
+        return False
+    cursor.execute('DELETE FROM node_fts;')
+    cursor.execute('''INSERT INTO node_fts (text, name, node_id)
+    SELECT an, NULL, id FROM node
+    UNION ALL
+    SELECT text_value, name, node_id FROM node_attribute
+    WHERE text_value IS NOT NULL;''')
+    return True
+
+
+def _glob_literal(text):
+    """Returns a GLOB pattern matching text only."""
+    return u''.join([u'[%s]' % ch if ch in u'*?[' else ch for ch in text])
+
+
+def has_fts(connection):
+    return has_table(connection, 'node_fts')
 
 
 class BMGraphDBSink(bmgraph_file.GraphSink):
+    """Sink writing a graph into a database made by create_db().  A
+    database of an older schema version is migrated first."""
     def __init__(self, connection):
         super(BMGraphDBSink, self).__init__()
         self.connection = connection
         self.cursor = connection.cursor()
+        if has_table(connection, 'node') and schema_version(connection) < SCHEMA_VERSION:
+            # The sinks write real_value and rely on unique edges
+            migrate_db(connection)
+        self.adjacency = has_adjacency(connection)
+        self.fts = has_fts(connection)
+        self.bktree = has_bktree(connection)
+        self.edges_seen = 0
+        self.edges_created = 0
 
     def resolve_node_id(self, an, node_type):
         self.cursor.execute('SELECT id FROM node WHERE an=?;', (an,))
@@ -249,7 +844,13 @@ class BMGraphDBSink(bmgraph_file.GraphSink):
         if node_id != None:
             return node_id
         self.cursor.execute('INSERT INTO node (an, type) VALUES (?, ?);', (an, node_type))
-        return self.resolve_node_id(an, node_type)
+        node_id = self.resolve_node_id(an, node_type)
+        if self.fts:
+            self.cursor.execute('INSERT INTO node_fts (text, name, node_id) VALUES (?,NULL,?);',
+                                (an, node_id))
+        if self.bktree:
+            bktree_insert(self.cursor, node_id, an)
+        return node_id
 
     def special_node_read(self, an, node_type):
         node_id = self.get_or_create_node_id(an, node_type)
@@ -265,27 +866,210 @@ class BMGraphDBSink(bmgraph_file.GraphSink):
                  (node_id, 'special', True))
             self.cursor.execute(*q)
 
+    @_instrumented
     def edge_read(self, node1_name, node1_type, node2_name, node2_type,
                   type, attribute_dict):
         n1_id = self.get_or_create_node_id(node1_name, node1_type)
         n2_id = self.get_or_create_node_id(node2_name, node2_type)
+        self.edges_seen += 1
+
+        q = ('SELECT id FROM edge WHERE n1_id=? AND n2_id=? AND type IS ?;',
+             (n1_id, n2_id, type))
+        self.cursor.execute(*q)
+        ret = self.cursor.fetchone()
+        if ret != None:
+            self._merge_edge(ret[0], attribute_dict)
+            return
 
         q = ('INSERT INTO edge (n1_id, n2_id, type) VALUES (?,?,?);',
              (n1_id, n2_id, type))
         self.cursor.execute(*q)
         edge_id = self.cursor.lastrowid
+        self.edges_created += 1
 
         for k, v in attribute_dict.iteritems():
-            q = ('INSERT INTO edge_attribute (edge_id, name, text_value) VALUES (?,?,?);',
-                 (edge_id, k, v))
+            q = ('INSERT INTO edge_attribute (edge_id, name, text_value, real_value) VALUES (?,?,?,?);',
+                 (edge_id, k, v, real_value(k, v)))
             self.cursor.execute(*q)
+
+        if self.adjacency:
+            rows = _adjacency_rows(edge_id, n1_id, n2_id, edge_weight(attribute_dict))
+            self.cursor.executemany('INSERT INTO adjacency (node_id, weight, neighbour_id, edge_id) VALUES (?,?,?,?);',
+                                    rows)
+
+    def _merge_edge(self, edge_id, attribute_dict):
+        for k, v in attribute_dict.iteritems():
+            q = ('UPDATE edge_attribute SET text_value=?, real_value=? WHERE edge_id=? AND name=?;',
+                 (v, real_value(k, v), edge_id, k))
+            self.cursor.execute(*q)
+            if self.cursor.rowcount < 1:
+                q = ('INSERT INTO edge_attribute (edge_id, name, text_value, real_value) VALUES (?,?,?,?);',
+                     (edge_id, k, v, real_value(k, v)))
+                self.cursor.execute(*q)
+
+        if self.adjacency and set(attribute_dict) & set(WEIGHT_ATTRIBUTES):
+            q = ('SELECT name, text_value FROM edge_attribute WHERE edge_id=?;', (edge_id,))
+            self.cursor.execute(*q)
+            weight = edge_weight(dict(self.cursor.fetchall()))
+            q = ('UPDATE adjacency SET weight=? WHERE edge_id=?;', (weight, edge_id))
+            self.cursor.execute(*q)
+
+    @_instrumented
     def node_attributes_read(self, an, node_type, attribute_dict):
         node_id = self.get_or_create_node_id(an, node_type)
 
         for k, v in attribute_dict.iteritems():
-            q = ('INSERT INTO node_attribute (node_id, name, text_value) VALUES (?,?,?);',
-                 (node_id, k, v))
+            q = ('SELECT text_value FROM node_attribute WHERE node_id=? AND name=?;',
+                 (node_id, k))
             self.cursor.execute(*q)
+            ret = self.cursor.fetchone()
+            if ret != None:
+                q = ('UPDATE node_attribute SET text_value=?, real_value=? WHERE node_id=? AND name=?;',
+                     (v, real_value(k, v), node_id, k))
+                self.cursor.execute(*q)
+                if self.fts:
+                    # GLOB lets the trigram index find the row, = keeps it exact
+                    q = ('DELETE FROM node_fts WHERE text GLOB ? AND text=? AND node_id=? AND name=?;',
+                         (_glob_literal(ret[0]), ret[0], node_id, k))
+                    self.cursor.execute(*q)
+            else:
+                q = ('INSERT INTO node_attribute (node_id, name, text_value, real_value) VALUES (?,?,?,?);',
+                     (node_id, k, v, real_value(k, v)))
+                self.cursor.execute(*q)
+            if self.fts:
+                q = ('INSERT INTO node_fts (text, name, node_id) VALUES (?,?,?);',
+                     (v, k, node_id))
+                self.cursor.execute(*q)
+
+
+class BMGraphDBBulkSink(BMGraphDBSink, bmgraph_file.BatchGraphSink):
+    """Sink for loading large graphs.  Node ids are resolved from an
+    in-memory an -> id map and new rows are buffered and written with
+    executemany() every batch_size rows.  Call flush() after the last
+    read.  Takes the batches of read_file_batched() as they are."""
+    def __init__(self, connection, batch_size=50000):
+        super(BMGraphDBBulkSink, self).__init__(connection)
+        self.batch_size = batch_size
+        self.rows = 0
+        self.node_ids = {}
+        self.cursor.execute('SELECT id, an FROM node;')
+        for node_id, an in self.cursor:
+            self.node_ids[an] = node_id
+        self.cursor.execute('SELECT max(id) FROM node;')
+        self.next_node_id = (self.cursor.fetchone()[0] or 0) + 1
+        self.cursor.execute('SELECT max(id) FROM edge;')
+        self.next_edge_id = (self.cursor.fetchone()[0] or 0) + 1
+        self.specials = set()
+        self._nodes = []
+        self._edges = []
+        self._node_attributes = []
+        self._edge_attributes = []
+        self._adjacency = []
+        self._fts = []
+        self._pending = 0
+
+    def resolve_node_id(self, an, node_type):
+        return self.node_ids.get(an)
+
+    def get_or_create_node_id(self, an, node_type):
+        node_id = self.node_ids.get(an)
+        if node_id != None:
+            return node_id
+        node_id = self.next_node_id
+        self.next_node_id += 1
+        self.node_ids[an] = node_id
+        self._nodes.append((node_id, an, node_type))
+        if self.fts:
+            self._fts.append((an, None, node_id))
+        self._added(1)
+        return node_id
+
+    def special_node_read(self, an, node_type):
+        node_id = self.get_or_create_node_id(an, node_type)
+        if node_id in self.specials:
+            return
+        self.specials.add(node_id)
+        self._node_attributes.append((node_id, 'special', True, None, None))
+        self._added(1)
+
+    def edge_read(self, node1_name, node1_type, node2_name, node2_type,
+                  type, attribute_dict):
+        n1_id = self.get_or_create_node_id(node1_name, node1_type)
+        n2_id = self.get_or_create_node_id(node2_name, node2_type)
+        edge_id = self.next_edge_id
+        self.next_edge_id += 1
+        self._edges.append((edge_id, n1_id, n2_id, type))
+        for k, v in attribute_dict.iteritems():
+            self._edge_attributes.append((edge_id, k, v, real_value(k, v)))
+        if self.adjacency:
+            self._adjacency.extend(_adjacency_rows(edge_id, n1_id, n2_id,
+                                                   edge_weight(attribute_dict)))
+        self._added(1 + len(attribute_dict))
+
+    def node_attributes_read(self, an, node_type, attribute_dict):
+        node_id = self.get_or_create_node_id(an, node_type)
+        for k, v in attribute_dict.iteritems():
+            self._node_attributes.append((node_id, k, None, v, real_value(k, v)))
+            if self.fts:
+                self._fts.append((v, k, node_id))
+        self._added(len(attribute_dict))
+
+    def edges_read(self, batch):
+        """Writes a batch of edges with one executemany() per table."""
+        get_node_id = self.get_or_create_node_id
+        edge_id = self.next_edge_id
+        for n1_name, n1_type, n2_name, n2_type, type, attribute_dict in batch:
+            n1_id = get_node_id(n1_name, n1_type)
+            n2_id = get_node_id(n2_name, n2_type)
+            # get_node_id() may flush, so the buffers are looked up each time
+            self._edges.append((edge_id, n1_id, n2_id, type))
+            self._edge_attributes.extend([(edge_id, k, v, real_value(k, v))
+                                          for k, v in attribute_dict.iteritems()])
+            if self.adjacency:
+                self._adjacency.extend(_adjacency_rows(edge_id, n1_id, n2_id,
+                                                       edge_weight(attribute_dict)))
+            self._pending += 1 + len(attribute_dict)
+            edge_id += 1
+        self.next_edge_id = edge_id
+        self.flush()
+
+    def nodes_attributes_read(self, batch):
+        for node in batch:
+            self.node_attributes_read(*node)
+
+    def _added(self, rows):
+        self._pending += rows
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    @_instrumented
+    def flush(self):
+        c = self.cursor
+        c.executemany('INSERT INTO node (id, an, type) VALUES (?,?,?);',
+                      self._nodes)
+        if self.bktree:
+            for node_id, an, node_type in self._nodes:
+                bktree_insert(c, node_id, an)
+        c.executemany('INSERT INTO edge (id, n1_id, n2_id, type) VALUES (?,?,?,?);',
+                      self._edges)
+        c.executemany('INSERT INTO node_attribute (node_id, name, bool_value, text_value, real_value) VALUES (?,?,?,?,?);',
+                      self._node_attributes)
+        c.executemany('INSERT INTO edge_attribute (edge_id, name, text_value, real_value) VALUES (?,?,?,?);',
+                      self._edge_attributes)
+        if self.adjacency:
+            c.executemany('INSERT INTO adjacency (node_id, weight, neighbour_id, edge_id) VALUES (?,?,?,?);',
+                          self._adjacency)
+        if self.fts:
+            c.executemany('INSERT INTO node_fts (text, name, node_id) VALUES (?,?,?);',
+                          self._fts)
+        self.rows += self._pending
+        self._nodes = []
+        self._edges = []
+        self._node_attributes = []
+        self._edge_attributes = []
+        self._adjacency = []
+        self._fts = []
+        self._pending = 0
 
 
 def node_count(cursor):
@@ -302,42 +1086,46 @@ def edge_count(cursor):
     return cursor.fetchone()[0]
 
 
-def suggest(connection, pattern, fields, print_results=False):
-    "suggestion pattern and attribute names to look for"
-    attr_names = []
-    for field in fields:
-        attr_names.append('name=?')
-
-        if len(attr_names) > 0:
-            r = u"SELECT node_id FROM node_attribute"
-        r = r + u" WHERE text_value like '%' || ? || '%'"
-        r = r + u" AND " + " AND ".join(attr_names) + u";"
-        l = list(fields)
-        l.insert(0, pattern)
-        q = (r, tuple(l))
-        # print q
+@_instrumented
+def suggest(connection, pattern, fields, print_results=False, prefix=False):
+    """suggestion pattern and attribute names to look for.  Nodes whose
+    attributes match are returned, or if there are none, nodes whose
+    accession number matches.  With prefix=True only values starting with
+    pattern match.  Uses the node_fts index if the database has one."""
+    if prefix:
+        like = pattern + u'%'
     else:
-        q = (u'SELECT node_id FROM node_attribute WHERE text_value like \'%\' || ? || \'%\';',
-             (pattern,))
+        like = u'%' + pattern + u'%'
+
+    if has_fts(connection):
+        attr_q = u'SELECT DISTINCT node_id FROM node_fts WHERE text LIKE ? AND name IS NOT NULL'
+        an_q = u'SELECT DISTINCT node_id FROM node_fts WHERE text LIKE ? AND name IS NULL;'
+    else:
+        attr_q = u'SELECT node_id FROM node_attribute WHERE text_value LIKE ?'
+        an_q = u'SELECT id FROM node WHERE an LIKE ?;'
+    args = [like]
+    if len(fields) > 0:
+        attr_q = attr_q + u' AND name IN (%s)' % u', '.join([u'?'] * len(fields))
+        args.extend(fields)
 
     ret = set()
 
     c = connection.cursor()
-    c.execute(*q)
+    c.execute(attr_q + u';', args)
+    rows = c.fetchall()
 
-    if c.rowcount < 1:
-        q = (u'SELECT id FROM node WHERE an like \'%\' || ? || \'%\';',
-             (pattern,))
-        c.execute(*q)
+    if len(rows) < 1:
+        c.execute(an_q, (like,))
+        rows = c.fetchall()
 
-    for row in c:
-        n = Node(row[0], connection)
+    for row in rows:
+        n = get_node(connection, row[0])
         ret.add(n)
 
     if print_results == True:
+        prefetch(connection, ret)
         print_order = []
         for n in ret:
-            n.attributes.populate()
             if len(n.attributes) == 0:
                 print_order.append((n.an, n))
             else:
@@ -365,6 +1153,7 @@ def suggest(connection, pattern, fields, print_results=False):
     return ret
 
 
+@_instrumented
 def edges(connection, an, print_results=False):
     c = connection.cursor()
     c.execute('SELECT id FROM node WHERE an=?;', (an,))
@@ -372,93 +1161,723 @@ def edges(connection, an, print_results=False):
     if ret is None:
         return
 
+    # Nodes of this call, shared by the edges if connection has no
+    # identity map of its own
+    node_map = _node_map(connection)
+    if node_map is None:
+        node_map = {}
+
     node_id = ret[0]
-    node = Node(node_id, connection)
-    node.attributes.populate()
-    # Special node
-    if print_results:
-        _utf8_out.write(u"%s\n" % node.typed_name())
+    node = get_node(connection, node_id, node_map)
 
-    nodes = set()
     c.execute('SELECT DISTINCT id, n1_id, n2_id, type FROM edge WHERE n1_id=? OR n2_id=?;',
               (node_id, node_id))
 
     ret = set()
     for row in c:
-        e = Edge(row['id'], row['n1_id'], row['n2_id'], row['type'], connection) 
-	#Take also llr-values, (previous version did not have the next line): 
-	e.attributes.populate()       
-	ret.add(e)
-	
-        if print_results:
-            e.attributes.populate()
+        ret.add(get_edge(connection, row[0], row[1], row[2], row[3], node_map))
+    c.close()
+    # Take also llr-values and the endpoints, in bulk
+    prefetch(connection, [node] + list(ret))
+
+    if print_results:
+        # Special node
+        _utf8_out.write(u"%s\n" % node.typed_name())
+        nodes = set()
+        for e in ret:
             nodes.add(e.n1)
             nodes.add(e.n2)
             _utf8_out.write(u"%s\n" % e)
-
-    if print_results:
         for n in nodes:
-            n.attributes.populate()
             _utf8_out.write(u"%s\n" % n)
     
     return ret
 
 
-def sample(connection, count, constraints=None, print_results=False):
+_neighbourhood_query = '''SELECT e.id, n1.an, n1.type, n2.an, n2.type, e.type,
+    a.name, a.text_value, a.bool_value, %s
+    FROM edge e
+    JOIN node n1 ON n1.id = e.n1_id
+    JOIN node n2 ON n2.id = e.n2_id
+    LEFT JOIN edge_attribute a ON a.edge_id = e.id
+    WHERE e.id IN (SELECT edge.id FROM node, edge
+                   WHERE node.an = ? AND edge.n1_id = node.id
+                   UNION
+                   SELECT edge.id FROM node, edge
+                   WHERE node.an = ? AND edge.n2_id = node.id)
+    ORDER BY e.id;'''
+
+@_instrumented
+def neighbourhood(connection, an):
+    """Returns the edges of node an as a list of EdgeRecords.  Edges,
+    endpoint names and edge attributes are fetched with a single query."""
+    c = connection.cursor()
+    c.execute(_neighbourhood_query % _real_value_column(connection, 'a'), (an, an))
+
+    ret = []
+    record = None
+    for row in c:
+        if record is None or record.id != row[0]:
+            record = EdgeRecord(row[0], row[1], row[2], row[3], row[4],
+                                row[5], {})
+            ret.append(record)
+        if row[6] is None:
+            continue
+        if row[9] is not None:
+            record.attributes[row[6]] = row[9]
+        elif row[7] is not None:
+            record.attributes[row[6]] = row[7]
+        elif row[8] is not None:
+            record.attributes[row[6]] = row[8]
+    c.close()
+    return ret
+
+
+@_instrumented
+def top_neighbours(connection, an, k, min_weight=None):
+    """Returns at most k Neighbours of node an, highest weight first,
+    leaving out those lighter than min_weight if it is given.  A loop does
+    not make an its own neighbour.  Requires the adjacency table, see
+    build_adjacency()."""
+    q = '''SELECT n.an, n.type, a.weight, a.edge_id
+    FROM adjacency a JOIN node n ON n.id = a.neighbour_id
+    WHERE a.node_id = (SELECT id FROM node WHERE an = ?)
+    AND a.neighbour_id != a.node_id'''
+    args = [an]
+    if min_weight is not None:
+        q = q + ' AND a.weight >= ?'
+        args.append(min_weight)
+    args.append(k)
+    c = connection.cursor()
+    c.execute(q + ' ORDER BY a.weight DESC LIMIT ?;', args)
+    ret = [Neighbour(*row) for row in c]
+    c.close()
+    return ret
+
+
+@_instrumented
+def hop_neighbourhood(connection, an, hops, max_nodes, min_weight=None):
+    """Returns HopNeighbours of at most max_nodes nodes at most hops edges
+    away from node an, nearest first and heaviest first within a hop, like
+    bmgraph.csrgraph.CSRGraph.hop_neighbours_of().  The expansion is
+    breadth-first with one query per hop, leaving out edges lighter than
+    min_weight if it is given; each hop keeps its heaviest new nodes, up to
+    max_nodes in all.  The weight of a node is that of the heaviest edge it
+    was reached over.  Requires the adjacency table, see
+    build_adjacency()."""
+    q = 'SELECT neighbour_id, max(weight) FROM adjacency WHERE node_id IN (%s)'
+    args = []
+    if min_weight is not None:
+        q = q + ' AND weight >= ?'
+        args.append(min_weight)
+    q = q + ' GROUP BY neighbour_id;'
+
+    c = connection.cursor()
+    c.execute('SELECT id FROM node WHERE an = ?;', (an,))
+    row = c.fetchone()
+    if row is None:
+        c.close()
+        return []
+    seen = set([row[0]])
+    frontier = [row[0]]
+    reached = []
+    for hop in range(1, hops + 1):
+        weights = {}
+        for chunk in _chunks(frontier):
+            c.execute(q % ', '.join(['?'] * len(chunk)), chunk + args)
+            for node_id, weight in c:
+                if node_id not in seen:
+                    weights[node_id] = max(weight, weights.get(node_id))
+        # None sorts below every weight
+        frontier = sorted(weights, key=weights.get, reverse=True)[:max_nodes - len(reached)]
+        for node_id in frontier:
+            seen.add(node_id)
+            reached.append((node_id, hop, weights[node_id]))
+        if len(reached) >= max_nodes or len(frontier) == 0:
+            break
+
+    names = {}
+    for chunk in _chunks([r[0] for r in reached]):
+        c.execute('SELECT id, an, type FROM node WHERE id IN (%s);' %
+                  ', '.join(['?'] * len(chunk)), chunk)
+        for node_id, node_an, node_type in c:
+            names[node_id] = (node_an, node_type)
+    c.close()
+    return [HopNeighbour(names[node_id][0], names[node_id][1], hop, weight)
+            for node_id, hop, weight in reached]
+
+
+# Memory map and page cache sizes of immutable connections, see
+# open_readonly()
+SHARED_MMAP_SIZE = 1 << 30
+SHARED_CACHE_KIB = 65536
+
+def open_readonly(path, factory=GraphConnection, immutable=False):
+    """Opens the graph database at path read-only.  Unlike
+    sqlite3.connect() this fails if the file doesn't exist.  Pass
+    factory=InstrumentedConnection to collect query_stats().
+
+    With immutable=True SQLite is told the file never changes, so it takes
+    no locks and never rereads its cache, and the file is memory-mapped,
+    so processes reading the same graph share the pages of the operating
+    system's cache.  The file must then not be written while the
+    connection is open."""
+    if not os.path.exists(path):
+        raise IOError("Graph database %s doesn't exist." % path)
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    uri = 'file:%s?mode=ro' % urllib.quote(os.path.abspath(path))
+    if immutable:
+        uri = uri + '&immutable=1'
+    connection = sqlite3.connect(uri, cached_statements=256, factory=factory)
+    connection.row_factory = sqlite3.Row
+    if immutable:
+        connection.execute('PRAGMA mmap_size=%i;' % SHARED_MMAP_SIZE)
+        connection.execute('PRAGMA cache_size=-%i;' % SHARED_CACHE_KIB)
+    return connection
+
+
+def open_immutable(path):
+    return open_readonly(path, immutable=True)
+
+
+class ConnectionPool(object):
+    """Read-only connections keyed by database path.  Each thread gets its
+    own connection per path, and the pool starts over in a forked child,
+    so a connection is never shared.  Connections stay open, so sqlite3's
+    statement cache keeps the prepared statements of repeated queries."""
+    def __init__(self, factory=open_readonly):
+        self.factory = factory
+        self._pid = os.getpid()
+        self._local = threading.local()
+
+    def get(self, path):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local = threading.local()
+        connections = self._local.__dict__.setdefault('connections', {})
+        connection = connections.get(path)
+        if connection is None:
+            connection = self.factory(path)
+            connections[path] = connection
+        return connection
+
+    def close(self):
+        """Closes the connections of the calling thread."""
+        connections = self._local.__dict__.get('connections', {})
+        for connection in connections.values():
+            connection.close()
+        connections.clear()
+
+
+_pool = ConnectionPool()
+_immutable_pool = ConnectionPool(open_immutable)
+
+def pooled_connection(path, immutable=False):
+    """Returns the calling thread's read-only connection to path, opened
+    with open_readonly(path, immutable=immutable)."""
+    if immutable:
+        return _immutable_pool.get(path)
+    return _pool.get(path)
+
+
+def database_path(connection):
+    """Returns the file name of the main database of connection, or an
+    empty string for in-memory and temporary databases."""
+    c = connection.cursor()
+    c.execute('PRAGMA database_list;')
+    for row in c:
+        if row[1] == 'main':
+            return row[2] or ''
+    return ''
+
+
+class NodeSampler(object):
+    """Draws distinct random nodes from a dense array of node ids that is
+    loaded once.  Uniform draws pick a random position of the array; with
+    weighted=True nodes are drawn in proportion to their degree using a
+    Walker alias table.  Either way a single draw is O(1)."""
+    def __init__(self, connection, weighted=False):
+        self.weighted = weighted
+        self.version = self._version(connection)
+        self.ids = array('l')
+        c = connection.cursor()
+        if not weighted:
+            c.execute('SELECT id FROM node ORDER BY id;')
+            for row in c:
+                self.ids.append(row[0])
+            c.close()
+            return
+
+        if has_adjacency(connection):
+            c.execute('''SELECT node_id, count(*) FROM adjacency
+            GROUP BY node_id ORDER BY node_id;''')
+        else:
+            c.execute('''SELECT node_id, count(*) FROM
+            (SELECT n1_id AS node_id FROM edge
+             UNION ALL
+             SELECT n2_id AS node_id FROM edge WHERE n1_id != n2_id)
+            GROUP BY node_id ORDER BY node_id;''')
+        degrees = []
+        for node_id, degree in c:
+            self.ids.append(node_id)
+            degrees.append(degree)
+        c.close()
+        self._build_alias(degrees)
+
+    def _build_alias(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        self.probability = array('d', [0.0] * n)
+        self.alias = array('l', [0] * n)
+        scaled = [w * n / total for w in weights]
+        small = [i for i in xrange(n) if scaled[i] < 1.0]
+        large = [i for i in xrange(n) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        for i in small + large:
+            self.probability[i] = 1.0
+
+    @staticmethod
+    def _version(connection):
+        c = connection.cursor()
+        c.execute('SELECT max(id) FROM node;')
+        max_id = c.fetchone()[0]
+        c.close()
+        path = database_path(connection)
+        if path == '':
+            return (None, max_id)
+        return (os.stat(path).st_mtime, max_id)
+
+    def is_current(self, connection):
+        return self.version == self._version(connection)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _draw_index(self):
+        i = random.randrange(len(self.ids))
+        if self.weighted and random.random() >= self.probability[i]:
+            return self.alias[i]
+        return i
+
+    def draw(self, count):
+        """Returns a list of count distinct node ids, or all of them if
+        there are not that many."""
+        if count >= len(self.ids):
+            return list(self.ids)
+        if not self.weighted:
+            return [self.ids[i] for i in random.sample(xrange(len(self.ids)), count)]
+        drawn = set()
+        while len(drawn) < count:
+            drawn.add(self._draw_index())
+        return [self.ids[i] for i in drawn]
+
+
+# Samplers of file databases by (path, weighted), shared by all connections
+_samplers = {}
+
+def get_sampler(connection, weighted=False):
+    """Returns a NodeSampler for connection.  Samplers of file databases are
+    cached and rebuilt only when the database has changed."""
+    path = database_path(connection)
+    if path == '':
+        return NodeSampler(connection, weighted)
+    key = (path, weighted)
+    sampler = _samplers.get(key)
+    if sampler is None or not sampler.is_current(connection):
+        sampler = NodeSampler(connection, weighted)
+        _samplers[key] = sampler
+    return sampler
+
+
+@_instrumented
+def sample(connection, count, constraints=None, print_results=False,
+           weighted=False):
     """
     count is the number of samplable nodes,
     constraint contains the attributes that must match the nodes returned.
+    weighted draws nodes in proportion to their degree.
     """
-    c = connection.cursor()
-
     if constraints is not None:
         raise NotImplemented()
 
-
-    # Special case for count > node count in db
-    c.execute("SELECT COUNT(id) FROM node;")
-    if count >= c.fetchone()[0]:
-        c.execute("SELECT id FROM node;")
-        ret = []
-        for row in c:
-            n = Node(row[0], connection)
-            ret.append(n)
-            if print_results:
-                n.attributes.populate()
-                _utf8_out.write(u"%s\n" % n.typed_name())
-        return ret
+    ret = []
+    for id in get_sampler(connection, weighted).draw(count):
+        ret.append(get_node(connection, id))
+    if print_results:
+        prefetch(connection, ret)
+        for n in ret:
+            _utf8_out.write(u"%s\n" % n.typed_name())
+    return ret
 
 
-    ids = set()
-    for i in range(count):
+# Settings used while bulk loading; durability is traded for speed as a
+# failed load is simply started over.
+_loader_pragmas = (
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-262144'),
+    ('temp_store', 'MEMORY'),
+    )
+
+# BK-tree over node accession numbers for fuzzy_lookup().  Each node is a
+# child of the node it was inserted under, at its levenshtein distance.
+_bktree_statements = (
+    '''CREATE TABLE IF NOT EXISTS bktree (
+    node_id INTEGER PRIMARY KEY,
+    parent_id INTEGER,
+    distance INTEGER
+    )''',
+    '''CREATE INDEX IF NOT EXISTS bktree_i ON bktree (parent_id, distance);''',
+    )
+
+def build_bktree(cursor):
+    """(Re)builds the bktree table over all nodes in the database."""
+    for stmt in _bktree_statements:
+        cursor.execute(stmt)
+    cursor.execute('DELETE FROM bktree;')
+
+    cursor.execute('SELECT id, an FROM node ORDER BY id;')
+    root = None
+    names = {}
+    children = {}
+    rows = []
+    for node_id, an in cursor.fetchall():
+        names[node_id] = an
+        if root is None:
+            root = node_id
+            rows.append((node_id, None, None))
+            continue
+        parent = root
         while True:
-            q = "SELECT id FROM node WHERE id >= (abs(random()) % (SELECT max(id) FROM node)) LIMIT 1;"
-            c.execute(q,)
-            id = c.fetchone()[0]
-            if id not in ids:
-                ids.add(id)
+            d = levenshtein(an, names[parent])
+            kids = children.setdefault(parent, {})
+            if d not in kids:
+                kids[d] = node_id
+                rows.append((node_id, parent, d))
                 break
+            parent = kids[d]
+    cursor.executemany('INSERT INTO bktree (node_id, parent_id, distance) VALUES (?,?,?);',
+                       rows)
+    logger.info("%i nodes in the BK-tree." % len(rows))
+
+
+def bktree_insert(cursor, node_id, an):
+    """Adds a new node to the bktree table, one query per level of the
+    tree.  The graph sinks call this for the nodes they create."""
+    cursor.execute('''SELECT b.node_id, n.an FROM bktree b JOIN node n ON n.id = b.node_id
+    WHERE b.parent_id IS NULL;''')
+    row = cursor.fetchone()
+    parent, d = None, None
+    while row is not None:
+        parent = row[0]
+        d = levenshtein(an, row[1])
+        cursor.execute('''SELECT b.node_id, n.an FROM bktree b JOIN node n ON n.id = b.node_id
+        WHERE b.parent_id=? AND b.distance=?;''', (parent, d))
+        row = cursor.fetchone()
+    cursor.execute('INSERT INTO bktree (node_id, parent_id, distance) VALUES (?,?,?);',
+                   (node_id, parent, d))
+
+
+def has_bktree(connection):
+    return has_table(connection, 'bktree')
+
+
+@_instrumented
+def fuzzy_lookup(connection, an, max_distance=2):
+    """Returns (distance, an) pairs for the nodes within max_distance
+    edits of an, nearest first.  Requires the bktree table, see
+    build_bktree(); the graph sinks and prune_db() keep it current.  The
+    tree is searched level by level, with one query per level."""
+    c = connection.cursor()
+    c.execute('''SELECT b.node_id, n.an FROM bktree b JOIN node n ON n.id = b.node_id
+    WHERE b.parent_id IS NULL;''')
+    frontier = c.fetchall()
 
     ret = []
-    for id in ids:
-        n = Node(id, connection)
-        ret.append(n)
-        if print_results:
-            n.attributes.populate()
-            _utf8_out.write(u"%s\n" % n.typed_name())
+    while len(frontier) > 0:
+        ranges = []
+        for node_id, node_an in frontier:
+            d = levenshtein(an, node_an)
+            if d <= max_distance:
+                ret.append((d, node_an))
+            ranges.append((node_id, max(d - max_distance, 0), d + max_distance))
+
+        frontier = []
+        # Stay well below the SQLite host parameter limit
+        for i in range(0, len(ranges), 300):
+            chunk = ranges[i:i + 300]
+            args = []
+            for r in chunk:
+                args.extend(r)
+            c.execute('''WITH f (parent_id, lo, hi) AS (VALUES %s)
+            SELECT b.node_id, n.an FROM f
+            JOIN bktree b ON b.parent_id = f.parent_id AND b.distance BETWEEN f.lo AND f.hi
+            JOIN node n ON n.id = b.node_id;''' % ', '.join(['(?,?,?)'] * len(chunk)),
+                      args)
+            frontier.extend(c.fetchall())
+    c.close()
+
+    ret.sort()
     return ret
 
 
-def build_db(connection, filename):
+def _read_graph_file(filename, sink, processes):
+    bmgraph_file.logger.setLevel(logging.INFO)
+    if processes == 1:
+        with bmgraph_file.open_file(filename) as f:
+            bmgraph_file.read_file_batched(f, sink)
+    else:
+        bmgraph_file.read_file_parallel(filename, sink, processes)
+
+
+def ingest_db(connection, filename, processes=1):
+    """Adds the contents of BMGraph file filename to a database, creating
+    the tables if it has none yet.  Edges already in the database, by (n1, n2, type), are not duplicated;
+    their attributes are merged, new values replacing old ones of the same
+    name.  The file is read in a single transaction, so the cost depends
+    on the size of the file, not of the database.  With processes other
+    than 1 the file is parsed by read_file_parallel()."""
+    if not has_table(connection, 'node'):
+        create_db(connection.cursor())
+    elif schema_version(connection) < SCHEMA_VERSION:
+        migrate_db(connection)
+    start = time.time()
+    s = BMGraphDBSink(connection)
+    _read_graph_file(filename, s, processes)
+    connection.commit()
+    elapsed = time.time() - start
+    logger.info("Read %i edges, %i of them new, in %.1f s (%.0f edges/s)." %
+                (s.edges_seen, s.edges_created, elapsed,
+                 s.edges_seen / max(elapsed, 1e-6)))
+    return s.edges_created
+
+
+def _load_db(connection, filename, bulk, fts, bktree, processes):
     c = connection.cursor()
-    create_db(c)
-    with codecs.open(filename, 'r', encoding="utf-8") as f:
+    create_db(c, indexes=not bulk)
+    if bulk:
+        s = BMGraphDBBulkSink(connection)
+    else:
         s = BMGraphDBSink(connection)
-        # bmgraph.logger.setLevel(logging.DEBUG)
-        bmgraph_file.logger.setLevel(logging.INFO)
-        bmgraph_file.read_file(f, s)
-    connection.commit()
-    logger.info("%i rows in the database." % node_count(c))
-    logger.info("%i node attributes in the database." % node_attribute_count(c))
-    logger.info("%i edge attributes in the database." % edge_attribute_count(c))
-    logger.info("%i edges in the database." % edge_count(c))
\ No newline at end of file
+    _read_graph_file(filename, s, processes)
+    if bulk:
+        s.flush()
+        merge_duplicate_edges(c)
+        create_indexes(c)
+    if fts:
+        build_fts(c)
+    if bktree:
+        build_bktree(c)
+
+
+def build_db(connection, filename, bulk=False, fts=True, bktree=False,
+             processes=1):
+    """Builds the graph database from BMGraph file filename.  With bulk=True
+    the file is loaded in a single transaction with BMGraphDBBulkSink and
+    the loader PRAGMAs, and the indexes are created after the data.  If
+    loading fails the transaction is rolled back, and the PRAGMAs are
+    restored either way.  With fts=True the node_fts index for suggest()
+    is built too, and with bktree=True the bktree table for fuzzy_lookup().
+    With processes other than 1 the file is parsed by
+    read_file_parallel()."""
+    c = connection.cursor()
+    start = time.time()
+    if not bulk:
+        _load_db(connection, filename, bulk, fts, bktree, processes)
+        connection.commit()
+    else:
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        saved_pragmas = []
+        try:
+            for name, value in _loader_pragmas:
+                c.execute('PRAGMA %s;' % name)
+                saved_pragmas.append((name, c.fetchone()[0]))
+                c.execute('PRAGMA %s=%s;' % (name, value))
+            c.execute('BEGIN;')
+            try:
+                _load_db(connection, filename, bulk, fts, bktree, processes)
+            except:
+                c.execute('ROLLBACK;')
+                raise
+            c.execute('COMMIT;')
+        finally:
+            for name, value in saved_pragmas:
+                c.execute('PRAGMA %s=%s;' % (name, value))
+            connection.isolation_level = isolation_level
+    elapsed = time.time() - start
+
+    rows = 0
+    for name, count in (("rows", node_count(c)),
+                        ("node attributes", node_attribute_count(c)),
+                        ("edge attributes", edge_attribute_count(c)),
+                        ("edges", edge_count(c))):
+        logger.info("%i %s in the database." % (count, name))
+        rows += count
+    logger.info("Loaded %i rows in %.1f s (%.0f rows/s)." %
+                (rows, elapsed, rows / max(elapsed, 1e-6)))
+
+
+def degree_distribution(connection):
+    """Returns (nodes, max_degree, mean_degree, bins) of the graph, where
+    bins is a list of (low, high, nodes) with the number of nodes whose
+    degree is within [low, high], in power-of-two bins.  Nodes without
+    edges are in the (0, 0) bin."""
+    c = connection.cursor()
+    c.execute('''SELECT count(*) FROM
+    (SELECT n1_id AS node_id FROM edge
+     UNION ALL SELECT n2_id FROM edge WHERE n1_id != n2_id)
+    GROUP BY node_id;''')
+    counts = {}
+    total = 0
+    nodes = 0
+    max_degree = 0
+    for row in c:
+        degree = row[0]
+        nodes += 1
+        total += degree
+        max_degree = max(max_degree, degree)
+        b = 0
+        while degree >> b > 1:
+            b += 1
+        counts[b + 1] = counts.get(b + 1, 0) + 1
+    c.close()
+    counts[0] = node_count(connection.cursor()) - nodes
+    nodes += counts[0]
+
+    bins = [(0, 0, counts[0])]
+    for b in range(1, max(counts) + 1):
+        bins.append((1 << (b - 1), (1 << b) - 1, counts.get(b, 0)))
+    return nodes, max_degree, total / float(max(nodes, 1)), bins
+
+
+def log_graph_stats(connection, title):
+    path = database_path(connection)
+    if path:
+        logger.info("%s: %.1f MB" % (title, os.path.getsize(path) / 1048576.0))
+    nodes, max_degree, mean_degree, bins = degree_distribution(connection)
+    logger.info("%s: %i nodes, %i edges, mean degree %.1f, max degree %i" %
+                (title, nodes, edge_count(connection.cursor()), mean_degree, max_degree))
+    for low, high, count in bins:
+        logger.info("  degree %6i-%-6i %i nodes" % (low, high, count))
+
+
+def _kept_edges(connection, k, min_weight):
+    """Yields the ids of the edges that are among the k heaviest of either
+    endpoint and at least min_weight.  Edges are read in node order, one
+    node at a time."""
+    if has_adjacency(connection):
+        q = 'SELECT node_id, weight, edge_id FROM adjacency'
+    else:
+        q = 'SELECT node_id, weight, edge_id FROM (%s)' % _directed_edges_query(connection)
+    args = []
+    if min_weight is not None:
+        q = q + ' WHERE weight >= ?'
+        args.append(min_weight)
+    c = connection.cursor()
+    c.execute(q + ' ORDER BY node_id, weight DESC;', args)
+    node_id = None
+    kept = 0
+    for row in c:
+        if row[0] != node_id:
+            node_id = row[0]
+            kept = 0
+        if k is None or kept < k:
+            kept += 1
+            yield row[2]
+    c.close()
+
+
+def _copy_rows(source, target, select, insert, ids):
+    c = source.cursor()
+    for chunk in _chunks(ids):
+        c.execute(select % ', '.join(['?'] * len(chunk)), chunk)
+        target.executemany(insert, c.fetchall())
+    c.close()
+
+
+def prune_db(connection, filename, k=None, min_weight=None, batch_size=50000):
+    """Writes a pruned copy of the graph database of connection to a new
+    database file filename.  An edge is kept if it is among the k heaviest
+    edges of either of its endpoints, when k is given, and its weight is at
+    least min_weight, when that is given; nodes are kept if they have a
+    kept edge.  Edges are streamed in node order and copied batch_size at a
+    time, so memory use doesn't grow with the graph.  The copy gets the
+    indexes, adjacency table and, if the original had one, the full-text
+    index, and is vacuumed.  Returns the number of edges kept."""
+    if k is None and min_weight is None:
+        raise ValueError("Either k or min_weight must be given.")
+    if os.path.exists(filename):
+        raise IOError("Pruned database %s already exists." % filename)
+    start = time.time()
+    log_graph_stats(connection, "Before pruning")
+
+    target = sqlite3.connect(filename)
+    t = target.cursor()
+    create_db(t, indexes=False)
+    t.execute('CREATE TEMP TABLE keep_edge (id INTEGER PRIMARY KEY);')
+    t.execute('CREATE TEMP TABLE keep_node (id INTEGER PRIMARY KEY);')
+    batch = []
+    for edge_id in _kept_edges(connection, k, min_weight):
+        batch.append((edge_id,))
+        if len(batch) >= batch_size:
+            t.executemany('INSERT OR IGNORE INTO keep_edge (id) VALUES (?);', batch)
+            batch = []
+    t.executemany('INSERT OR IGNORE INTO keep_edge (id) VALUES (?);', batch)
+
+    value = _real_value_column(connection, 'a')
+    kept = 0
+    t.execute('SELECT id FROM keep_edge ORDER BY id;')
+    while True:
+        ids = [row[0] for row in t.fetchmany(batch_size)]
+        if len(ids) == 0:
+            break
+        kept += len(ids)
+        _copy_rows(connection, target,
+                   'SELECT id, n1_id, n2_id, type FROM edge WHERE id IN (%s);',
+                   'INSERT INTO edge (id, n1_id, n2_id, type) VALUES (?,?,?,?);', ids)
+        _copy_rows(connection, target,
+                   '''SELECT edge_id, name, bool_value, text_value, %s
+                   FROM edge_attribute a WHERE edge_id IN (%%s);''' % value,
+                   '''INSERT INTO edge_attribute (edge_id, name, bool_value, text_value, real_value)
+                   VALUES (?,?,?,?,?);''', ids)
+    target.execute('''INSERT OR IGNORE INTO keep_node (id)
+    SELECT n1_id FROM edge UNION ALL SELECT n2_id FROM edge;''')
+
+    t.execute('SELECT id FROM keep_node ORDER BY id;')
+    while True:
+        ids = [row[0] for row in t.fetchmany(batch_size)]
+        if len(ids) == 0:
+            break
+        _copy_rows(connection, target,
+                   'SELECT id, an, type FROM node WHERE id IN (%s);',
+                   'INSERT INTO node (id, an, type) VALUES (?,?,?);', ids)
+        _copy_rows(connection, target,
+                   '''SELECT node_id, name, bool_value, text_value, %s
+                   FROM node_attribute a WHERE node_id IN (%%s);''' % value,
+                   '''INSERT INTO node_attribute (node_id, name, bool_value, text_value, real_value)
+                   VALUES (?,?,?,?,?);''', ids)
+    t.execute('DROP TABLE temp.keep_edge;')
+    t.execute('DROP TABLE temp.keep_node;')
+
+    create_indexes(t)
+    build_adjacency(t)
+    if has_fts(connection):
+        build_fts(t)
+    if has_bktree(connection):
+        build_bktree(t)
+    target.commit()
+    t.execute('VACUUM;')
+    logger.info("Kept %i edges in %.1f s." % (kept, time.time() - start))
+    log_graph_stats(target, "After pruning")
+    target.close()
+    return kept
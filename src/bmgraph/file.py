@@ -3,8 +3,18 @@
 from __future__ import with_statement
 
 import sys
+import os
 import traceback
 import StringIO
+import cStringIO
+import marshal
+import itertools
+import collections
+import multiprocessing
+import codecs
+import subprocess
+import gzip
+import bz2
 
 import logging
 logging.basicConfig(level=logging.WARNING)
@@ -25,6 +35,10 @@ class mdict(dict):
     def delete(self, key, value):
         self[key].remove(value)
 
+    def replace(self, key, value):
+        """Sets value as the only value of key."""
+        dict.__setitem__(self, key, [value])
+
     def __str__(self):
         return unicode(self).encode('ASCII', 'backslashreplace')
 
@@ -50,35 +64,77 @@ class GraphSink(object):
 
 class GraphObjectSink(GraphSink):
     '''Sink for an in-memory Graph object.  If passed a graph object as the kw
-    param graph, append to that Graph.'''
-    def __init__(self, graph=None):
+    param graph, append to that Graph.  An edge read again, with the same
+    nodes and type, updates the attributes of the edge already in the graph
+    unless dedupe is False.'''
+    def __init__(self, graph=None, dedupe=True):
         if graph != None:
             self.graph = graph
         else:
             self.graph = Graph()
+        self.dedupe = dedupe
     def special_node_read(self, node_name, node_type):
         self.graph.get_node(node_name, node_type).special_node = True
     def edge_read(self, node1_name, node1_type, node2_name, node2_type,
                   type, attribute_dict):
         n1 = self.graph.get_node(node1_name, node1_type)
         n2 = self.graph.get_node(node2_name, node2_type)
-        e = n1.add_edge(n2)
-        e.type = type
+        if self.dedupe:
+            e = self.graph.get_edge(n1, n2, type)
+            if e is not None:
+                for k, v in attribute_dict.iteritems():
+                    e.attributes.replace(_intern(k), v)
+                return
+        e = n1.add_edge(n2, type)
         for k, v in attribute_dict.iteritems():
-            e.attributes[k] = v
+            e.attributes[_intern(k)] = v
     def node_attributes_read(self, node_name, node_type, attribute_dict):
         n = self.graph.get_node(node_name, node_type)
         for k, v in attribute_dict.iteritems():
-            n.attributes[k] = v
+            n.attributes[_intern(k)] = v
     def get_object(self):
         return self.graph
 
 
+class BatchGraphSink(GraphSink):
+    '''Sink for read_file_batched().  Edges and node attributes arrive in
+    lists, the plural methods taking lists of the arguments of the singular
+    ones of GraphSink: edges_read() (node1_name, node1_type, node2_name,
+    node2_type, type, attribute_dict) tuples and nodes_attributes_read()
+    (node_name, node_type, attribute_dict) tuples.'''
+    def edges_read(self, batch):
+        pass
+    def nodes_attributes_read(self, batch):
+        pass
+
+
+class BatchSinkAdapter(BatchGraphSink):
+    '''Passes the batches of read_file_batched() to a GraphSink one at a
+    time.'''
+    def __init__(self, sink):
+        self.sink = sink
+    def special_node_read(self, node_name, node_type):
+        self.sink.special_node_read(node_name, node_type)
+    def comment_read(self, type, value):
+        self.sink.comment_read(type, value)
+    def edges_read(self, batch):
+        edge_read = self.sink.edge_read
+        for edge in batch:
+            edge_read(*edge)
+    def nodes_attributes_read(self, batch):
+        node_attributes_read = self.sink.node_attributes_read
+        for node in batch:
+            node_attributes_read(*node)
+
+
 class Graph(object):
     def __init__(self):
         self.attributes = mdict()
         self.nodes = {}
         self.comments = []
+        # (n1 name, n2 name) -> the edge from n1 to n2, or a list of them
+        # if there are several, which is rare
+        self._edges = {}
 
     def add_node(self, node):
         self.nodes[node.name] = node
@@ -91,44 +147,133 @@ class Graph(object):
             n = Node(self, name, type)
             return n
 
+    def _index_edge(self, edge):
+        key = (edge.n1.name, edge.n2.name)
+        indexed = self._edges.get(key)
+        if indexed is None:
+            self._edges[key] = edge
+        elif isinstance(indexed, list):
+            indexed.append(edge)
+        else:
+            self._edges[key] = [indexed, edge]
+
+    def _unindex_edge(self, edge):
+        key = (edge.n1.name, edge.n2.name)
+        indexed = self._edges.get(key)
+        if indexed is edge:
+            del self._edges[key]
+        elif isinstance(indexed, list):
+            indexed[:] = [e for e in indexed if e is not edge]
+            if len(indexed) == 1:
+                self._edges[key] = indexed[0]
+
+    def edges_between(self, n1, n2):
+        """Returns the edges from node n1 to node n2."""
+        indexed = self._edges.get((n1.name, n2.name))
+        if indexed is None:
+            return []
+        if isinstance(indexed, list):
+            return list(indexed)
+        return [indexed]
+
+    def get_edge(self, n1, n2, type):
+        """Returns the edge of type from node n1 to node n2, or None."""
+        indexed = self._edges.get((n1.name, n2.name))
+        if isinstance(indexed, list):
+            for e in indexed:
+                if e.type == type:
+                    return e
+        elif indexed is not None and indexed.type == type:
+            return indexed
+        return None
+
+    def has_edge(self, n1, n2, type):
+        return self.get_edge(n1, n2, type) is not None
+
+    def _remove_edges(self, edges):
+        removed = {}
+        for e in edges:
+            removed[id(e)] = e
+        nodes = {}
+        for e in removed.itervalues():
+            self._unindex_edge(e)
+            nodes[id(e.n1)] = e.n1
+            nodes[id(e.n2)] = e.n2
+        # One pass over the edges of each node instead of a list removal
+        # for each edge
+        for node in nodes.itervalues():
+            node.edges = [e for e in node.edges if id(e) not in removed]
+        return len(removed)
+
+    def remove_edge(self, edge):
+        """Removes edge from the graph and from the edges of its nodes."""
+        self._remove_edges([edge])
+
+    def delete_edges(self, predicate):
+        """Removes the edges e for which predicate(e) is true, in one pass
+        over the graph.  Returns the number of edges removed."""
+        edges = []
+        for node in self.nodes.itervalues():
+            for e in node.edges:
+                if e.n1 is node and predicate(e):
+                    edges.append(e)
+        return self._remove_edges(edges)
+
+    def delete_nodes(self, predicate):
+        """Removes the nodes n for which predicate(n) is true, and their
+        edges.  Returns the number of nodes removed."""
+        nodes = [n for n in self.nodes.itervalues() if predicate(n)]
+        edges = []
+        for node in nodes:
+            self.del_node(node)
+            edges.extend(node.edges)
+        self._remove_edges(edges)
+        return len(nodes)
+
     def __str__(self):
         print "called"
         return unicode(self).encode('ASCII', 'backslashreplace')
 
     def __unicode__(self):
-        ret = []
+        ret = StringIO.StringIO()
+        write_graph(self, ret)
+        return ret.getvalue()
 
-        for node in self.nodes.values():
-            if node.special_node:
-                ret.append(unicode(node))
-                specials_written = True
 
-        for comment in self.comments:
-            ret.append(u"# %s" % unicode(comment))
-            comments_written = True
+# Node and edge types and attribute names, shared by all the nodes and
+# edges that have them instead of a copy each
+_interned = {}
 
-        written_edges = set([])
-        for node in self.nodes.values():
-            for edge in node.edges:
-                if unicode(edge) in written_edges:
-                    continue
-                ret.append(unicode(edge))
-                written_edges.add(unicode(edge))
+def _intern(s):
+    return _interned.setdefault(s, s)
 
-        for node in self.nodes.values():
-            if len(node.attributes.keys()) == 0:
-                continue
-            ret.append(u"# _attributes %s %s" % (unicode(node), unicode(node.attributes)))
 
-        ret.append(u'')
-        return u'\n'.join(ret)
+class _Attributed(object):
+    '''Base of Node and Edge.  Graphs have millions of them, so they have
+    __slots__ and no __dict__, and their attributes mdict is only created
+    when it is first used.'''
+    __slots__ = ('_attributes',)
 
+    def _get_attributes(self):
+        if self._attributes is None:
+            self._attributes = mdict()
+        return self._attributes
+    def _set_attributes(self, attributes):
+        self._attributes = attributes
+    attributes = property(_get_attributes, _set_attributes)
 
-class Edge(object):
-    def __init__(self, n1, n2):
-        self.attributes = mdict()
+    def has_attributes(self):
+        return bool(self._attributes)
+
+
+class Edge(_Attributed):
+    __slots__ = ('n1', 'n2', 'type')
+
+    def __init__(self, n1, n2, type=None):
+        self._attributes = None
         self.n1 = n1
         self.n2 = n2
+        self.type = _intern(type)
 
     def other(self, node):
         if node == self.n1:
@@ -142,36 +287,41 @@ class Edge(object):
         return unicode(self).encode('ASCII', 'backslashreplace')
 
     def __unicode__(self):
-        return u"%s %s %s %s" % (self.n1, self.n2, self.type, self.attributes)
+        return u"%s %s %s %s" % (self.n1, self.n2, self.type, self._attributes or u"")
 
     def __repr__(self):
         return "<Edge %s>" % str(self)
 
 
-class Node(object):
+class Node(_Attributed):
+    __slots__ = ('graph', 'name', 'type', 'special_node', 'edges')
+
     def __init__(self, graph, name, type):
         self.graph = graph
-        self.attributes = mdict()
+        self._attributes = None
         self.name = name
-        self.type = type
+        self.type = _intern(type)
         self.special_node = False
         self.edges = []
         self.graph.add_node(self)
 
-    def add_edge(self, other):
-        e = Edge(self, other)
+    def add_edge(self, other, type=None):
+        e = Edge(self, other, type)
         self.edges.append(e)
         other.edges.append(e)
+        self.graph._index_edge(e)
         return e
 
     def remove_edge(self, edge):
+        """Removes edge from the edges of this node and from the edge index
+        of the graph.  The other node of edge keeps it until its own
+        remove_edge(); Graph.remove_edge() does both."""
         self.edges.remove(edge)
+        self.graph._unindex_edge(edge)
 
     def delete(self):
         self.graph.del_node(self)
-        for edge in self.edges:
-            other = edge.other(self)
-            other.remove_edge(edge)
+        self.graph._remove_edges(self.edges)
 
     def __cmp__(self, other):
         return (str(self) == str(other))
@@ -280,15 +430,334 @@ def read_file(stream, sink):
                 sink.edge_read(n1_name, n1_type, n2_name, n2_type,
                                type, attr_dict)
 
+# Compression of graph files by extension.  Python has no xz or zstd
+# modules, so those go through the xz and zstd commands.
+_compressions = {'.gz': 'gzip', '.bz2': 'bzip2', '.xz': 'xz', '.zst': 'zstd'}
+
+def compression(filename):
+    """Returns the compression of filename by its extension: 'gzip',
+    'bzip2', 'xz', 'zstd' or None."""
+    return _compressions.get(os.path.splitext(filename)[1])
+
+
+def _find_command(command):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, command)
+        if os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class _CompressorPipe(object):
+    '''File reading from or writing to a compression command, decoding
+    or encoding unicode if an encoding is given.'''
+    def __init__(self, command, filename, mode, encoding=None):
+        path = _find_command(command)
+        if path is None:
+            raise IOError("The %s command is needed for %s." % (command, filename))
+        self.name = filename
+        self.command = command
+        self.reading = 'r' in mode
+        if self.reading:
+            self._file = None
+            self._process = subprocess.Popen([path, '-d', '-c', '-q', filename],
+                                             stdout=subprocess.PIPE)
+            self._pipe = self._process.stdout
+        else:
+            self._file = open(filename, 'wb')
+            self._process = subprocess.Popen([path, '-c', '-q'], stdin=subprocess.PIPE,
+                                             stdout=self._file)
+            self._pipe = self._process.stdin
+        self._stream = self._pipe
+        if encoding is not None and self.reading:
+            self._stream = codecs.getreader(encoding)(self._pipe)
+        elif encoding is not None:
+            self._stream = codecs.getwriter(encoding)(self._pipe)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def close(self):
+        if self._pipe.closed:
+            return
+        self._pipe.close()
+        status = self._process.wait()
+        if self._file is not None:
+            self._file.close()
+        # Killed by SIGPIPE when closed before the end of the file
+        if status > 0 or (status < 0 and not self.reading):
+            raise IOError("%s failed on %s with status %i." %
+                          (self.command, self.name, status))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except IOError:
+            # The exception raised in the with block is the one to report
+            pass
+
+
+def open_file(filename, mode='rb', encoding=None):
+    """Opens filename for reading, mode 'r', or writing, mode 'w',
+    compressed with gzip, bzip2, xz or zstd if its name ends in .gz, .bz2,
+    .xz or .zst.  The data is (de)compressed as it is read or written.
+    The file reads and writes str, or unicode if an encoding is given."""
+    if mode not in ('r', 'rb', 'w', 'wb'):
+        raise ValueError("Mode must be 'r' or 'w', not %r." % mode)
+    mode = mode[0] + 'b'
+    c = compression(filename)
+    if c == 'gzip':
+        f = gzip.open(filename, mode)
+    elif c == 'bzip2':
+        f = bz2.BZ2File(filename, mode)
+    elif c is not None:
+        return _CompressorPipe(c, filename, mode, encoding)
+    else:
+        f = open(filename, mode)
+    if encoding is None:
+        return f
+    if mode == 'rb':
+        return codecs.getreader(encoding)(f)
+    return codecs.getwriter(encoding)(f)
+
+
+def write_graph(graph, stream):
+    """Writes graph to stream, which takes unicode, in the BMGraph format a
+    line at a time: special nodes, comments, edges and node attributes.
+    Each edge is written once, at its first node, so that no more memory
+    is needed than for the line being written."""
+    for node in graph.nodes.itervalues():
+        if node.special_node:
+            stream.write(u"%s\n" % unicode(node))
+
+    for comment in graph.comments:
+        stream.write(u"# %s\n" % unicode(comment))
+
+    for node in graph.nodes.itervalues():
+        previous = None
+        for edge in node.edges:
+            # A loop is in the edges of its node twice, one after the other
+            if edge.n1 is node and edge is not previous:
+                stream.write(u"%s\n" % unicode(edge))
+            previous = edge
+
+    for node in graph.nodes.itervalues():
+        if not node.has_attributes():
+            continue
+        stream.write(u"# _attributes %s %s\n" % (unicode(node), unicode(node.attributes)))
+
+
+def _line_blocks(stream, block_size):
+    """Yields the lines of stream, without line ends, in lists of about
+    block_size bytes.  Each block is decoded from UTF-8 at once."""
+    rest = ''
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        block = rest + block
+        end = block.rfind('\n')
+        if end < 0:
+            rest = block
+            continue
+        rest = block[end + 1:]
+        block = block[:end]
+        if isinstance(block, str):
+            block = block.decode('utf-8')
+        yield block.split(u'\n')
+    if rest:
+        if isinstance(rest, str):
+            rest = rest.decode('utf-8')
+        yield [rest]
+
+
+def _attribute_dict(attributes, lines_read):
+    attr_dict = {}
+    for attribute in attributes:
+        key, sep, value = attribute.partition('=')
+        if not sep:
+            logger.warning("Line %i: error parsing attribute %s" % (lines_read, attribute))
+            continue
+        if '+' in value:
+            value = value.replace('+', ' ')
+        attr_dict[key] = value
+    return attr_dict
+
+
+def read_file_batched(stream, sink, batch_size=10000, block_size=1 << 20):
+    """Reads the same format as read_file(), faster.  stream, a file opened
+    in binary mode or one giving unicode, is read block_size bytes at a
+    time, and edges and node attributes are handed to sink batch_size at
+    a time.  sink is a BatchGraphSink; other GraphSinks are wrapped in a
+    BatchSinkAdapter."""
+    if not isinstance(sink, BatchGraphSink):
+        sink = BatchSinkAdapter(sink)
+    edges = []
+    nodes = []
+    lines_read = 0
+    for lines in _line_blocks(stream, block_size):
+        for line in lines:
+            lines_read += 1
+            if not line:
+                continue
+
+            if line[0] == '#':
+                comment_type, sep, value = line[2:].partition(" ")
+                if comment_type == "_attributes":
+                    node, sep, attributes = value.partition(" ")
+                    node_type, sep, node_name = node.partition('_')
+                    if not sep:
+                        node_name, node_type = node_type, None
+                    nodes.append((node_name, node_type,
+                                  _attribute_dict(attributes.split(" "), lines_read)))
+                    if len(nodes) >= batch_size:
+                        sink.nodes_attributes_read(nodes)
+                        nodes = []
+                else:
+                    sink.comment_read(comment_type, value.replace("+", " "))
+                continue
+
+            parts = line.split(" ", 2)
+            if len(parts) == 3:
+                edge_attributes = parts[2].split(" ")
+                n1_type, sep, n1_name = parts[0].partition('_')
+                if not sep:
+                    n1_name, n1_type = n1_type, None
+                n2_type, sep, n2_name = parts[1].partition('_')
+                if not sep:
+                    n2_name, n2_type = n2_type, None
+                edges.append((n1_name, n1_type, n2_name, n2_type, edge_attributes[0],
+                               _attribute_dict(edge_attributes[1:], lines_read)))
+                if len(edges) >= batch_size:
+                    sink.edges_read(edges)
+                    edges = []
+            elif len(parts) == 1 and parts[0].strip() != "":
+                node_type, sep, node_name = parts[0].partition('_')
+                if not sep:
+                    node_name, node_type = node_type, None
+                sink.special_node_read(node_name, node_type)
+        logger.info("Read %i lines..." % lines_read)
+
+    if edges:
+        sink.edges_read(edges)
+    if nodes:
+        sink.nodes_attributes_read(nodes)
+
+
+class _RecordingBatchSink(BatchGraphSink):
+    def __init__(self):
+        self.calls = []
+    def special_node_read(self, node_name, node_type):
+        self.calls.append(('special_node_read', (node_name, node_type)))
+    def comment_read(self, type, value):
+        self.calls.append(('comment_read', (type, value)))
+    def edges_read(self, batch):
+        self.calls.append(('edges_read', (batch,)))
+    def nodes_attributes_read(self, batch):
+        self.calls.append(('nodes_attributes_read', (batch,)))
+
+
+def _line_ranges(filename, chunk_size):
+    """Yields (start, end) byte ranges of filename of about chunk_size
+    bytes, each ending at a line end."""
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def _decompressed_ranges(filename, chunk_size):
+    """Yields (end, data) of the decompressed data of filename in blocks of
+    about chunk_size bytes, each ending at a line end."""
+    with open_file(filename) as f:
+        end = 0
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            data += f.readline()
+            end += len(data)
+            yield end, data
+
+
+def _read_range(filename, start, end, batch_size):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return _parse_range(data, batch_size)
+
+
+def _parse_range(data, batch_size):
+    sink = _RecordingBatchSink()
+    read_file_batched(cStringIO.StringIO(data), sink, batch_size, len(data) + 1)
+    # Much faster to pass between processes than pickled
+    return marshal.dumps(sink.calls)
+
+
+def read_file_parallel(filename, sink, processes=None, chunk_size=1 << 24,
+                       batch_size=10000):
+    """Reads BMGraph file filename like read_file_batched(), parsing ranges
+    of about chunk_size bytes in a pool of processes, by default one per
+    core.  The parsed batches are handed to sink in this process in the
+    order of the file, so sink needn't be safe for concurrent use, and at
+    most two ranges per process are parsed ahead of it.  Line numbers in
+    warnings are counted from the start of their range.  A compressed
+    file is decompressed in this process and parsed in the pool."""
+    if not isinstance(sink, BatchGraphSink):
+        sink = BatchSinkAdapter(sink)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if compression(filename) is None:
+        jobs = ((end, _read_range, (filename, start, end, batch_size))
+                for start, end in _line_ranges(filename, chunk_size))
+    else:
+        jobs = ((end, _parse_range, (data, batch_size))
+                for end, data in _decompressed_ranges(filename, chunk_size))
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        for end, f, args in itertools.islice(jobs, 2 * processes):
+            pending.append((end, pool.apply_async(f, args)))
+        while pending:
+            end, result = pending.popleft()
+            calls = marshal.loads(result.get())
+            for next_end, f, args in itertools.islice(jobs, 1):
+                pending.append((next_end, pool.apply_async(f, args)))
+            for name, args in calls:
+                getattr(sink, name)(*args)
+            logger.info("Read %i bytes..." % end)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 def read_string(string, sink):
     return read_file(StringIO.StringIO(string), sink)
 
 def main(args):
     if len(args) > 0:
-        s = bmgraph_file.GraphObjectSink()
+        s = GraphObjectSink()
         for arg in args:
             try:
-                bmgraph_file.read_file(arg, s)
+                with open_file(arg, encoding='utf-8') as f:
+                    read_file(f, s)
             except:
                 traceback.print_exc()
         print s.get_object()
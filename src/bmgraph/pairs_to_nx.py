@@ -7,11 +7,11 @@ import cProfile
 import re, codecs
 import random
 import tavuttaja_regexp as regexp
-from bmgraph.file import Graph, Node, Edge
+from bmgraph.file import Graph, Node, Edge, write_graph, open_file
 
 def main():
     
-    f = codecs.open('/home/jmtoivan/Lemma_based_replace/graph_sentence_nouns.txt', encoding = 'utf-8')
+    f = open_file('/home/jmtoivan/Lemma_based_replace/graph_sentence_nouns.txt', encoding = 'utf-8')
     G = read_to_graph(f)
 
 def read_to_graph(file_handle):
@@ -50,8 +50,8 @@ def read_to_graph(file_handle):
         keycounter = keycounter + 1
         
     #print G.number_of_nodes()
-    with codecs.open('/home/jmtoivan/Lemma_based_replace/temp.bmg', 'w', encoding = 'utf-8') as g:
-        print >> g, unicode(bmg)
+    with open_file('/home/jmtoivan/Lemma_based_replace/temp.bmg', 'w', encoding = 'utf-8') as g:
+        write_graph(bmg, g)
 
     #print nx.connected_components(G)
     #nx.draw(G)
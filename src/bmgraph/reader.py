@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''Graph queries run by a fixed pool of reader threads, each with its own
+read-only connection, so that an event loop or a server can have many
+lookups in flight without blocking on them.
+
+The queries return GraphFutures.  They have the interface of
+concurrent.futures.Future: result() and exception() with a timeout,
+cancel() and add_done_callback(), which is what event loops need to wrap
+them.  Cancelling a running query, or one whose timeout passes, interrupts
+it in SQLite.
+
+Nodes and edges in the results are fully loaded by the reader thread, as
+their connection can't be used from other threads.
+'''
+
+import threading
+import Queue
+import logging
+logger = logging.getLogger("bmgraph.reader")
+
+import db as bmgraph_db
+
+
+class QueryTimeout(Exception):
+    pass
+
+class QueryCancelled(Exception):
+    pass
+
+
+_PENDING = 'pending'
+_RUNNING = 'running'
+_CANCELLED = 'cancelled'
+_FINISHED = 'finished'
+
+class GraphFuture(object):
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = _PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        # The reader running the query, for interrupting it
+        self._reader = None
+
+    def cancel(self):
+        """Cancels the query, interrupting it if it is running.  Returns
+        False if it has already finished."""
+        with self._condition:
+            if self._state == _FINISHED:
+                return False
+            if self._state == _CANCELLED:
+                return True
+            if self._state == _RUNNING:
+                self._reader.interrupt(self)
+            self._state = _CANCELLED
+            self._condition.notify_all()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == _CANCELLED
+
+    def running(self):
+        return self._state == _RUNNING
+
+    def done(self):
+        return self._state in (_CANCELLED, _FINISHED)
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self.done():
+                self._condition.wait(timeout)
+            if self._state == _CANCELLED:
+                raise QueryCancelled()
+            if self._state != _FINISHED:
+                raise QueryTimeout()
+
+    def result(self, timeout=None):
+        """Returns the result of the query, waiting at most timeout seconds
+        for it.  Raises QueryTimeout if it isn't done by then, and
+        QueryCancelled if it was cancelled."""
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Calls fn(future) when the query is done, in the reader thread,
+        or at once if it already is."""
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _start(self, reader):
+        with self._condition:
+            if self._state != _PENDING:
+                return False
+            self._state = _RUNNING
+            self._reader = reader
+            return True
+
+    def _finish(self, result, exception):
+        with self._condition:
+            if self._state != _RUNNING:
+                return
+            self._result = result
+            self._exception = exception
+            self._state = _FINISHED
+            self._condition.notify_all()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        with self._condition:
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("Callback of a graph query failed.")
+
+
+class _Reader(threading.Thread):
+    def __init__(self, path, immutable, jobs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.immutable = immutable
+        self.jobs = jobs
+        self.connection = None
+        self._lock = threading.Lock()
+        self._current = None
+        self._timed_out = False
+
+    def interrupt(self, future, timed_out=False):
+        # Only the query of future: the timer of a finished query must not
+        # interrupt the next one
+        with self._lock:
+            if self._current is future:
+                self._timed_out = timed_out
+                self.connection.interrupt()
+
+    def run(self):
+        self.connection = bmgraph_db.open_readonly(self.path, immutable=self.immutable)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, timeout, f, args, kwargs = job
+            if not future._start(self):
+                continue
+            with self._lock:
+                self._current = future
+                self._timed_out = False
+            timer = None
+            if timeout is not None:
+                timer = threading.Timer(timeout, self.interrupt, (future, True))
+                timer.start()
+            result, exception = None, None
+            try:
+                result = f(self.connection, *args, **kwargs)
+            except Exception, e:
+                exception = e
+            if timer is not None:
+                timer.cancel()
+            with self._lock:
+                self._current = None
+                if self._timed_out:
+                    result, exception = None, QueryTimeout()
+            future._finish(result, exception)
+        self.connection.close()
+
+
+class GraphReader(object):
+    """Runs graph queries on the database at path in worker threads,
+    each with its own connection, opened with open_readonly(path,
+    immutable=immutable).  At most max_pending queries wait for a reader;
+    more block the caller.  Queries taking longer than timeout seconds, if
+    it is given, are interrupted and fail with QueryTimeout."""
+    def __init__(self, path, workers=4, max_pending=256, timeout=None,
+                 immutable=False):
+        self.timeout = timeout
+        self._jobs = Queue.Queue(max_pending)
+        self._readers = [_Reader(path, immutable, self._jobs) for i in range(workers)]
+        for r in self._readers:
+            r.start()
+
+    def submit(self, f, *args, **kwargs):
+        """Returns a GraphFuture of f(connection, *args, **kwargs) run by a
+        reader.  The timeout keyword argument overrides that of the
+        GraphReader."""
+        timeout = kwargs.pop('timeout', None)
+        if timeout is None:
+            timeout = self.timeout
+        future = GraphFuture()
+        self._jobs.put((future, timeout, f, args, kwargs))
+        return future
+
+    def edges(self, an, timeout=None):
+        return self.submit(_loaded_edges, an, timeout=timeout)
+
+    def sample(self, count, weighted=False, timeout=None):
+        return self.submit(_loaded_sample, count, weighted, timeout=timeout)
+
+    def suggest(self, pattern, fields, prefix=False, timeout=None):
+        return self.submit(_loaded_suggest, pattern, fields, prefix,
+                           timeout=timeout)
+
+    def close(self):
+        """Stops the readers after the queries already submitted."""
+        for r in self._readers:
+            self._jobs.put(None)
+        for r in self._readers:
+            r.join()
+
+
+def _loaded_edges(connection, an):
+    ret = bmgraph_db.edges(connection, an)
+    if ret is None:
+        return None
+    bmgraph_db.prefetch(connection, ret)
+    return ret
+
+def _loaded_sample(connection, count, weighted):
+    ret = bmgraph_db.sample(connection, count, weighted=weighted)
+    bmgraph_db.prefetch(connection, ret)
+    return ret
+
+def _loaded_suggest(connection, pattern, fields, prefix):
+    ret = bmgraph_db.suggest(connection, pattern, fields, prefix=prefix)
+    bmgraph_db.prefetch(connection, ret)
+    return ret
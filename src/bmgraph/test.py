@@ -2,12 +2,32 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import os
+import codecs
+import StringIO
+import logging
+import sqlite3
+import shutil
+import tempfile
 
 import unittest
 runner = unittest.TextTestRunner(stream=sys.stderr, descriptions=True, verbosity=2)
 
 import db as bmgraph_db
+import reader
 import file as bmgraph_file
+import binary
+import crawler
+try:
+    import csrgraph
+except ImportError:
+    csrgraph = None
+# The poem generator that uses these graphs lives one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+try:
+    import generate_poem
+except ImportError:
+    generate_poem = None
 
 
 class Test_mdict(unittest.TestCase):
@@ -50,19 +70,1183 @@ CellularComponent_GO:GO:0048196 CellularComponent_GO:GO:0009531 -is_a best=0 goo
                 edges.add(edge)
         self.assertEqual(2, len(edges))
 
+    def test_compact(self):
+        node = self.graph.nodes[u"GO:GO:0009531"]
+        self.assertFalse(hasattr(node, '__dict__'))
+        self.assertFalse(hasattr(node.edges[0], '__dict__'))
+        # Shared type strings, attributes only where there are some
+        types = set(id(e.type) for n in self.graph.nodes.values() for e in n.edges
+                    if e.type == u"is_a")
+        self.assertEqual(1, len(types))
+        self.assertTrue(node._attributes is None)
+        self.assertEqual([u"bar"], self.graph.nodes[u"GO:GO:0048196"].attributes[u"foo"])
+
+
+class TestWriteGraph(unittest.TestCase):
+    def setUp(self):
+        self.text = u"""Term_koira
+Term_koira Term_kissa is_related_to llr=10.2
+Term_kissa Term_hiiri is_related_to llr=12.0
+Term_hiiri Term_hiiri is_related_to
+# _attributes Term_koira lemma=koira+x
+"""
+        s = bmgraph_file.GraphObjectSink()
+        bmgraph_file.read_string(self.text, s)
+        self.graph = s.get_object()
+
+    def test_round_trip(self):
+        out = StringIO.StringIO()
+        bmgraph_file.write_graph(self.graph, out)
+        self.assertEqual(sorted(self.text.splitlines()),
+                         sorted(line.rstrip(u" ") for line in out.getvalue().splitlines()))
+        self.assertEqual(out.getvalue(), unicode(self.graph))
+
+    def test_edges_by_identity(self):
+        # Two edges that print the same are both written
+        n1 = self.graph.nodes[u"koira"]
+        e = n1.add_edge(self.graph.nodes[u"kissa"])
+        e.type = u"is_related_to"
+        e.attributes["llr"] = u"10.2"
+        lines = unicode(self.graph).splitlines()
+        self.assertEqual(2, lines.count(u"Term_koira Term_kissa is_related_to llr=10.2"))
+
+
+class TestGraphIndex(unittest.TestCase):
+    def setUp(self):
+        s = bmgraph_file.GraphObjectSink()
+        bmgraph_file.read_string(u"""Term_koira Term_kissa is_related_to llr=10.2
+Term_kissa Term_hiiri is_related_to llr=12.0
+Term_hiiri Term_hiiri is_related_to
+Term_koira Term_kissa is_related_to llr=11.0 note=x
+Term_koira Term_kissa -is_related_to
+""", s)
+        self.graph = s.get_object()
+        self.koira, self.kissa, self.hiiri = [self.graph.nodes[n] for n in
+                                              (u"koira", u"kissa", u"hiiri")]
+
+    def _edge_count(self):
+        return sum(len(n.edges) for n in self.graph.nodes.values())
+
+    def test_lookup(self):
+        e = self.graph.get_edge(self.koira, self.kissa, u"is_related_to")
+        self.assertTrue(e.n1 is self.koira)
+        self.assertTrue(self.graph.has_edge(self.koira, self.kissa, u"-is_related_to"))
+        self.assertFalse(self.graph.has_edge(self.kissa, self.koira, u"is_related_to"))
+        self.assertFalse(self.graph.has_edge(self.koira, self.hiiri, u"is_related_to"))
+        self.assertEqual(2, len(self.graph.edges_between(self.koira, self.kissa)))
+
+    def test_dedupe(self):
+        e = self.graph.get_edge(self.koira, self.kissa, u"is_related_to")
+        self.assertEqual([u"11.0"], e.attributes[u"llr"])
+        self.assertEqual([u"x"], e.attributes[u"note"])
+        self.assertEqual(8, self._edge_count())
+
+    def test_node_remove_edge(self):
+        e = self.graph.get_edge(self.kissa, self.hiiri, u"is_related_to")
+        self.kissa.remove_edge(e)
+        self.hiiri.remove_edge(e)
+        self.assertFalse(self.graph.has_edge(self.kissa, self.hiiri, u"is_related_to"))
+        self.assertEqual(6, self._edge_count())
+
+    def test_delete_edges(self):
+        self.assertEqual(2, self.graph.delete_edges(lambda e: u"llr" not in e.attributes))
+        self.assertFalse(self.graph.has_edge(self.hiiri, self.hiiri, u"is_related_to"))
+        self.assertEqual([], self.hiiri.edges[1:])
+        self.assertEqual(4, self._edge_count())
+
+    def test_delete_nodes(self):
+        self.assertEqual(1, self.graph.delete_nodes(lambda n: n.name == u"kissa"))
+        self.assertFalse(u"kissa" in self.graph.nodes)
+        self.assertEqual([], self.koira.edges)
+        self.assertEqual(2, len(self.hiiri.edges))
+        self.hiiri.delete()
+        self.assertEqual({}, self.graph._edges)
+
+
+class _RecordingSink(bmgraph_file.GraphSink):
+    def __init__(self):
+        self.calls = []
+    def special_node_read(self, *args):
+        self.calls.append(('special',) + args)
+    def edge_read(self, *args):
+        self.calls.append(('edge',) + args)
+    def node_attributes_read(self, *args):
+        self.calls.append(('attributes',) + args)
+    def comment_read(self, *args):
+        self.calls.append(('comment',) + args)
+
+
+class TestBatchedReading(unittest.TestCase):
+    def setUp(self):
+        self.text = u"""Term_koira
+plain
+Term_koira Term_kissa is_related_to llr=10.2 note=a+b
+x y t
+Term_hauki Term_käärme is_related_to  bad llr=3
+# _attributes Term_koira lemma=koira+x foo=bar
+# comment hello+world
+Term_koira Term_luu is_related_to"""
+
+    def _read(self, **kwargs):
+        s = _RecordingSink()
+        bmgraph_file.read_file_batched(StringIO.StringIO(self.text.encode('utf-8')), s, **kwargs)
+        return s.calls
+
+    def test_same_calls(self):
+        s = _RecordingSink()
+        bmgraph_file.read_string(self.text, s)
+        self.assertEqual(s.calls, self._read(batch_size=1, block_size=7))
+        self.assertEqual(sorted(s.calls), sorted(self._read()))
+        self.assertTrue(isinstance(self._read()[-1][1], unicode))
+
+    def test_parallel(self):
+        path = "/tmp/bmgdb_parallel_test_%i.bmg" % os.getpid()
+        with codecs.open(path, 'w', encoding="utf-8") as f:
+            f.write(self.text * 20)
+            f.write(u"\n" + _llr_graph)
+        try:
+            s = _RecordingSink()
+            with codecs.open(path, 'r', encoding="utf-8") as f:
+                bmgraph_file.read_file(f, s)
+            parallel = _RecordingSink()
+            bmgraph_file.read_file_parallel(path, parallel, processes=2, chunk_size=100)
+        finally:
+            os.unlink(path)
+        self.assertEqual([c for c in s.calls if c[0] == 'edge'],
+                         [c for c in parallel.calls if c[0] == 'edge'])
+        self.assertEqual(sorted(s.calls), sorted(parallel.calls))
+
+    def test_batches(self):
+        batches = []
+        class Sink(bmgraph_file.BatchGraphSink):
+            def edges_read(self, batch):
+                batches.append(len(batch))
+        bmgraph_file.read_file_batched(StringIO.StringIO(self.text.encode('utf-8')),
+                                       Sink(), batch_size=2)
+        self.assertEqual([2, 2], batches)
+
+
+def _graph_content(graph):
+    edges = sorted((unicode(e.n1), unicode(e.n2), e.type, sorted(e.attributes.items()))
+                   for n in graph.nodes.itervalues() for e in n.edges)
+    nodes = sorted((unicode(n), n.special_node, sorted(n.attributes.items()))
+                   for n in graph.nodes.itervalues())
+    return nodes, edges
+
+
+class TestBinaryGraph(unittest.TestCase):
+    def setUp(self):
+        self.text = u"""Term_koira
+plain
+Term_koira Term_kissa is_related_to llr=10.2 note=a+b note=c
+Term_kissa Term_h\u00e4\u00e4r\u00e4 is_related_to llr=12.0
+Term_hiiri Term_hiiri is_related_to
+Term_kissa Term_koira -is_related_to
+# _attributes Term_koira lemma=koira+x foo=bar
+"""
+        s = bmgraph_file.GraphObjectSink()
+        bmgraph_file.read_string(self.text, s)
+        self.graph = s.get_object()
+        self.path = "/tmp/bmgb_test_%i.bmgb" % os.getpid()
+        binary.write_bmgb(self.graph, self.path)
+        self.binary = binary.BinaryGraph(self.path)
+
+    def tearDown(self):
+        self.binary.close()
+        os.unlink(self.path)
+
+    def test_graph_api(self):
+        self.assertEqual(_graph_content(self.graph), _graph_content(self.binary))
+        self.assertEqual(len(self.graph.nodes), len(self.binary.nodes))
+        self.assertTrue(u"plain" in self.binary.nodes)
+        self.assertFalse(u"susi" in self.binary.nodes)
+        self.assertRaises(KeyError, lambda: self.binary.nodes[u"susi"])
+        koira = self.binary.nodes[u"koira"]
+        self.assertEqual(u"Term", koira.type)
+        self.assertEqual(None, self.binary.nodes[u"plain"].type)
+        self.assertEqual(set([u"kissa"]), set(e.other(koira).name for e in koira.edges))
+        # A loop is in the edges of its node twice, as in Graph
+        self.assertEqual(2, len(self.binary.nodes[u"hiiri"].edges))
+
+    def test_round_trip(self):
+        out = StringIO.StringIO()
+        binary.write_bmg(self.binary, out)
+        s = bmgraph_file.GraphObjectSink()
+        bmgraph_file.read_string(out.getvalue(), s)
+        self.assertEqual(_graph_content(self.graph), _graph_content(s.get_object()))
+
+    def test_duplicate_edges(self):
+        text = (u"Term_a Term_b rel llr=1.0\n"
+                u"Term_a Term_b rel llr=2.0\n")
+        path = self.path + ".dup"
+        out = StringIO.StringIO()
+        try:
+            binary.bmg_to_bmgb(StringIO.StringIO(text), path)
+            binary.bmgb_to_bmg(path, out)
+        finally:
+            os.unlink(path)
+        expected = _RecordingSink()
+        bmgraph_file.read_string(text, expected)
+        s = _RecordingSink()
+        bmgraph_file.read_string(out.getvalue(), s)
+        self.assertEqual(sorted(expected.calls), sorted(s.calls))
+
+    def test_not_binary(self):
+        self.assertRaises(ValueError, binary.BinaryGraph, __file__)
+
+
+_llr_graph = u"""Term_koira Term_kissa is_related_to llr=10.2
+Term_koira Term_luu is_related_to llr=9.5
+Term_hauki Term_koira is_related_to llr=31.0
+Term_kissa Term_hiiri is_related_to llr=12.0
+
+# _attributes Term_koira lemma=koira
+"""
+
+class TestCompressedFiles(unittest.TestCase):
+    def _path(self, extension):
+        return "/tmp/bmg_compressed_test_%i.bmg%s" % (os.getpid(), extension)
+
+    def _check(self, extension):
+        path = self._path(extension)
+        try:
+            with bmgraph_file.open_file(path, 'w', encoding='utf-8') as f:
+                f.write(_llr_graph * 3)
+            expected = _RecordingSink()
+            bmgraph_file.read_string(_llr_graph * 3, expected)
+            s = _RecordingSink()
+            with bmgraph_file.open_file(path) as f:
+                bmgraph_file.read_file_batched(f, s)
+            self.assertEqual(sorted(expected.calls), sorted(s.calls))
+            parallel = _RecordingSink()
+            bmgraph_file.read_file_parallel(path, parallel, processes=2, chunk_size=100)
+            self.assertEqual(sorted(expected.calls), sorted(parallel.calls))
+            if extension:
+                with open(path, 'rb') as f:
+                    self.assertNotEqual(_llr_graph[:10], f.read(10))
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_plain(self):
+        self._check('')
+
+    def test_gzip(self):
+        self._check('.gz')
+
+    def test_bzip2(self):
+        self._check('.bz2')
+
+    def test_commands(self):
+        for command, extension in (('xz', '.xz'), ('zstd', '.zst')):
+            if bmgraph_file._find_command(command) is None:
+                self.assertRaises(IOError, bmgraph_file.open_file, self._path(extension), 'w')
+            else:
+                self._check(extension)
+
+    def test_modes(self):
+        for mode in ('a', 'r+', 'ab'):
+            self.assertRaises(ValueError, bmgraph_file.open_file, self._path('.xz'), mode)
+
+    def test_failing_command(self):
+        bin_dir = tempfile.mkdtemp()
+        path = os.environ['PATH']
+        try:
+            with open(os.path.join(bin_dir, 'xz'), 'w') as f:
+                f.write("#!/bin/sh\ncat > /dev/null\nexit 1\n")
+            os.chmod(os.path.join(bin_dir, 'xz'), 0755)
+            os.environ['PATH'] = bin_dir + os.pathsep + path
+            def write(error):
+                with bmgraph_file.open_file(self._path('.xz'), 'w', encoding='utf-8') as f:
+                    f.write(_llr_graph)
+                    if error:
+                        raise KeyError(u"koira")
+            self.assertRaises(IOError, write, False)
+            # The error of the with block is not hidden by that of xz
+            self.assertRaises(KeyError, write, True)
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(bin_dir)
+            os.unlink(self._path('.xz'))
+
+
+def _memory_db(text=_llr_graph):
+    conn = sqlite3.connect(':memory:')
+    bmgraph_db.create_db(conn.cursor())
+    bmgraph_file.read_string(text, bmgraph_db.BMGraphDBSink(conn))
+    conn.commit()
+    return conn
+
+
+class TestNeighbourhood(unittest.TestCase):
+    def setUp(self):
+        self.conn = _memory_db()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_records(self):
+        records = bmgraph_db.neighbourhood(self.conn, u"koira")
+        self.assertEqual(3, len(records))
+        others = set([r.other(u"koira") for r in records])
+        self.assertEqual(set([u"kissa", u"luu", u"hauki"]), others)
+        for r in records:
+            self.assertEqual(u"Term", r.n1_type)
+            self.assertEqual(u"is_related_to", r.type)
+            self.assertEqual(r.attributes[u"llr"], r.weight())
+
+    def test_unknown_node(self):
+        self.assertEqual([], bmgraph_db.neighbourhood(self.conn, u"susi"))
+
+    def test_numeric_weights(self):
+        records = bmgraph_db.neighbourhood(self.conn, u"koira")
+        weights = sorted([r.weight() for r in records], reverse=True)
+        self.assertEqual([31.0, 10.2, 9.5], weights)
+
+
+class _CountingCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        self.connection.statements += 1
+        return sqlite3.Cursor.execute(self, *args)
+
+
+class _CountingConnection(bmgraph_db.GraphConnection):
+    statements = 0
+
+    def cursor(self):
+        return bmgraph_db.GraphConnection.cursor(self, _CountingCursor)
+
+
+class TestObjects(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:', factory=_CountingConnection)
+        self.conn.row_factory = sqlite3.Row
+        bmgraph_db.create_db(self.conn.cursor())
+        lines = [u"Term_hub Term_n%i is_related_to llr=%i" % (i, i) for i in range(100)]
+        bmgraph_file.read_string(u"\n".join(lines) + u"\n",
+                                 bmgraph_db.BMGraphDBSink(self.conn))
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_identity(self):
+        edges = bmgraph_db.edges(self.conn, u"hub")
+        hubs = set([id(e.n1) for e in edges])
+        self.assertEqual(1, len(hubs))
+        self.assertTrue(bmgraph_db.get_node(self.conn, edges.pop().n1.id) is
+                        bmgraph_db.get_node(self.conn, 1))
+
+    def test_edges_query_count(self):
+        self.conn.statements = 0
+        edges = bmgraph_db.edges(self.conn, u"hub")
+        for e in edges:
+            unicode(e)
+            unicode(e.n2)
+        self.assertEqual(100, len(edges))
+        self.assertTrue(self.conn.statements < 10)
+
+    def test_prefetch(self):
+        nodes = [bmgraph_db.Node(i, self.conn) for i in range(1, 11)]
+        self.conn.statements = 0
+        bmgraph_db.prefetch(self.conn, nodes)
+        self.assertEqual(2, self.conn.statements)
+        self.assertEqual(u"hub", nodes[0].an)
+        self.assertEqual(u"Term", nodes[9].type)
+        self.assertEqual(2, self.conn.statements)
+
+    def test_lazy(self):
+        n = bmgraph_db.Node(2, self.conn)
+        self.assertEqual(u"Term_n0", n.typed_name())
+        self.assertEqual(u"<Node #2 Term_n0>", repr(n))
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:', factory=bmgraph_db.InstrumentedConnection)
+        self.conn.row_factory = sqlite3.Row
+        bmgraph_db.create_db(self.conn.cursor())
+        lines = [u"Term_hub Term_n%i is_related_to llr=%i" % (i, i) for i in range(100)]
+        bmgraph_file.read_string(u"\n".join(lines) + u"\n",
+                                 bmgraph_db.BMGraphDBSink(self.conn))
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_calls(self):
+        stats = bmgraph_db.query_stats(self.conn, plans=False)
+        self.assertEqual(100, stats['BMGraphDBSink.edge_read']['calls'])
+        # create_db() is not a logical call
+        self.assertTrue(stats[None]['statements'] > 0)
+
+        bmgraph_db.reset_query_stats(self.conn)
+        for i in range(3):
+            edges = bmgraph_db.edges(self.conn, u"hub")
+            for e in edges:
+                unicode(e)
+        stats = bmgraph_db.query_stats(self.conn, plans=False)
+        self.assertEqual(['edges'], sorted(stats))
+        self.assertEqual(3, stats['edges']['calls'])
+        # No N+1: the statements don't grow with the number of edges
+        self.assertTrue(stats['edges']['statements_per_call'] <= 6)
+
+    def test_full_scans(self):
+        bmgraph_db.reset_query_stats(self.conn)
+        bmgraph_db.suggest(self.conn, u"n1", [])
+        bmgraph_db.top_neighbours(self.conn, u"hub", 5)
+        stats = bmgraph_db.query_stats(self.conn)
+        # The an LIKE scan reads the an_i index, not the table
+        self.assertEqual(['node_attribute'], stats['suggest']['full_scans'])
+        self.assertEqual([], stats['top_neighbours']['full_scans'])
+
+    def test_plan(self):
+        plan = bmgraph_db.query_plan(self.conn, 'SELECT * FROM node WHERE an = ?;', (u"hub",))
+        self.assertEqual([], bmgraph_db.full_scans(plan))
+        self.assertEqual(None, bmgraph_db.query_plan(self.conn, 'PRAGMA user_version;'))
+
+    def test_plan_formats(self):
+        for prefix in ('SCAN ', 'SCAN TABLE '):
+            plan = [prefix + 'edge',
+                    prefix + 'node USING COVERING INDEX an_i',
+                    prefix + 'node_fts VIRTUAL TABLE INDEX 0:',
+                    prefix + 'node_fts VIRTUAL TABLE INDEX 0:L0',
+                    prefix + 'sqlite_master',
+                    'SEARCH %snode USING INDEX an_i (an=?)' % prefix[5:],
+                    'SCAN CONSTANT ROW']
+            self.assertEqual(['edge', 'node_fts'], bmgraph_db.full_scans(plan))
+
+
+class TestAdjacency(unittest.TestCase):
+    def setUp(self):
+        self.conn = _memory_db()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_sink_matches_rebuild(self):
+        c = self.conn.cursor()
+        q = 'SELECT * FROM adjacency ORDER BY node_id, edge_id;'
+        c.execute(q)
+        from_sink = c.fetchall()
+        bmgraph_db.build_adjacency(c)
+        c.execute(q)
+        self.assertEqual(8, len(from_sink))
+        self.assertEqual(from_sink, c.fetchall())
+
+    def test_numeric_order(self):
+        neighbours = bmgraph_db.top_neighbours(self.conn, u"koira", 10)
+        self.assertEqual([u"hauki", u"kissa", u"luu"],
+                         [n.an for n in neighbours])
+        self.assertEqual(31.0, neighbours[0].weight)
+
+    def test_limit(self):
+        neighbours = bmgraph_db.top_neighbours(self.conn, u"koira", 1)
+        self.assertEqual([u"hauki"], [n.an for n in neighbours])
+
+    def test_min_weight(self):
+        neighbours = bmgraph_db.top_neighbours(self.conn, u"koira", 10, 10.0)
+        self.assertEqual([u"hauki", u"kissa"], [n.an for n in neighbours])
+
+    def test_loop(self):
+        conn = _memory_db(_llr_graph + u"Term_koira Term_koira is_related_to llr=50.0\n")
+        neighbours = bmgraph_db.top_neighbours(conn, u"koira", 10)
+        self.assertEqual([u"hauki", u"kissa", u"luu"], [n.an for n in neighbours])
+        conn.close()
+
+    def test_index_scan(self):
+        c = self.conn.cursor()
+        c.execute('''EXPLAIN QUERY PLAN SELECT neighbour_id FROM adjacency
+        WHERE node_id = 1 ORDER BY weight DESC LIMIT 5;''')
+        plan = " ".join([row[-1] for row in c])
+        self.assertTrue("COVERING INDEX adjacency_i" in plan)
+        self.assertTrue("TEMP B-TREE" not in plan)
+
+    def test_hops(self):
+        reached = bmgraph_db.hop_neighbourhood(self.conn, u"hauki", 3, 10)
+        self.assertEqual([(u"koira", 1, 31.0), (u"kissa", 2, 10.2), (u"luu", 2, 9.5),
+                          (u"hiiri", 3, 12.0)],
+                         [(n.an, n.hop, n.weight) for n in reached])
+        reached = bmgraph_db.hop_neighbourhood(self.conn, u"hauki", 2, 10)
+        self.assertEqual([u"koira", u"kissa", u"luu"], [n.an for n in reached])
+        self.assertEqual([], bmgraph_db.hop_neighbourhood(self.conn, u"susi", 2, 10))
+
+    def test_hop_budget(self):
+        reached = bmgraph_db.hop_neighbourhood(self.conn, u"hauki", 3, 2)
+        self.assertEqual([u"koira", u"kissa"], [n.an for n in reached])
+        reached = bmgraph_db.hop_neighbourhood(self.conn, u"hauki", 3, 10, 10.0)
+        self.assertEqual([u"koira", u"kissa", u"hiiri"], [n.an for n in reached])
+
+    def test_hop_paths_meet(self):
+        # b and c reach each other again on the second hop
+        conn = _memory_db(u"""Term_a Term_b is_related_to llr=3.0
+Term_a Term_c is_related_to llr=2.0
+Term_b Term_c is_related_to llr=5.0
+Term_c Term_d is_related_to llr=1.0
+""")
+        reached = bmgraph_db.hop_neighbourhood(conn, u"a", 2, 3)
+        self.assertEqual([(u"b", 1, 3.0), (u"c", 1, 2.0), (u"d", 2, 1.0)],
+                         [(n.an, n.hop, n.weight) for n in reached])
+        conn.close()
+
+
+class TestMigration(unittest.TestCase):
+    def setUp(self):
+        # A database as created before schema version 1
+        self.conn = _memory_db()
+        c = self.conn.cursor()
+        for table, key in (('node_attribute', 'node_id'), ('edge_attribute', 'edge_id')):
+            c.execute('ALTER TABLE %s RENAME TO old;' % table)
+            c.execute('''CREATE TABLE %s (%s INTEGER, name TEXT, bool_value TEXT,
+            text_value TEXT);''' % (table, key))
+            c.execute('''INSERT INTO %s SELECT %s, name, bool_value, text_value
+            FROM old;''' % (table, key))
+            c.execute('DROP TABLE old;')
+        c.execute('PRAGMA user_version=0;')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _weights(self):
+        records = bmgraph_db.neighbourhood(self.conn, u"koira")
+        return sorted([r.weight() for r in records], reverse=True)
+
+    def test_legacy_reads(self):
+        self.assertEqual([31.0, 10.2, 9.5], self._weights())
+        bmgraph_db.build_adjacency(self.conn.cursor())
+        neighbours = bmgraph_db.top_neighbours(self.conn, u"koira", 10)
+        self.assertEqual([31.0, 10.2, 9.5], [n.weight for n in neighbours])
+
+    def test_migrate(self):
+        bmgraph_db.migrate_db(self.conn)
+        self.assertEqual(bmgraph_db.SCHEMA_VERSION,
+                         bmgraph_db.schema_version(self.conn))
+        c = self.conn.cursor()
+        c.execute('''SELECT count(*) FROM edge_attribute
+        WHERE name = 'llr' AND real_value > 10;''')
+        self.assertEqual(3, c.fetchone()[0])
+        c.execute('''SELECT real_value FROM node_attribute;''')
+        self.assertEqual([None], [row[0] for row in c])
+        self.assertEqual([31.0, 10.2, 9.5], self._weights())
+
+    def test_legacy_non_numeric(self):
+        self.conn.execute("UPDATE edge_attribute SET text_value = 'n/a' WHERE text_value = '9.5';")
+        legacy = self._weights()
+        bmgraph_db.build_adjacency(self.conn.cursor())
+        neighbours = bmgraph_db.top_neighbours(self.conn, u"koira", 10)
+        self.assertEqual([31.0, 10.2, None], [n.weight for n in neighbours])
+        bmgraph_db.migrate_db(self.conn)
+        self.assertEqual(self._weights(), legacy)
+
+    def test_sink_migrates(self):
+        for sink in (bmgraph_db.BMGraphDBSink, bmgraph_db.BMGraphDBBulkSink):
+            self.setUp()
+            s = sink(self.conn)
+            bmgraph_file.read_string("Term_susi Term_koira is_related_to llr=2.5\n", s)
+            if sink is bmgraph_db.BMGraphDBBulkSink:
+                s.flush()
+            self.assertEqual(bmgraph_db.SCHEMA_VERSION,
+                             bmgraph_db.schema_version(self.conn))
+            self.assertEqual([31.0, 10.2, 9.5, 2.5], self._weights())
+            self.tearDown()
+
+    def test_sink_after_migration(self):
+        bmgraph_db.migrate_db(self.conn)
+        s = bmgraph_db.BMGraphDBSink(self.conn)
+        bmgraph_file.read_string("Term_susi Term_koira is_related_to llr=2.5\n", s)
+        self.assertEqual([31.0, 10.2, 9.5, 2.5], self._weights())
+
+
+class TestCrawler(unittest.TestCase):
+    def setUp(self):
+        self.conn = _memory_db()
+        s = bmgraph_file.GraphObjectSink()
+        bmgraph_file.read_string(_llr_graph, s)
+        self.graph = s.get_object()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _crawl(self, *args, **kwargs):
+        """Returns the nodes and edges of the crawl, checking that it is
+        the same on the database and on the Graph."""
+        ret = []
+        for graph in (self.conn, self.graph):
+            g = crawler.crawl(graph, *args, **kwargs)
+            edges = set((e.n1.name, e.n2.name) for n in g.nodes.values() for e in n.edges)
+            ret.append((set(g.nodes), edges))
+            for an in args[0]:
+                self.assertTrue(g.nodes[an].special_node)
+        self.assertEqual(ret[0], ret[1])
+        return ret[0]
+
+    def test_neighborhood(self):
+        nodes, edges = self._crawl([u"koira"], 'neighborhood', max_nodes=3)
+        self.assertEqual(set([u"koira", u"hauki", u"kissa"]), nodes)
+        self.assertEqual(set([(u"hauki", u"koira"), (u"koira", u"kissa")]), edges)
+        nodes, edges = self._crawl([u"koira"], 'neighborhood', mingoodness=0.91)
+        self.assertEqual(set([u"koira", u"hauki", u"kissa", u"hiiri"]), nodes)
+
+    def test_connection_subgraph(self):
+        nodes, edges = self._crawl([u"hauki", u"hiiri"])
+        self.assertEqual(set([u"hauki", u"koira", u"kissa", u"hiiri"]), nodes)
+        self.assertEqual(3, len(edges))
+        # The path doesn't fit, is too long or passes through a hub
+        for kwargs in (dict(max_nodes=3), dict(maxdepth=2), dict(maxnodedegree=2)):
+            self.assertEqual((set([u"hauki", u"hiiri"]), set()),
+                             self._crawl([u"hauki", u"hiiri"], **kwargs))
+
+    def test_maxdepth_detour(self):
+        # The best path to c is two edges long, so d is only reached within
+        # two edges over the worse edge a-c
+        text = u"""Term_a Term_b is_related_to goodness=0.99
+Term_b Term_c is_related_to goodness=0.99
+Term_a Term_c is_related_to goodness=0.5
+Term_c Term_d is_related_to goodness=0.9
+"""
+        self.conn.close()
+        self.conn = _memory_db(text)
+        s = bmgraph_file.GraphObjectSink()
+        bmgraph_file.read_string(text, s)
+        self.graph = s.get_object()
+        nodes, edges = self._crawl([u"a"], 'neighborhood', maxdepth=2)
+        self.assertEqual(set([u"a", u"b", u"c", u"d"]), nodes)
+        nodes, edges = self._crawl([u"a", u"d"], maxdepth=2)
+        self.assertEqual(set([u"a", u"c", u"d"]), nodes)
+        self.assertEqual(set([(u"a", u"c"), (u"c", u"d")]), edges)
+        nodes, edges = self._crawl([u"a", u"d"])
+        self.assertEqual(set([u"a", u"b", u"c", u"d"]), nodes)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, crawler.crawl, self.conn, [])
+        self.assertRaises(ValueError, crawler.crawl, self.conn, [u"koira"], 'other')
+
+
+_fake_crawler = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in -outfile) out="$2"; shift;; esac
+    shift
+done
+read nodes
+case "$nodes" in *slow*) exec sleep 10;; esac
+for n in $nodes; do echo "Term_$n"; done > "$out"
+"""
+
+class TestCrawlBatch(unittest.TestCase):
+    def setUp(self):
+        self.path = "/tmp/bmgdb_crawl_test_%i.db" % os.getpid()
+        conn = sqlite3.connect(self.path)
+        bmgraph_db.create_db(conn.cursor())
+        bmgraph_file.read_string(_llr_graph, bmgraph_db.BMGraphDBSink(conn))
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_native(self):
+        query_sets = crawler.read_query_sets(StringIO.StringIO(
+            u"# theme\nkoira\n\nhauki hiiri\n"))
+        self.assertEqual([[u"koira"], [u"hauki", u"hiiri"]], query_sets)
+        results = sorted(crawler.crawl_batch(self.path, query_sets, processes=2,
+                                             params={'mode': 'neighborhood',
+                                                     'max_nodes': 3}))
+        self.assertEqual(['ok', 'ok'], [r.status for r in results])
+        self.assertEqual(3, results[0].graph.count(u"\n"))
+        self.assertTrue(u"Term_koira" in results[1].graph)
+        self.assertTrue(u"Term_kissa" not in results[1].graph)
+        self.assertRaises(ValueError, crawler.crawl_batch, self.path, query_sets,
+                          params={'max_st_pairs': 2})
+
+    def test_native_timeout(self):
+        results = list(crawler.crawl_batch(self.path, [[u"koira", u"hiiri"]], processes=1,
+                                           params={'max_query_time': 30}, timeout=0))
+        self.assertEqual(['timeout'], [r.status for r in results])
+        self.assertTrue(results[0].seconds < 5)
+        self.assertTrue(u"Term_koira" in results[0].graph)
+        self.assertTrue(u"max_query_time" in results[0].log)
+
+    def test_external(self):
+        bin_dir = tempfile.mkdtemp()
+        path = os.environ['PATH']
+        try:
+            with open(os.path.join(bin_dir, 'crawler'), 'w') as f:
+                f.write(_fake_crawler)
+            os.chmod(os.path.join(bin_dir, 'crawler'), 0755)
+            os.environ['PATH'] = bin_dir + os.pathsep + path
+            results = sorted(crawler.crawl_batch("graph.bmg", [[u"koira"], [u"slow"]],
+                                                 processes=2, external=True, timeout=1))
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(bin_dir)
+        self.assertEqual(['ok', 'timeout'], [r.status for r in results])
+        self.assertEqual(u"Term_koira\n", results[0].graph)
+        self.assertTrue(u"# Killed" in results[1].log)
+
+
+class TestBulkBuild(unittest.TestCase):
+    def setUp(self):
+        self.bmg_file = "/tmp/bmgdb_bulk_test_%i.bmg" % os.getpid()
+        with codecs.open(self.bmg_file, 'w', encoding="utf-8") as f:
+            f.write(u"Term_koira\n" + _llr_graph)
+
+    def tearDown(self):
+        os.unlink(self.bmg_file)
+
+    def _build(self, bulk):
+        conn = sqlite3.connect(':memory:')
+        bmgraph_db.build_db(conn, self.bmg_file, bulk=bulk)
+        return conn
+
+    def test_same_contents(self):
+        plain = self._build(False)
+        bulk = self._build(True)
+        for conn in (plain, bulk):
+            c = conn.cursor()
+            self.assertEqual(5, bmgraph_db.node_count(c))
+            self.assertEqual(4, bmgraph_db.edge_count(c))
+            self.assertEqual(4, bmgraph_db.edge_attribute_count(c))
+            self.assertEqual(2, bmgraph_db.node_attribute_count(c))
+        self.assertEqual(bmgraph_db.neighbourhood(plain, u"koira"),
+                         bmgraph_db.neighbourhood(bulk, u"koira"))
+        self.assertEqual(bmgraph_db.top_neighbours(plain, u"kissa", 5),
+                         bmgraph_db.top_neighbours(bulk, u"kissa", 5))
+        self.assertEqual(plain.isolation_level, bulk.isolation_level)
+
+    def test_failure_restores_settings(self):
+        conn = sqlite3.connect(':memory:')
+        c = conn.cursor()
+        c.execute('PRAGMA synchronous;')
+        synchronous = c.fetchone()[0]
+        self.assertRaises(IOError, bmgraph_db.build_db, conn,
+                          self.bmg_file + ".missing", bulk=True)
+        c.execute('PRAGMA synchronous;')
+        self.assertEqual(synchronous, c.fetchone()[0])
+        self.assertEqual('', conn.isolation_level)
+        # create_db() ran in the bulk transaction, which was rolled back
+        self.assertFalse(bmgraph_db.has_table(conn, 'node'))
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.bmg_file = "/tmp/bmgdb_ingest_test_%i.bmg" % os.getpid()
+        with codecs.open(self.bmg_file, 'w', encoding="utf-8") as f:
+            f.write(u"""Term_koira Term_kissa is_related_to llr=40.0 source=ingest
+Term_koira Term_susi is_related_to llr=15.0
+
+# _attributes Term_koira lemma=koiruli
+""")
+        self.conn = _memory_db()
+        bmgraph_db.build_adjacency(self.conn.cursor())
+        bmgraph_db.build_fts(self.conn.cursor())
+
+    def tearDown(self):
+        self.conn.close()
+        os.unlink(self.bmg_file)
+
+    def test_merge(self):
+        self.assertEqual(1, bmgraph_db.ingest_db(self.conn, self.bmg_file))
+        self.assertEqual(0, bmgraph_db.ingest_db(self.conn, self.bmg_file))
+        c = self.conn.cursor()
+        self.assertEqual(5, bmgraph_db.edge_count(c))
+        self.assertEqual(6, bmgraph_db.edge_attribute_count(c))
+        neighbours = bmgraph_db.top_neighbours(self.conn, u"koira", 10)
+        self.assertEqual([(u"kissa", 40.0), (u"hauki", 31.0), (u"susi", 15.0), (u"luu", 9.5)],
+                         [(n.an, n.weight) for n in neighbours])
+        self.assertEqual([u"koira"], [n.an for n in bmgraph_db.suggest(
+                    self.conn, u"koiruli", ["lemma"])])
+        c.execute("SELECT text FROM node_fts WHERE name = 'lemma';")
+        self.assertEqual([u"koiruli"], [row[0] for row in c])
+
+
+    def test_new_db(self):
+        conn = sqlite3.connect(':memory:')
+        self.assertEqual(2, bmgraph_db.ingest_db(conn, self.bmg_file))
+        self.assertEqual(bmgraph_db.SCHEMA_VERSION, bmgraph_db.schema_version(conn))
+        self.assertEqual(2, bmgraph_db.edge_count(conn.cursor()))
+        conn.close()
+    def test_fts_update_exact(self):
+        s = bmgraph_db.BMGraphDBSink(self.conn)
+        s.node_attributes_read(u"kissa", u"Term", {u"lemma": u"ko_ra"})
+        s.node_attributes_read(u"kissa", u"Term", {u"lemma": u"mirri"})
+        c = self.conn.cursor()
+        c.execute("SELECT text FROM node_fts WHERE name = 'lemma' ORDER BY text;")
+        # The koira row matches the old value as a LIKE pattern but stays
+        self.assertEqual([u"koira", u"mirri"], [row[0] for row in c])
+
+    def test_untyped_edges(self):
+        s = bmgraph_db.BMGraphDBSink(self.conn)
+        for i in range(2):
+            s.edge_read(u"koira", u"Term", u"susi", u"Term", None, {u"llr": u"3.0"})
+        self.assertEqual(1, s.edges_created)
+        self.assertEqual(5, bmgraph_db.edge_count(self.conn.cursor()))
+
+    def test_migrate_duplicates(self):
+        c = self.conn.cursor()
+        c.execute('DROP INDEX edge_i;')
+        c.execute('''INSERT INTO edge (n1_id, n2_id, type)
+        SELECT n1_id, n2_id, type FROM edge WHERE id = 1;''')
+        c.execute('''INSERT INTO edge_attribute (edge_id, name, text_value, real_value)
+        VALUES (?, 'llr', '20.0', 20.0);''', (c.lastrowid,))
+        c.execute('PRAGMA user_version=1;')
+        bmgraph_db.migrate_db(self.conn)
+        self.assertEqual(4, bmgraph_db.edge_count(c))
+        self.assertEqual(4, bmgraph_db.edge_attribute_count(c))
+        neighbours = bmgraph_db.top_neighbours(self.conn, u"koira", 10)
+        self.assertEqual([31.0, 20.0, 9.5], [n.weight for n in neighbours])
+        self.assertRaises(sqlite3.IntegrityError, c.execute,
+                          '''INSERT INTO edge (n1_id, n2_id, type)
+                          SELECT n1_id, n2_id, type FROM edge WHERE id = 1;''')
+
+
+class TestPrune(unittest.TestCase):
+    def setUp(self):
+        self.conn = _memory_db()
+        self.pruned_file = "/tmp/bmgdb_prune_test_%i.db" % os.getpid()
+
+    def tearDown(self):
+        self.conn.close()
+        if os.path.exists(self.pruned_file):
+            os.unlink(self.pruned_file)
+
+    def _pruned(self, **kwargs):
+        bmgraph_db.prune_db(self.conn, self.pruned_file, **kwargs)
+        return sqlite3.connect(self.pruned_file)
+
+    def test_top_k(self):
+        # koira keeps hauki, kissa keeps hiiri, every other node keeps koira
+        pruned = self._pruned(k=1)
+        self.assertEqual(3, bmgraph_db.edge_count(pruned.cursor()))
+        self.assertEqual([31.0, 9.5], [n.weight for n in
+                                       bmgraph_db.top_neighbours(pruned, u"koira", 10)])
+        self.assertEqual(1, bmgraph_db.node_attribute_count(pruned.cursor()))
+        self.assertEqual(bmgraph_db.SCHEMA_VERSION, bmgraph_db.schema_version(pruned))
+        pruned.close()
+
+    def test_min_weight(self):
+        pruned = self._pruned(min_weight=11)
+        self.assertEqual(2, bmgraph_db.edge_count(pruned.cursor()))
+        self.assertEqual(4, bmgraph_db.node_count(pruned.cursor()))
+        self.assertEqual([u"hauki"], [n.an for n in
+                                      bmgraph_db.top_neighbours(pruned, u"koira", 10)])
+        pruned.close()
+
+    def test_bktree(self):
+        bmgraph_db.build_bktree(self.conn.cursor())
+        pruned = self._pruned(min_weight=11)
+        # luu was pruned away, so it is no longer found
+        self.assertEqual([(1, u"hauki")],
+                         bmgraph_db.fuzzy_lookup(pruned, u"hauku", 1))
+        self.assertEqual([], bmgraph_db.fuzzy_lookup(pruned, u"luu", 1))
+        pruned.close()
+
+    def test_degree_distribution(self):
+        nodes, max_degree, mean_degree, bins = bmgraph_db.degree_distribution(self.conn)
+        self.assertEqual(5, nodes)
+        self.assertEqual(3, max_degree)
+        self.assertEqual(8 / 5.0, mean_degree)
+        self.assertEqual([(0, 0, 0), (1, 1, 3), (2, 3, 2)], bins)
+
+    def test_arguments(self):
+        self.assertRaises(ValueError, bmgraph_db.prune_db, self.conn, self.pruned_file)
+
+
+class TestBKTree(unittest.TestCase):
+    def setUp(self):
+        self.conn = _memory_db()
+        bmgraph_db.build_bktree(self.conn.cursor())
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_levenshtein(self):
+        self.assertEqual(0, bmgraph_db.levenshtein(u"Koira", u"koira"))
+        self.assertEqual(1, bmgraph_db.levenshtein(u"koira", u"koiria"))
+        self.assertEqual(3, bmgraph_db.levenshtein(u"kissa", u"koira"))
+
+    def test_lookup(self):
+        self.assertEqual([(1, u"kissa")],
+                         bmgraph_db.fuzzy_lookup(self.conn, u"kisa", 1))
+        self.assertEqual([(0, u"koira")],
+                         bmgraph_db.fuzzy_lookup(self.conn, u"Koira", 2))
+
+    def _check_linear_scan(self, queries=(u"hiiri", u"hauka", u"luuta", u"x")):
+        c = self.conn.cursor()
+        c.execute('SELECT an FROM node;')
+        names = [row[0] for row in c]
+        for query in queries:
+            for k in range(4):
+                expected = sorted([(bmgraph_db.levenshtein(query, an), an)
+                                   for an in names])
+                expected = [t for t in expected if t[0] <= k]
+                self.assertEqual(expected,
+                                 bmgraph_db.fuzzy_lookup(self.conn, query, k))
+
+    def test_matches_linear_scan(self):
+        self._check_linear_scan()
+
+    def test_sinks(self):
+        bmgraph_file.read_string(u"Term_koira Term_koiras is_related_to\n",
+                                 bmgraph_db.BMGraphDBSink(self.conn))
+        sink = bmgraph_db.BMGraphDBBulkSink(self.conn)
+        bmgraph_file.read_string(u"Term_hiiri Term_hiirulainen is_related_to\n", sink)
+        sink.flush()
+        self.assertEqual([(0, u"koiras")],
+                         bmgraph_db.fuzzy_lookup(self.conn, u"koiras", 0))
+        self._check_linear_scan((u"koiras", u"hiirulainen", u"hiiri", u"x"))
+
+
+class TestSample(unittest.TestCase):
+    def setUp(self):
+        self.conn = _memory_db()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_distinct(self):
+        for weighted in (False, True):
+            nodes = bmgraph_db.sample(self.conn, 4, weighted=weighted)
+            self.assertEqual(4, len(set([n.id for n in nodes])))
+
+    def test_all(self):
+        nodes = bmgraph_db.sample(self.conn, 10)
+        self.assertEqual(5, len(nodes))
+
+    def test_weighted(self):
+        sampler = bmgraph_db.NodeSampler(self.conn, weighted=True)
+        counts = {}
+        for i in range(6000):
+            id = sampler.ids[sampler._draw_index()]
+            counts[id] = counts.get(id, 0) + 1
+        # koira has degree 3 out of a total of 8
+        c = self.conn.cursor()
+        c.execute('SELECT id FROM node WHERE an=?;', (u"koira",))
+        koira = c.fetchone()[0]
+        self.assertTrue(abs(counts[koira] / 6000.0 - 3 / 8.0) < 0.05)
+
+    def test_cache(self):
+        path = "/tmp/bmgdb_sample_test_%i.db" % os.getpid()
+        conn = sqlite3.connect(path)
+        try:
+            bmgraph_db.create_db(conn.cursor())
+            bmgraph_file.read_string(_llr_graph, bmgraph_db.BMGraphDBSink(conn))
+            conn.commit()
+            sampler = bmgraph_db.get_sampler(conn)
+            other = sqlite3.connect(path)
+            self.assertTrue(sampler is bmgraph_db.get_sampler(other))
+            other.close()
+        finally:
+            conn.close()
+            os.unlink(path)
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.path = "/tmp/bmgdb_pool_test_%i.db" % os.getpid()
+        conn = sqlite3.connect(self.path)
+        bmgraph_db.create_db(conn.cursor())
+        bmgraph_file.read_string(_llr_graph, bmgraph_db.BMGraphDBSink(conn))
+        conn.commit()
+        conn.close()
+        self.pool = bmgraph_db.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        os.unlink(self.path)
+
+    def test_reuse(self):
+        conn = self.pool.get(self.path)
+        self.assertTrue(conn is self.pool.get(self.path))
+        self.assertEqual(3, len(bmgraph_db.neighbourhood(conn, u"koira")))
+
+    def test_per_thread(self):
+        import threading
+        conns = []
+        t = threading.Thread(target=lambda: conns.append(self.pool.get(self.path)))
+        t.start()
+        t.join()
+        self.assertFalse(conns[0] is self.pool.get(self.path))
+
+    def test_read_only(self):
+        conn = self.pool.get(self.path)
+        self.assertRaises(sqlite3.OperationalError, conn.execute,
+                          'DELETE FROM node;')
+
+    def test_missing(self):
+        self.assertRaises(IOError, self.pool.get, self.path + ".missing")
+        self.assertFalse(os.path.exists(self.path + ".missing"))
+
+    def test_immutable(self):
+        pool = bmgraph_db.ConnectionPool(bmgraph_db.open_immutable)
+        conn = pool.get(self.path)
+        self.assertFalse(conn is self.pool.get(self.path))
+        self.assertEqual(bmgraph_db.SHARED_MMAP_SIZE,
+                         conn.execute('PRAGMA mmap_size;').fetchone()[0])
+        self.assertEqual(3, len(bmgraph_db.edges(conn, u"koira")))
+        self.assertRaises(sqlite3.OperationalError, conn.execute,
+                          'DELETE FROM node;')
+        pool.close()
+
+
+_endless_query = '''WITH RECURSIVE c (x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c)
+SELECT count(*) FROM c;'''
+
+class TestGraphReader(unittest.TestCase):
+    def setUp(self):
+        self.path = "/tmp/bmgdb_reader_test_%i.db" % os.getpid()
+        conn = sqlite3.connect(self.path)
+        bmgraph_db.create_db(conn.cursor())
+        bmgraph_file.read_string(_llr_graph, bmgraph_db.BMGraphDBSink(conn))
+        conn.commit()
+        conn.close()
+        self.reader = reader.GraphReader(self.path, workers=1)
+
+    def tearDown(self):
+        self.reader.close()
+        os.unlink(self.path)
+
+    def test_queries(self):
+        edges = self.reader.edges(u"koira")
+        nodes = self.reader.sample(5)
+        suggested = self.reader.suggest(u"koira", [u"lemma"])
+        self.assertEqual(set([u"kissa", u"luu", u"hauki"]),
+                         set([e.n2.an if e.n1.an == u"koira" else e.n1.an
+                              for e in edges.result(5)]))
+        self.assertEqual(5, len(nodes.result(5)))
+        self.assertEqual([u"koira"], [n.an for n in suggested.result(5)])
+        self.assertTrue(edges.done())
+
+    def test_unknown_node(self):
+        self.assertEqual(None, self.reader.edges(u"zzz").result(5))
+
+    def test_timeout(self):
+        slow = self.reader.submit(lambda c: c.execute(_endless_query).fetchone(),
+                                  timeout=0.1)
+        self.assertRaises(reader.QueryTimeout, slow.result, 5)
+        self.assertEqual(3, len(self.reader.edges(u"koira").result(5)))
+
+    def test_cancel(self):
+        done = []
+        slow = self.reader.submit(lambda c: c.execute(_endless_query).fetchone())
+        pending = self.reader.edges(u"koira")
+        pending.add_done_callback(done.append)
+        self.assertRaises(reader.QueryTimeout, slow.result, 0.1)
+        self.assertTrue(pending.cancel())
+        self.assertEqual([pending], done)
+        self.assertTrue(slow.cancel())
+        self.assertRaises(reader.QueryCancelled, slow.result)
+        self.assertEqual(3, len(self.reader.edges(u"koira").result(5)))
+
+
+@unittest.skipIf(csrgraph is None, "NumPy is not installed")
+class TestCSRGraph(unittest.TestCase):
+    def setUp(self):
+        self.conn = _memory_db()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def _check(self, graph):
+        self.assertEqual(5, len(graph))
+        self.assertEqual(3, graph.degree(u"koira"))
+        for an in (u"koira", u"kissa", u"hiiri"):
+            expected = [(n.an, n.weight)
+                        for n in bmgraph_db.top_neighbours(self.conn, an, 10)]
+            got = graph.neighbours_of(an)
+            self.assertEqual([t[0] for t in expected], [t[0] for t in got])
+            for e, g in zip(expected, got):
+                self.assertAlmostEqual(e[1], g[1], places=4)
+        self.assertEqual([u"hauki"], [t[0] for t in graph.neighbours_of(u"koira", 1)])
+        self.assertEqual(None, graph.neighbours_of(u"susi"))
+
+    def test_from_adjacency(self):
+        self._check(csrgraph.CSRGraph.from_db(self.conn))
+
+    def test_hops(self):
+        graph = csrgraph.CSRGraph.from_db(self.conn)
+        for args in ((3, 10), (2, 10), (3, 2), (3, 10, 10.0)):
+            expected = [(n.an, n.hop, n.weight)
+                        for n in bmgraph_db.hop_neighbourhood(self.conn, u"hauki", *args)]
+            got = graph.hop_neighbours_of(u"hauki", *args)
+            self.assertEqual([t[:2] for t in expected], [t[:2] for t in got])
+            for e, g in zip(expected, got):
+                self.assertAlmostEqual(e[2], g[2], places=4)
+
+    def test_unweighted_hops(self):
+        conn = _memory_db(u"Term_a Term_b is_related_to\nTerm_b Term_c is_related_to\n")
+        graph = csrgraph.CSRGraph.from_db(conn)
+        self.assertEqual([(u"b", 1, None), (u"c", 2, None)],
+                         graph.hop_neighbours_of(u"a", 2, 10))
+        self.assertEqual([(n.an, n.hop, n.weight)
+                          for n in bmgraph_db.hop_neighbourhood(conn, u"a", 2, 10)],
+                         graph.hop_neighbours_of(u"a", 2, 10))
+        conn.close()
+
+    def test_from_edges(self):
+        expected = csrgraph.CSRGraph.from_db(self.conn)
+        self.conn.execute('DROP TABLE adjacency;')
+        graph = csrgraph.CSRGraph.from_db(self.conn)
+        self.assertEqual(list(expected.offsets), list(graph.offsets))
+        self.assertEqual(list(expected.neighbours), list(graph.neighbours))
+        self.assertEqual(list(expected.weights), list(graph.weights))
+
+
+@unittest.skipIf(generate_poem is None, "generate_poem is not importable")
+class TestThemeWords(unittest.TestCase):
+    def setUp(self):
+        self.path = "/tmp/bmgdb_theme_test_%i.db" % os.getpid()
+        conn = sqlite3.connect(self.path)
+        bmgraph_db.create_db(conn.cursor())
+        bmgraph_file.read_string(_llr_graph, bmgraph_db.BMGraphDBSink(conn))
+        conn.commit()
+        conn.close()
+        self.backends = ['sqlite']
+        if generate_poem.csrgraph is not None:
+            self.backends.append('memory')
+
+    def tearDown(self):
+        # generate_poem has its own copies of these modules, via bmgraph
+        generate_poem.bmgraph.db._pool.close()
+        generate_poem.bmgraph.db._immutable_pool.close()
+        if generate_poem.csrgraph is not None:
+            generate_poem.csrgraph._graphs.pop(self.path, None)
+        os.unlink(self.path)
+
+    def test_get_nodes(self):
+        for backend in self.backends:
+            nodes = generate_poem.get_nodes(self.path, u"koira", backend)
+            self.assertEqual([u"hauki", u"kissa", u"luu"], [n[0] for n in nodes])
+            self.assertAlmostEqual(31.0, nodes[0][1], places=4)
+            self.assertEqual(None, generate_poem.get_nodes(self.path, u"susi", backend))
+
+    def test_theme_based_words(self):
+        for backend in self.backends:
+            themes, goodness = generate_poem.theme_based_words(u"koira", self.path, 2,
+                                                               backend)
+            self.assertEqual([u"koira", u"hauki", u"kissa", u"luu"], themes)
+            self.assertEqual((u"hauki", 31.0), goodness[1])
+            # hiiri has one neighbour, so words two and three hops away are added
+            themes, goodness = generate_poem.theme_based_words(u"hiiri", self.path, 3,
+                                                               backend)
+            self.assertEqual([u"hiiri", u"kissa", u"koira", u"hauki"], themes)
+            self.assertEqual([], generate_poem.theme_based_words(u"susi", self.path, 3,
+                                                                 backend))
+
 
 class TestSuggestAttributes(unittest.TestCase):
     def setUp(self):
         self.conn = sqlite3.connect(':memory:')
         bmgraph_db.logger.setLevel(logging.INFO)
         
-        g = u"""
+        g = u"""Term_koira Term_kissa is_related_to llr=10.2
+Term_koiranpentu Term_kissa is_related_to llr=3.0
+Term_hauki Term_ahven is_related_to llr=4.0
 
+# _attributes Term_hauki lemma=Esox+lucius
 """
         self.bmg_file = "/tmp/bmgdb_test_%i.bmg" % os.getpid()
-        with codecs.open(filename, 'w', encoding="utf-8") as f:
+        with codecs.open(self.bmg_file, 'w', encoding="utf-8") as f:
             print >> f, g
-        bmgraph_db.build_db(conn, self.bmg_file)
+        bmgraph_db.build_db(self.conn, self.bmg_file)
 
     def tearDown(self):
         self.conn.close()
@@ -71,6 +1255,31 @@ class TestSuggestAttributes(unittest.TestCase):
         except:
             pass
 
+    def _suggest(self, pattern, fields=[], prefix=False):
+        nodes = bmgraph_db.suggest(self.conn, pattern, fields, prefix=prefix)
+        return set([n.an for n in nodes])
+
+    def _check(self):
+        self.assertEqual(set([u"koira", u"koiranpentu"]), self._suggest(u"oir"))
+        self.assertEqual(set([u"koira", u"koiranpentu"]), self._suggest(u"ko", prefix=True))
+        self.assertEqual(set([u"hauki"]), self._suggest(u"lucius"))
+        self.assertEqual(set([u"hauki"]), self._suggest(u"esox", [u"lemma"]))
+        self.assertEqual(set(), self._suggest(u"irpe"))
+
+    def test_fts(self):
+        self.assertTrue(bmgraph_db.has_fts(self.conn))
+        self._check()
+
+    def test_like(self):
+        self.conn.execute('DROP TABLE node_fts;')
+        self._check()
+
+    def test_sink_sync(self):
+        s = bmgraph_db.BMGraphDBSink(self.conn)
+        bmgraph_file.read_string("Term_susi Term_koira is_related_to llr=2.0\n", s)
+        self.assertEqual(set([u"susi"]), self._suggest(u"usi"))
+
+
 def main():
     unittest.main(testRunner=runner)
 
@@ -11,12 +11,20 @@ import english_specific, french_specific
 import tag_en, tag_fr, tag_fi
 import morphg_en, morphg_fr
 import bmgraph.db
+try:
+    from bmgraph import csrgraph
+except ImportError:
+    # The in-memory graph backend needs NumPy
+    csrgraph = None
 import helpers 
 import codecs
-import sqlite3
 import random
 import sys
 
+# Set to True to open the graph databases immutable, see
+# bmgraph.db.open_readonly().  Only safe while nothing writes to them.
+immutable_graphs = False
+
 def main():
   
     corpus = './runoutta/runoutta_aakkosellinen.txt'
@@ -322,7 +330,7 @@ def get_verse_of_corpus(corpus, num_words, num_lines):
         string = string + ' '.join(line) + '\n'
     return string
 
-def get_nodes(db, word):
+def get_nodes(db, word, backend='sqlite'):
     """
     Looks for neighbouring words for a given word in a graph.
     
@@ -331,12 +339,18 @@ def get_nodes(db, word):
 
     :param db:
     :param word:
+    :param backend: 'sqlite' to query the database, or 'memory' to query
+                    an in-memory copy of the whole graph (needs NumPy)
     :return:
     """
-    conn = sqlite3.connect(db)
-    conn.row_factory = sqlite3.Row
-    nodes = bmgraph.db.edges(conn, word, print_results = False)
-    if nodes == None:
+    if backend == 'memory':
+        return unique_nodes(memory_graph(db).neighbours_of(word, 200))
+    conn = bmgraph.db.pooled_connection(db, immutable=immutable_graphs)
+    if bmgraph.db.has_adjacency(conn):
+        neighbours = bmgraph.db.top_neighbours(conn, word, 200)
+        return unique_nodes([(n.an, n.weight) for n in neighbours])
+    nodes = bmgraph.db.neighbourhood(conn, word)
+    if len(nodes) == 0:
         return None
     else:
         result = parse_nodes(nodes, word)
@@ -345,67 +359,128 @@ def get_nodes(db, word):
     else:
         return result
 
+def memory_graph(db):
+    """
+    Returns the in-memory copy of a graph database, loaded once per process.
+
+    :param db:
+    :return: bmgraph.csrgraph.CSRGraph
+    """
+    if csrgraph is None:
+        raise ImportError("the memory backend needs NumPy")
+    return csrgraph.load(db)
+
+def unique_nodes(nodes):
+    """
+    Drops repeated word-weight tuples, keeping the order.
+
+    :param nodes: list of word-weight tuples or None
+    :return: list of word-weight tuples, or None if there are none
+    """
+    if not nodes:
+        return None
+    result = []
+    seen = set()
+    for node in nodes:
+        if node not in seen:
+            seen.add(node)
+            result.append(node)
+    return result
+
 def parse_nodes(nodes, word):
     """
-    .. important:: 
-       Add description.
+    Picks the neighbouring words and their weights from edge records.
 
-    :param nodes:
-    :param word:
-    :return:
+    :param nodes: edge records as returned by bmgraph.db.neighbourhood
+    :param word: the word whose neighbours are picked
+    :return: list of word-weight tuples, highest weight first
     """
     result = set()
-    for line in nodes:    
-        ln = unicode(line)
-        l = ln.split(' ')
-        l[0] = l[0].replace('stem_', '')
-        l[1] = l[1].replace('stem_', '')
-        l[3] = l[3].replace('goodness=','')
-        l[0] = l[0].replace('Term_', '')
-        l[1] = l[1].replace('Term_', '')
-        l[3] = l[3].replace('llr=','')
-        if l[0] != word:
-            result.add((l[0],l[3]))
-        if l[1] != word:
-            result.add((l[1],l[3]))
-        _result = sorted(list(result), key=lambda node: node[1], reverse=True)
-        
-    return _result
+    for edge in nodes:
+        weight = edge.weight()
+        if edge.n1 != word:
+            result.add((edge.n1, weight))
+        if edge.n2 != word:
+            result.add((edge.n2, weight))
+    return sorted(list(result), key=lambda node: node[1], reverse=True)
+
+def closest_theme(db, theme, max_distance=2):
+    """
+    Looks for the word of the graph that is closest in spelling to the
+    given theme.
 
-def theme_based_words(theme, db, min_num_words):
+    :param db: graph database
+    :param theme: theme that is missing from the graph
+    :param max_distance: maximum edit distance to the theme
+    :return: the closest word, or None if the graph has no BK-tree or
+             no word is close enough
     """
-    Looks for words around the given theme.
+    conn = bmgraph.db.pooled_connection(db, immutable=immutable_graphs)
+    if not bmgraph.db.has_bktree(conn):
+        return None
+    closest = bmgraph.db.fuzzy_lookup(conn, theme, max_distance)
+    if len(closest) == 0:
+        return None
+    return closest[0][1]
 
-    .. important:: 
-       Add description.
+def hop_nodes(db, word, max_nodes, hops=3, backend='sqlite'):
+    """
+    Looks for words at most a few edges away from a given word in a graph,
+    nearest and heaviest first.
+
+    :param db:
+    :param word:
+    :param max_nodes: maximum number of words to return
+    :param hops: maximum number of edges away from word
+    :param backend: as in get_nodes
+    :return: list of word-weight tuples, or None if there are none
+    """
+    if backend == 'memory':
+        nodes = memory_graph(db).hop_neighbours_of(word, hops, max_nodes)
+        return unique_nodes([(an, weight) for an, hop, weight in nodes or []])
+    conn = bmgraph.db.pooled_connection(db, immutable=immutable_graphs)
+    if bmgraph.db.has_adjacency(conn):
+        nodes = bmgraph.db.hop_neighbourhood(conn, word, hops, max_nodes)
+        return unique_nodes([(n.an, n.weight) for n in nodes])
+    # Without the adjacency table, expand the heaviest neighbours one by one
+    words = get_nodes(db, word, backend) or []
+    seen = set([word] + [w[0] for w in words])
+    for w in list(words):
+        if len(words) >= max_nodes:
+            break
+        for more in get_nodes(db, w[0], backend) or []:
+            if more[0] not in seen:
+                seen.add(more[0])
+                words.append(more)
+    return unique_nodes(words[:max_nodes])
+
+def theme_based_words(theme, db, min_num_words, backend='sqlite'):
+    """
+    Looks for words around the given theme.  If the theme has fewer than
+    min_num_words neighbours, words further away are added, nearest first.
 
     :param theme:
     :param db:
     :param min_num_words:
-    :return:
+    :param backend: graph backend for get_nodes
+    :return: tuple of the theme words and a list of word-weight tuples,
+             or an empty list if the theme is not in the graph
     """
-    words = get_nodes(db, theme)
+    words = get_nodes(db, theme, backend)
+    if words == None:
+        closest = closest_theme(db, theme)
+        if closest != None:
+            theme = closest
+            words = get_nodes(db, theme, backend)
     if words == None or len(words) == 0:
         return []
-    while len(words) < min_num_words: 
-        counter = 0
-        while True:
-            rn = random.choice(list(words))
-            if len(rn) > 1:
-                rn = rn[0]
-            more_words = get_nodes(db, rn)
-            if more_words == None or len(more_words) == 0:
-                continue
-            elif counter == 10:
-                break
-            else:
-                words = words.union(more_words)
-                break
+    if len(words) < min_num_words:
+        words = hop_nodes(db, theme, min_num_words, backend=backend)
     themes = [unicode(theme)]
     goodness = [(unicode(theme), 20.0)]
     for w in words:
         themes.append(w[0])
-        goodness.append((w[0], round(float(w[1]), 1)))
+        goodness.append((w[0], round(float(w[1] or 0.0), 1)))
     return (themes, goodness)
 
 def replace_all(language,
@@ -573,8 +648,7 @@ def choose_random_theme(db, number_of_random_words):
     :param number_of_random_words:
     :return:
     """
-    conn = sqlite3.connect(db)
-    conn.row_factory = sqlite3.Row
+    conn = bmgraph.db.pooled_connection(db, immutable=immutable_graphs)
     theme = bmgraph.db.sample(conn, number_of_random_words, print_results=False)
     theme = parse_themes(theme)
     if len(theme) == 1: